@@ -0,0 +1,577 @@
+"""asyncio ingestion service.
+
+Runs the MQTT socket, device windows, feedback publishes and PSQL writes on
+a single event loop, so one process keeps many DB writes and publishes in
+flight at once. Window semantics match ec2_mqtt.py: a window completes after
+MESSAGE_LIMIT messages or is discarded TIMEOUT seconds after its first one.
+
+Model inference still runs on the InferenceBatcher thread. Model files,
+broker (re)connects and the batcher shutdown run in the default executor,
+so none of them blocks the loop.
+
+Usage:
+    python async_service.py
+"""
+
+# Basic libraries
+import asyncio
+import datetime
+import json
+import logging
+import os
+import signal
+import threading
+from decimal import Decimal
+from warnings import filterwarnings
+
+# PSQL Library
+import asyncpg
+
+# MQTT Library
+import paho.mqtt.client as mqttClient
+
+# Custom modules
+import calculations, dedup, device_cache, device_registry, inference_batcher
+import model_registry, payload_parser, psql_func, rollups, settings, spool
+filterwarnings("ignore")
+
+# Logging
+logging.basicConfig(
+    filename=settings.MQTT_LOG_FILE,
+    filemode="a",
+    format="%(asctime)s - %(levelname)s %(message)s",
+    level=logging.INFO,
+)
+
+# Topics
+SUB_TOPIC = settings.SUB_TOPIC
+CONTROL_TOPIC = settings.CONTROL_TOPIC
+
+# MQTT Credentials
+USER = settings.MQTT_USER
+PASSWORD = settings.MQTT_PASSWORD
+
+BROKER_ADDRESS = settings.BROKER_ADDRESS
+MQTT_PORT = settings.MQTT_PORT
+
+TIMEOUT = settings.TIMEOUT
+
+# Batches replayed from the spool after a crash keep their keys
+INSERT_QUERY = """INSERT INTO public."QLog_data" VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11)
+ON CONFLICT (id) DO NOTHING"""
+DEVICE_ROLLUP_UPSERT = psql_func.DEVICE_ROLLUP_UPSERT.format(
+    values="($1, $2, $3, $4, $5, $6, $7, $8, $9, $10)")
+WAREHOUSE_ROLLUP_UPSERT = psql_func.WAREHOUSE_ROLLUP_UPSERT.format(
+    values="($1, $2, $3, $4, $5, $6, $7, $8, $9)")
+
+
+class AsyncioHelper:
+    """Drives a paho client from an asyncio event loop instead of its own thread
+
+    Must be created on the loop thread. connect and reconnect block on the TCP
+    handshake, so they run in an executor; the socket callbacks they trigger
+    are handed to the loop and waited for.
+
+    Args:
+        loop (asyncio.AbstractEventLoop): The running loop
+        client (mqttClient): The paho client
+    """
+
+    def __init__(self, loop, client):
+        self.loop = loop
+        self.client = client
+        self.misc = None
+        self._loop_thread = threading.get_ident()
+
+        self.client.on_socket_open = self.on_socket_open
+        self.client.on_socket_close = self.on_socket_close
+        self.client.on_socket_register_write = self.on_socket_register_write
+        self.client.on_socket_unregister_write = self.on_socket_unregister_write
+
+    def _on_loop(self, callback, *args):
+        # Waiting is safe, the loop is only awaiting the executor meanwhile.
+        # The socket is closed right after on_socket_close returns
+        if threading.get_ident() == self._loop_thread:
+            callback(*args)
+        else:
+            asyncio.run_coroutine_threadsafe(self._call(callback, *args), self.loop).result()
+
+    @staticmethod
+    async def _call(callback, *args):
+        callback(*args)
+
+    def on_socket_open(self, client, userdata, sock):
+        self._on_loop(self._open, client, sock)
+
+    def _open(self, client, sock):
+        self.loop.add_reader(sock, client.loop_read)
+        self.misc = self.loop.create_task(self.misc_loop())
+
+    def on_socket_close(self, client, userdata, sock):
+        self._on_loop(self._close, sock)
+
+    def _close(self, sock):
+        self.loop.remove_reader(sock)
+        if self.misc is not None:
+            self.misc.cancel()
+
+    def on_socket_register_write(self, client, userdata, sock):
+        self._on_loop(self.loop.add_writer, sock, client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self._on_loop(self.loop.remove_writer, sock)
+
+    async def misc_loop(self):
+        # Keepalive pings and retries
+        while self.client.loop_misc() == mqttClient.MQTT_ERR_SUCCESS:
+            try:
+                await asyncio.sleep(1)
+            except asyncio.CancelledError:
+                break
+
+
+class AsyncBulkWriter:
+    """Spools readings to disk and drains them to PSQL from the event loop
+
+    add() only appends to the spool. The appends are fsynced in the default
+    executor every fsync_interval seconds, and durable readings are written
+    in batches once max_rows are waiting or the oldest has waited max_delay.
+    While PSQL is failing readings stay on disk and are retried every
+    retry_delay seconds, and readings left on close are written by the next
+    run. Spool is not thread safe, so the rest of its bookkeeping, including
+    the checkpoint written per batch, stays on the loop.
+
+    Args:
+        pool (asyncpg.Pool): Connection pool
+        spool (spool.Spool): The spool, opened by start()
+        max_rows (int): Number of waiting rows that triggers a write
+        max_delay (float): Seconds a reading may wait before it is written
+        fsync_interval (float): Seconds between fsyncs of new readings
+        retry_delay (float): Seconds to wait after a failed write
+    """
+
+    def __init__(self, pool, spool,
+                 max_rows=settings.BULK_WRITE_MAX_ROWS,
+                 max_delay=settings.BULK_WRITE_MAX_DELAY,
+                 fsync_interval=settings.SPOOL_FSYNC_INTERVAL,
+                 retry_delay=settings.BULK_WRITE_RETRY_DELAY):
+        self.pool = pool
+        self.spool = spool
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self.fsync_interval = fsync_interval
+        self.retry_delay = retry_delay
+
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._converters = None
+        self._closing = False
+
+        # Appended readings not yet fsynced, and when the first was appended
+        self._unsynced = 0
+        self._first_unsynced = None
+
+        # When the oldest unwritten reading was appended
+        self._first_pending = None
+        self._retry_at = 0
+
+    def start(self):
+        """Opens the spool and starts draining it"""
+        loop = asyncio.get_running_loop()
+        if self.spool.open():
+            # Left by the last run, written straight away
+            self._first_pending = loop.time() - self.max_delay
+
+        self._task = loop.create_task(self._run())
+        return self
+
+    def add(self, warehouse_id, device_id, device_readings):
+        """Appends a reading to the spool"""
+        now = datetime.datetime.now(tz=psql_func.TIMEZONE)
+        self.spool.append((warehouse_id, device_id, device_readings, now))
+
+        loop_time = asyncio.get_running_loop().time()
+        if not self._unsynced:
+            self._first_unsynced = loop_time
+        if self._first_pending is None:
+            self._first_pending = loop_time
+        self._unsynced += 1
+
+        if self._unsynced >= self.max_rows or self.spool.pending() >= self.max_rows:
+            self._wakeup.set()
+
+    async def close(self, timeout=settings.BULK_WRITE_CLOSE_TIMEOUT):
+        """Makes one last attempt to drain the spool and closes it
+
+        Args:
+            timeout (float): Maximum seconds to wait for the final writes
+        """
+        self._closing = True
+        self._wakeup.set()
+
+        try:
+            await asyncio.wait_for(asyncio.shield(self._task), timeout)
+        except asyncio.TimeoutError:
+            # The batch being written is replayed with the same keys next run
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+        if self.spool.pending():
+            logging.error("Bulk writer closed with %s unwritten readings, "
+                          "written on next start" % self.spool.pending())
+        self.spool.close()
+
+    def _sync_due(self, now):
+        if not self._unsynced:
+            return False
+        return (self._closing or self._unsynced >= self.max_rows
+                or now - self._first_unsynced >= self.fsync_interval)
+
+    def _drain_due(self, now):
+        if not self.spool.pending() or now < self._retry_at:
+            return False
+        return (self._closing or self.spool.pending() >= self.max_rows
+                or now - self._first_pending >= self.max_delay)
+
+    def _wait_time(self, now):
+        deadlines = []
+        if self._unsynced:
+            deadlines.append(self._first_unsynced + self.fsync_interval)
+        if self.spool.pending():
+            deadlines.append(max(self._first_pending + self.max_delay, self._retry_at))
+        return max(0, min(deadlines) - now) if deadlines else None
+
+    async def _sync(self):
+        fd, position = self.spool.flush()
+        self._unsynced = 0
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, os.fsync, fd)
+        finally:
+            os.close(fd)
+        self.spool.mark_synced(position)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            now = loop.time()
+            if self._sync_due(now):
+                await self._sync()
+                continue
+
+            if self._drain_due(now):
+                if self._unsynced:
+                    await self._sync()
+                if not await self._write():
+                    if self._closing:
+                        return
+                    self._retry_at = loop.time() + self.retry_delay
+                continue
+
+            if self._closing and not self._unsynced:
+                return
+
+            # Nothing awaited since the checks, so no add() is missed
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self._wait_time(now))
+            except asyncio.TimeoutError:
+                pass
+
+    async def _write(self):
+        """Writes the next durable batch, False if PSQL failed"""
+        rows, ids = self.spool.read(self.max_rows)
+        if not rows:
+            # Everything pending was dropped while syncing
+            self.spool.abort()
+            return True
+
+        try:
+            async with self.pool.acquire() as conn:
+                if self._converters is None:
+                    self._converters = await self._parameter_converters(conn)
+
+                if ids is None:
+                    ids = await psql_func.id_allocator.allocate_async(conn, len(rows))
+                    self.spool.begin(ids)
+                records = [self._convert(psql_func.build_params(id_pk, *row))
+                           for id_pk, row in zip(ids, rows)]
+
+                async with conn.transaction():
+                    await conn.executemany(INSERT_QUERY, records)
+        except Exception as e:
+            logging.error("Bulk write of %s readings failed - %s" % (len(rows), e))
+            self.spool.abort()
+            return False
+
+        self.spool.commit()
+        self._first_pending = (asyncio.get_running_loop().time()
+                               if self.spool.pending() else None)
+        return True
+
+    @staticmethod
+    async def _parameter_converters(conn):
+        """asyncpg needs Python types matching the columns, psycopg2 sent literals"""
+        statement = await conn.prepare(INSERT_QUERY)
+        converters = []
+        for parameter in statement.get_parameters():
+            name = parameter.name
+            if name == "date":
+                converters.append(lambda v: datetime.date.fromisoformat(v) if isinstance(v, str) else v)
+            elif name in ("time", "timetz"):
+                converters.append(lambda v: datetime.time.fromisoformat(v) if isinstance(v, str) else v)
+            elif name in ("int2", "int4", "int8"):
+                converters.append(int)
+            elif name in ("float4", "float8"):
+                converters.append(float)
+            elif name == "numeric":
+                converters.append(lambda v: Decimal(str(v)))
+            elif name in ("text", "varchar", "bpchar"):
+                converters.append(str)
+            else:
+                converters.append(lambda v: v)
+        return converters
+
+    def _convert(self, params):
+        return tuple(convert(value) for convert, value in zip(self._converters, params))
+
+
+class AsyncIngestService:
+    """Window handling, feedback and PSQL writes on one event loop"""
+
+    def __init__(self):
+        self.devices = device_registry.DeviceRegistry()
+        self.duplicates = dedup.DuplicateFilter()
+        self.batcher = inference_batcher.InferenceBatcher()
+        self.brix_models = model_registry.ModelRegistry('BRIX', settings.DEFAULT_BRIX_MODEL)
+        self.clf_models = model_registry.ModelRegistry('CLF', settings.DEFAULT_CLF_MODEL)
+        self.device_settings = device_cache.DeviceSettingsCache(psql_func.get_device_data)
+        # Aggregated on the loop, upserted from the aggregator's thread through the loop
+        self.rollup = rollups.RollupAggregator(self.write_rollups, self.create_rollup_tables)
+
+        self.loop = None
+        self.client = None
+        self.pool = None
+        self.writer = None
+        self._timers = {}
+        self._tasks = set()
+        self._stopped = None
+
+    async def run(self):
+        """Serves until SIGTERM or SIGINT, then drains"""
+        self.loop = asyncio.get_running_loop()
+        self._stopped = asyncio.Event()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            self.loop.add_signal_handler(signum, self._stopped.set)
+
+        self.pool = await asyncpg.create_pool(database=settings.PSQL_DB_NAME,
+                                              user=settings.PSQL_USER,
+                                              password=settings.PSQL_PASSWORD,
+                                              host=settings.PSQL_HOST,
+                                              port=settings.PSQL_PORT,
+                                              min_size=1,
+                                              max_size=settings.ASYNC_DB_POOL_SIZE,
+                                              init=self._init_connection)
+        self.writer = AsyncBulkWriter(self.pool, spool.Spool(f"{settings.SPOOL_DIR}async/")).start()
+        self.batcher.start()
+        self.rollup.start()
+
+        self.client = self.create_client()
+        AsyncioHelper(self.loop, self.client)
+        # Off the loop, the socket callbacks still register with the loop
+        await self.loop.run_in_executor(None, self.client.connect, BROKER_ADDRESS, MQTT_PORT)
+        logging.info(f"Connected via asyncio service ({USER})")
+
+        reconnect = self.loop.create_task(self._keep_connected())
+        await self._stopped.wait()
+
+        # Stop taking readings, then finish the windows already completed
+        logging.info("Shutting down asyncio service")
+        reconnect.cancel()
+        self.client.unsubscribe(SUB_TOPIC)
+        await asyncio.gather(*list(self._tasks), return_exceptions=True)
+        # Results of the last batches are delivered through the loop
+        await self.loop.run_in_executor(None, self.batcher.close,
+                                        settings.PIPELINE_STOP_TIMEOUT)
+        await self.writer.close()
+        # The last upsert runs on this loop, so wait for it off the loop
+        await self.loop.run_in_executor(None, self.rollup.close,
+                                        settings.BULK_WRITE_CLOSE_TIMEOUT)
+        self.client.disconnect()
+        await self.pool.close()
+
+    @staticmethod
+    async def _init_connection(conn):
+        # psycopg2 returned JSON columns (white_standard) as dicts
+        for json_type in ("json", "jsonb"):
+            await conn.set_type_codec(json_type, encoder=json.dumps,
+                                      decoder=json.loads, schema="pg_catalog")
+
+    def create_rollup_tables(self):
+        asyncio.run_coroutine_threadsafe(self._create_rollup_tables(), self.loop).result()
+
+    async def _create_rollup_tables(self):
+        async with self.pool.acquire() as conn:
+            for statement in psql_func.ROLLUP_TABLES:
+                await conn.execute(statement)
+
+    def write_rollups(self, device_rows, warehouse_rows):
+        asyncio.run_coroutine_threadsafe(
+            self._write_rollups(device_rows, warehouse_rows), self.loop).result()
+
+    async def _write_rollups(self, device_rows, warehouse_rows):
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                # Sorted, so concurrent ingest processes lock shared rows in the same order
+                for query, rows in ((DEVICE_ROLLUP_UPSERT, device_rows),
+                                    (WAREHOUSE_ROLLUP_UPSERT, warehouse_rows)):
+                    if rows:
+                        await conn.executemany(query, [psql_func.rollup_params(row)
+                                                       for row in sorted(rows)])
+
+    def create_client(self):
+        # Persistent session, the broker queues readings while the service restarts
+        client = mqttClient.Client(client_id=settings.ASYNC_CLIENT_ID, clean_session=False)
+        client.username_pw_set(USER, password=PASSWORD)
+        client.on_connect = self.on_connect
+        client.on_message = self.on_message
+        client.on_disconnect = self.on_disconnect
+        return client
+
+    async def _keep_connected(self):
+        while True:
+            await asyncio.sleep(settings.ASYNC_RECONNECT_INTERVAL)
+            if not self.client.is_connected():
+                try:
+                    await self.loop.run_in_executor(None, self.client.reconnect)
+                    logging.info("Reconnected to broker")
+                except Exception as e:
+                    logging.error("Reconnect failed - %s" % e)
+
+    """
+    CALLBACKS
+    """
+
+    def on_connect(self, client, userdata, flags, rc):
+        if rc == 0:
+            logging.info("Connected to broker")
+            client.subscribe([(SUB_TOPIC, settings.MQTT_SUBSCRIBE_QOS),
+                              (CONTROL_TOPIC, settings.MQTT_SUBSCRIBE_QOS)])
+        else:
+            logging.error("Connection failed from asyncio service %s", str(rc))
+
+    def on_disconnect(self, client, userdata, rc):
+        if rc == 0:
+            logging.info("Disconnected")
+        else:
+            logging.error("Unexpected disconnect from asyncio service %s", str(rc))
+
+    def on_message(self, client, userdata, message):
+        """Runs on the event loop, completed windows continue in a task"""
+        if message.topic == CONTROL_TOPIC:
+            self.handle_control(message.payload)
+            return
+
+        # Drop redeliveries and retransmits of recent payloads before they reach a window
+        if self.duplicates.is_duplicate(message.payload, message.dup):
+            return
+
+        try:
+            warehouse_id, device_id, readings = payload_parser.parse_payload(message.payload)
+        except payload_parser.PayloadError as e:
+            logging.error("Dropping unparsable message - %s" % e)
+            return
+
+        device = self.devices.get_or_create(warehouse_id, device_id)
+        device.add(readings)
+
+        # Start the time out with the first message of the window
+        if device.end_time == -1:
+            device.end_time = self.loop.time() + TIMEOUT
+            self._timers[device] = self.loop.call_at(device.end_time, self.on_timeout, device)
+
+        if device.message_count == self.devices.message_limit:
+            raw_mean_values = device.window_mean()
+            self.reset_variables(device)
+
+            task = self.loop.create_task(self.complete_window(warehouse_id, device_id,
+                                                              device.pub_topic, raw_mean_values))
+            self._tasks.add(task)
+            task.add_done_callback(self._window_done)
+
+    def _window_done(self, task):
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logging.error("Completing window failed - %s" % task.exception())
+
+    def handle_control(self, payload):
+        """Runs a command published on the control topic, see ec2_mqtt.handle_control"""
+        try:
+            command, _, argument = payload.decode("utf-8").strip().partition(",")
+        except UnicodeDecodeError as e:
+            logging.error("Dropping undecodable control command - %s" % e)
+            return
+
+        if command == "invalidate_settings":
+            self.device_settings.invalidate(argument.strip() or None)
+        else:
+            logging.error("Unknown control command %s" % command)
+
+    def on_timeout(self, device):
+        logging.error(f"Timeout exceeded for {device.name}")
+        self._timers.pop(device, None)
+        self.reset_variables(device)
+
+    def reset_variables(self, device):
+        timer = self._timers.pop(device, None)
+        if timer is not None:
+            timer.cancel()
+        device.reset()
+
+    async def complete_window(self, warehouse_id, device_id, pub_topic, raw_mean_values):
+        """Scores a completed window, publishes the feedback and queues the row"""
+        try:
+            fruit, variety, white_standard, batch_number, vendor_code, device_type = (
+                await self.get_device_data(warehouse_id, device_id))[0]
+            white_standard = [float(x) for x in white_standard.values()]
+
+            brix_model = await self.loop.run_in_executor(None, self.brix_models.get, fruit, variety)
+            clf_model = await self.loop.run_in_executor(None, self.clf_models.get, fruit, variety)
+
+        except Exception as e:
+            logging.critical("Failed to load device data - %s" % e)
+
+            white_standard = settings.DEFAULT_WHITE_STANDARD
+            brix_model = await self.loop.run_in_executor(None, lambda: self.brix_models.default)
+            clf_model = await self.loop.run_in_executor(None, lambda: self.clf_models.default)
+
+        normalized_values = calculations.normalize_fruit_data(raw_mean_values, white_standard)
+
+        scored = self.loop.create_future()
+
+        def deliver(*result):
+            self.loop.call_soon_threadsafe(scored.set_result, result)
+
+        self.batcher.submit(brix_model, clf_model, normalized_values, deliver)
+        predicted_brix, brix_level, fruit_status = await scored
+
+        # Send feedback
+        message_to_client = f"{str(fruit_status)}{brix_level},{round(float(predicted_brix), 2)};"
+        self.client.publish(pub_topic, message_to_client)
+
+        # Update to DB
+        self.writer.add(warehouse_id, device_id, raw_mean_values)
+        self.rollup.add(warehouse_id, device_id, raw_mean_values)
+
+    async def get_device_data(self, warehouse_id, device_id):
+        """Device settings from the cache, loaded with asyncpg on a miss"""
+        response = self.device_settings.peek(device_id)
+        if response is None:
+            rows = await self.pool.fetch(psql_func.DEVICE_DATA_QUERY, device_id)
+            response = [tuple(row) for row in rows]
+            self.device_settings.put(device_id, response)
+        return response
+
+
+if __name__ == "__main__":
+
+    asyncio.run(AsyncIngestService().run())
@@ -1,11 +1,26 @@
 #!/bin/bash
 
-echo 'Stopping feedback.service'
-sudo systemctl stop feedback.service
-echo 'Starting feedback.service'
-sudo systemctl start feedback.service
-
-echo 'Stopping update.service'
-sudo systemctl stop status_update.service
-echo 'Starting update.service'
-sudo systemctl start status_update.service
\ No newline at end of file
+# Restarts one service at a time and waits until it reports ready on
+# http://127.0.0.1:<metrics port>/ready. The services keep persistent MQTT
+# sessions, so the broker queues their messages while they restart.
+
+READY_TIMEOUT=120
+
+restart_service() {
+    echo "Restarting $1"
+    sudo systemctl restart "$1"
+
+    for ((waited = 0; waited < READY_TIMEOUT; waited++)); do
+        if curl -sf "http://127.0.0.1:$2/ready" > /dev/null; then
+            echo "$1 ready after ${waited}s"
+            return 0
+        fi
+        sleep 1
+    done
+
+    echo "$1 not ready after ${READY_TIMEOUT}s: $(curl -s "http://127.0.0.1:$2/ready")"
+    return 1
+}
+
+restart_service feedback.service 9108 || exit 1
+restart_service status_update.service 9109
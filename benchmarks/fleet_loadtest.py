@@ -0,0 +1,313 @@
+"""End-to-end load test with a simulated device fleet.
+
+Starts main.py or ec2_mqtt.py against a local broker, publishes /proto/out
+payloads from N simulated devices spread over M warehouses at a fixed rate,
+and reports as JSON:
+
+    throughput     Messages received and windows committed per second
+    latency        p50/p95/p99/max seconds from the last message of a window
+                   being published to its row being committed
+    process        CPU seconds, CPU utilisation and peak RSS of the service
+    service        Counters scraped from the service's metrics endpoint
+
+Needs a mosquitto broker on --broker. PSQL is either the one configured
+with --psql-host or, with --stub-db, an in-process stand-in that only
+records commits, which measures the service without a database.
+
+Usage:
+    python benchmarks/fleet_loadtest.py --devices 1000 --warehouses 10 \\
+        --rate 1 --duration 60 --stub-db --output result.json
+"""
+
+# Basic libraries
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+
+# MQTT Library
+import paho.mqtt.client as mqttClient
+
+# Custom modules
+import payload_parser
+import settings
+
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+SCRAPED_METRICS = ("qlog_messages_received_total", "qlog_duplicate_messages_total",
+                   "qlog_parse_errors_total",
+                   "qlog_windows_completed_total", "qlog_windows_timed_out_total",
+                   "qlog_publish_failures_total", "qlog_db_write_failures_total",
+                   "qlog_db_rows_written_total", "qlog_queue_depth",
+                   "qlog_spool_pending_readings")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--service", default="ec2_mqtt.py", choices=("ec2_mqtt.py", "main.py"))
+    parser.add_argument("--devices", type=int, default=100)
+    parser.add_argument("--warehouses", type=int, default=10)
+    parser.add_argument("--rate", type=float, default=1.0, help="Messages per second per device")
+    parser.add_argument("--duration", type=float, default=30.0, help="Seconds of publishing")
+    parser.add_argument("--drain", type=float, default=15.0, help="Seconds to wait for the last commits")
+    parser.add_argument("--publishers", type=int, default=2, help="Publishing threads")
+    parser.add_argument("--message-limit", type=int, default=settings.MESSAGE_LIMIT)
+    parser.add_argument("--binary", action="store_true", help="Send binary payloads")
+    parser.add_argument("--broker", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=1883)
+    parser.add_argument("--psql-host", default="127.0.0.1")
+    parser.add_argument("--psql-port", type=int, default=settings.PSQL_PORT)
+    parser.add_argument("--stub-db", action="store_true", help="Replace PSQL by an in-process stand-in")
+    parser.add_argument("--metrics-port", type=int, default=19108)
+    parser.add_argument("--output", help="Write the JSON result to this file")
+    return parser.parse_args()
+
+
+class Device:
+
+    __slots__ = ("warehouse_id", "device_id", "sent", "window_ends")
+
+    def __init__(self, warehouse_id, device_id):
+        self.warehouse_id = warehouse_id
+        self.device_id = device_id
+        self.sent = 0
+        # Publish time of the last message of every window
+        self.window_ends = []
+
+
+def create_fleet(devices, warehouses):
+    return [Device(f"WH{index % warehouses:04d}", f"D{index:06d}")
+            for index in range(devices)]
+
+
+def payload(device, binary):
+    readings = [round(random.uniform(0, 100), 2) for _ in range(7)]
+    if binary:
+        return payload_parser.pack_binary_payload(device.warehouse_id, device.device_id, readings)
+    return ", ".join(str(reading) for reading in readings) + f", {device.warehouse_id}, {device.device_id}"
+
+
+def publish(devices, args, start, stop, lag):
+    """Publishes for every device of this thread at args.rate, spread evenly"""
+    client = mqttClient.Client()
+    client.connect(args.broker, args.port)
+    client.loop_start()
+
+    period = 1.0 / args.rate
+    step = period / len(devices)
+    round_number = 0
+
+    while not stop.is_set():
+        for index, device in enumerate(devices):
+            due = start + round_number * period + index * step
+            delay = due - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                lag[0] = max(lag[0], -delay)
+            if stop.is_set():
+                break
+
+            client.publish(settings.SUB_TOPIC, payload(device, args.binary))
+            device.sent += 1
+            if device.sent % args.message_limit == 0:
+                device.window_ends.append(time.time())
+        round_number += 1
+
+    client.loop_stop()
+    client.disconnect()
+
+
+def scrape(port):
+    values = {}
+    try:
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics", timeout=5) as response:
+            for line in response.read().decode("utf-8").splitlines():
+                name, _, value = line.partition(" ")
+                if name in SCRAPED_METRICS:
+                    values[name] = float(value)
+    except OSError:
+        pass
+    return values
+
+
+def process_usage(pid):
+    """(CPU seconds, RSS bytes) of a process from /proc"""
+    with open(f"/proc/{pid}/stat") as stat_file:
+        fields = stat_file.read().rsplit(")", 1)[1].split()
+    with open(f"/proc/{pid}/statm") as statm_file:
+        rss_pages = int(statm_file.read().split()[1])
+    return (int(fields[11]) + int(fields[12])) / CLOCK_TICKS, rss_pages * PAGE_SIZE
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def latencies(fleet, commit_log):
+    """Matches the n-th commit of a device with its n-th completed window"""
+    commits = {}
+    with open(commit_log) as log_file:
+        for line in log_file:
+            commit_time, warehouse_id, device_id = line.rstrip("\n").split(",")
+            commits.setdefault((warehouse_id, device_id), []).append(float(commit_time))
+
+    result = []
+    for device in fleet:
+        device_commits = commits.get((device.warehouse_id, device.device_id), [])
+        result.extend(commit - sent for sent, commit in zip(device.window_ends, device_commits))
+    return result, [commit for device_commits in commits.values() for commit in device_commits]
+
+
+def start_service(args, work_dir, commit_log):
+    log_dir = os.path.join(work_dir, "log") + "/"
+    os.makedirs(log_dir)
+    overrides = {
+        "BROKER_ADDRESS": args.broker,
+        "MQTT_PORT": args.port,
+        "PSQL_HOST": args.psql_host,
+        "PSQL_PORT": args.psql_port,
+        "MESSAGE_LIMIT": args.message_limit,
+        "LOG_DIR": log_dir,
+        "MQTT_LOG_FILE": f"{log_dir}mqtt.log",
+        "SPOOL_DIR": os.path.join(work_dir, "spool") + "/",
+        "EC2_METRICS_PORT": args.metrics_port,
+        "MAIN_METRICS_PORT": args.metrics_port,
+        # Sessions persist on the broker, keep runs apart
+        "EC2_CLIENT_ID": f"qlog-loadtest-{os.getpid()}",
+    }
+    env = dict(os.environ,
+               QLOG_SETTINGS_OVERRIDES=json.dumps(overrides),
+               QLOG_COMMIT_LOG=commit_log,
+               QLOG_STUB_DB="1" if args.stub_db else "0")
+
+    return subprocess.Popen([sys.executable, os.path.join(BASE_DIR, "benchmarks", "run_service.py"),
+                             args.service], env=env, cwd=BASE_DIR)
+
+
+def is_ready(port):
+    try:
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/ready", timeout=5) as response:
+            return response.status == 200
+    except OSError:
+        return False
+
+
+def wait_until_ready(port, service, timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if service.poll() is not None:
+            raise RuntimeError("Service exited with %s" % service.returncode)
+        if is_ready(port):
+            return
+        time.sleep(0.2)
+    raise RuntimeError("Service did not report ready")
+
+
+def run(args):
+    work_dir = tempfile.mkdtemp(prefix="qlog-loadtest-")
+    commit_log = os.path.join(work_dir, "commits.csv")
+    open(commit_log, "w").close()
+
+    service = start_service(args, work_dir, commit_log)
+    try:
+        wait_until_ready(args.metrics_port, service)
+        # Let the subscription settle
+        time.sleep(1)
+
+        fleet = create_fleet(args.devices, args.warehouses)
+        before = scrape(args.metrics_port)
+        cpu_before, peak_rss = process_usage(service.pid)
+
+        stop = threading.Event()
+        lag = [0.0]
+        start = time.time() + 0.5
+        threads = [threading.Thread(target=publish, args=(fleet[index::args.publishers], args,
+                                                          start, stop, lag))
+                   for index in range(args.publishers)]
+        for thread in threads:
+            thread.start()
+
+        # Sample RSS while publishing and draining
+        end = start + args.duration
+        while time.time() < end + args.drain:
+            if time.time() >= end:
+                stop.set()
+            peak_rss = max(peak_rss, process_usage(service.pid)[1])
+            time.sleep(0.5)
+        for thread in threads:
+            thread.join()
+
+        elapsed = time.time() - start
+        cpu_after, rss = process_usage(service.pid)
+        after = scrape(args.metrics_port)
+    finally:
+        service.terminate()
+        try:
+            service.wait(60)
+        except subprocess.TimeoutExpired:
+            service.kill()
+
+    window_latencies, commit_times = latencies(fleet, commit_log)
+    committed = len(commit_times)
+    # Sustained rate, commits that happened while the fleet was publishing
+    committed_in_run = sum(1 for commit in commit_times if start <= commit <= end)
+    published = sum(device.sent for device in fleet)
+    delta = {name: after.get(name, 0) - before.get(name, 0) for name in SCRAPED_METRICS}
+    delta["qlog_queue_depth"] = after.get("qlog_queue_depth")
+    delta["qlog_spool_pending_readings"] = after.get("qlog_spool_pending_readings")
+
+    result = {
+        "config": {key: value for key, value in vars(args).items() if key != "output"},
+        "published_messages": published,
+        "publisher_max_lag_seconds": lag[0],
+        "expected_windows": sum(len(device.window_ends) for device in fleet),
+        "committed_windows": committed,
+        "throughput": {
+            "published_per_second": published / args.duration,
+            "received_per_second": delta["qlog_messages_received_total"] / args.duration,
+            "committed_windows_per_second": committed_in_run / args.duration,
+        },
+        "latency_seconds": {
+            "samples": len(window_latencies),
+            "p50": percentile(window_latencies, 0.50),
+            "p95": percentile(window_latencies, 0.95),
+            "p99": percentile(window_latencies, 0.99),
+            "max": max(window_latencies) if window_latencies else None,
+        },
+        "process": {
+            "cpu_seconds": cpu_after - cpu_before,
+            "cpu_utilisation": (cpu_after - cpu_before) / elapsed,
+            "peak_rss_bytes": peak_rss,
+            "final_rss_bytes": rss,
+        },
+        "service": delta,
+    }
+
+    shutil.rmtree(work_dir, ignore_errors=True)
+    return result
+
+
+if __name__ == "__main__":
+
+    args = parse_args()
+    result = json.dumps(run(args), indent=2)
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            output_file.write(result + "\n")
+    print(result)
@@ -0,0 +1,247 @@
+"""Microbenchmarks of the calculation and parsing hot path.
+
+Every benchmark is timed with timeit (best of several repeats) and compared
+with the per-call time stored in benchmarks/baselines.json. The run fails
+if any benchmark is slower than its baseline by more than the threshold.
+A benchmark without a baseline fails the run as well. Baselines depend on
+the machine and the installed versions, record them on the machine that
+runs the comparison, with requirements.txt installed.
+
+Models are the bundled models/default_brix.sav and models/default_clf.sav,
+payloads and readings are synthetic with a fixed seed. Benchmarks whose
+dependencies are not installed (the pinned scikit-learn for the models,
+psycopg2 for psql_func) are reported as skipped.
+
+Usage:
+    python benchmarks/microbench.py                    Compare with the baselines
+    python benchmarks/microbench.py --update           Store the current timings
+    python benchmarks/microbench.py --only parse_ids_text,predict_brix
+"""
+
+# Basic libraries
+import argparse
+import functools
+import json
+import os
+import pickle
+import platform
+import sys
+import timeit
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+
+# Scientific Libraries
+import numpy as np
+
+# Custom modules
+import calculations
+import payload_parser
+import settings
+
+BASELINES_FILE = os.path.join(BASE_DIR, "benchmarks", "baselines.json")
+MODEL_DIR = os.path.join(BASE_DIR, "models")
+
+DEFAULT_THRESHOLD = 1.25
+REPEATS = 7
+BATCH_SIZE = 256
+
+# name -> setup function returning the callable to time
+BENCHMARKS = {}
+
+
+class Unavailable(Exception):
+    """Raised by a setup function whose dependencies are not installed"""
+
+
+def benchmark(name):
+    def register(setup):
+        BENCHMARKS[name] = setup
+        return setup
+    return register
+
+
+@functools.lru_cache(maxsize=None)
+def load_model(name):
+    try:
+        with open(os.path.join(MODEL_DIR, name), 'rb') as model_file:
+            return pickle.load(model_file)
+    except (ImportError, AttributeError) as e:
+        # The pickles reference modules of the pinned scikit-learn
+        raise Unavailable("%s needs the pinned scikit-learn - %s" % (name, e))
+
+
+def n_features(model):
+    for attribute in ("n_features_in_", "n_features_"):
+        if hasattr(model, attribute):
+            return getattr(model, attribute)
+    return np.asarray(model.coef_).shape[-1]
+
+
+def readings(count=7, seed=0):
+    return np.random.RandomState(seed).uniform(1, 100, size=count)
+
+
+def text_payload():
+    values = ", ".join(f"{value:.2f}" for value in readings())
+    return f"{values}, WC0001, D20".encode("utf-8")
+
+
+@benchmark("parse_ids_text")
+def _parse_ids_text():
+    return functools.partial(payload_parser.parse_ids, text_payload())
+
+
+@benchmark("parse_payload_text")
+def _parse_payload_text():
+    return functools.partial(payload_parser.parse_payload, text_payload())
+
+
+@benchmark("parse_payload_binary")
+def _parse_payload_binary():
+    payload = payload_parser.pack_binary_payload("WC0001", "D20", readings())
+    return functools.partial(payload_parser.parse_payload, payload)
+
+
+@benchmark("normalize_fruit_data")
+def _normalize_fruit_data():
+    return functools.partial(calculations.normalize_fruit_data, readings(),
+                             settings.DEFAULT_WHITE_STANDARD)
+
+
+@benchmark("calculate_brix_level")
+def _calculate_brix_level():
+    return functools.partial(calculations.calculate_brix_level, 13.7)
+
+
+@benchmark("calculate_brix_levels_batch")
+def _calculate_brix_levels_batch():
+    return functools.partial(calculations.calculate_brix_levels,
+                             np.random.RandomState(0).uniform(5, 20, BATCH_SIZE))
+
+
+@benchmark("predict_brix")
+def _predict_brix():
+    model = load_model("default_brix.sav")
+    return functools.partial(calculations.predict_brix, readings(n_features(model)), model)
+
+
+@benchmark("predict_brix_batch")
+def _predict_brix_batch():
+    model = load_model("default_brix.sav")
+    values = np.random.RandomState(0).uniform(0, 2, (BATCH_SIZE, n_features(model)))
+    return functools.partial(calculations.predict_brix_batch, values, model)
+
+
+@benchmark("predict_status")
+def _predict_status():
+    model = load_model("default_clf.sav")
+    return functools.partial(calculations.predict_status, readings(n_features(model)), model)
+
+
+@benchmark("predict_status_batch")
+def _predict_status_batch():
+    model = load_model("default_clf.sav")
+    values = np.random.RandomState(0).uniform(0, 2, (BATCH_SIZE, n_features(model)))
+    return functools.partial(calculations.predict_status_batch, values, model)
+
+
+@benchmark("create_dictionary")
+def _create_dictionary():
+    # Imported here, psql_func needs the PSQL driver installed
+    try:
+        import psql_func
+    except ImportError as e:
+        raise Unavailable("psql_func needs psycopg2 and pytz - %s" % e)
+    return functools.partial(psql_func.create_dictionary, settings.DEVICE_READINGS,
+                             list(readings(len(settings.DEVICE_READINGS))))
+
+
+def measure(func, repeats=REPEATS):
+    """Best seconds per call over several repeats"""
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=repeats, number=number)) / number
+
+
+def load_baselines(path):
+    if not os.path.exists(path):
+        return {"benchmarks": {}}
+    with open(path) as baselines_file:
+        return json.load(baselines_file)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--update", action="store_true", help="Store the timings as baselines")
+    parser.add_argument("--threshold", type=float,
+                        help="Allowed slowdown factor, default from the baselines file or %s"
+                        % DEFAULT_THRESHOLD)
+    parser.add_argument("--only", help="Comma separated benchmark names")
+    parser.add_argument("--baselines", default=BASELINES_FILE)
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+
+    args = parse_args()
+    names = args.only.split(",") if args.only else list(BENCHMARKS)
+    unknown = [name for name in names if name not in BENCHMARKS]
+    if unknown:
+        sys.exit("Unknown benchmarks: %s" % ", ".join(unknown))
+
+    baselines = load_baselines(args.baselines)
+    threshold = args.threshold or baselines.get("threshold", DEFAULT_THRESHOLD)
+
+    results = {}
+    skipped = {}
+    failed = False
+    for name in names:
+        try:
+            func = BENCHMARKS[name]()
+        except Unavailable as e:
+            skipped[name] = str(e)
+            continue
+
+        seconds = measure(func)
+        baseline = baselines["benchmarks"].get(name)
+        ratio = seconds / baseline if baseline else None
+        regressed = ratio is not None and ratio > threshold
+        failed = failed or regressed or (baseline is None and not args.update)
+        results[name] = {"seconds": seconds, "baseline": baseline,
+                         "ratio": ratio, "regressed": regressed}
+
+    if args.json:
+        print(json.dumps({"threshold": threshold, "results": results, "skipped": skipped},
+                         indent=2))
+    else:
+        print(f"{'benchmark':<30}{'us/call':>12}{'baseline':>12}{'ratio':>8}")
+        for name, result in results.items():
+            baseline = f"{result['baseline'] * 1e6:.3f}" if result["baseline"] else "-"
+            ratio = f"{result['ratio']:.2f}" if result["ratio"] else "-"
+            flag = ("  SLOWER" if result["regressed"]
+                    else "  NO BASELINE" if result["baseline"] is None else "")
+            print(f"{name:<30}{result['seconds'] * 1e6:>12.3f}{baseline:>12}{ratio:>8}{flag}")
+        for name, reason in skipped.items():
+            print(f"{name:<30}{'skipped':>12}  {reason}")
+
+    if args.update:
+        baselines["threshold"] = threshold
+        baselines["machine"] = f"{platform.machine()} {platform.processor() or ''}".strip()
+        baselines["python"] = platform.python_version()
+        baselines["numpy"] = np.__version__
+        try:
+            import sklearn
+            baselines["scikit-learn"] = sklearn.__version__
+        except ImportError:
+            pass
+        baselines["benchmarks"].update({name: result["seconds"]
+                                        for name, result in results.items()})
+        with open(args.baselines, "w") as baselines_file:
+            json.dump(baselines, baselines_file, indent=2, sort_keys=True)
+            baselines_file.write("\n")
+        print("Baselines written to %s" % args.baselines)
+        sys.exit(0)
+
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,86 @@
+"""Runs an ingest service for the load test with local settings.
+
+Settings are overridden from the JSON object in QLOG_SETTINGS_OVERRIDES
+before any module reads them, e.g. to point the service at a local broker,
+PSQL and scratch directories. psql_func.write_rows is wrapped so every
+committed reading is logged to QLOG_COMMIT_LOG as
+
+    <commit unix time>,<warehouse_id>,<device_id>
+
+With QLOG_STUB_DB=1, an in-process stand-in replaces PSQL: writes are
+only logged and every device gets the default settings.
+
+Usage:
+    python benchmarks/run_service.py ec2_mqtt.py
+"""
+
+# Basic libraries
+import json
+import os
+import runpy
+import sys
+import threading
+import time
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+
+# Custom modules
+import settings
+
+for name, value in json.loads(os.environ.get("QLOG_SETTINGS_OVERRIDES", "{}")).items():
+    setattr(settings, name, value)
+
+import psql_func
+
+commit_log = open(os.environ["QLOG_COMMIT_LOG"], "a", buffering=1)
+commit_lock = threading.Lock()
+write_rows = psql_func.write_rows
+
+
+def stub_write_rows(rows, ids=None):
+    return len(rows)
+
+
+def stub_allocate_ids(count):
+    global next_id
+    with commit_lock:
+        ids = list(range(next_id, next_id + count))
+        next_id += count
+    return ids
+
+
+def stub_get_device_data(warehouse_id, device_id):
+    white_standard = {f"w{index}": value
+                      for index, value in enumerate(settings.DEFAULT_WHITE_STANDARD)}
+    return [("default", "default", white_standard, "default", "default", "Q-Log")]
+
+
+def logged_write_rows(rows, ids=None):
+    written = write_rows(rows, ids)
+    now = time.time()
+    with commit_lock:
+        for warehouse_id, device_id, _, _ in rows:
+            commit_log.write(f"{now},{warehouse_id},{device_id}\n")
+    return written
+
+
+if os.environ.get("QLOG_STUB_DB") == "1":
+    next_id = 1
+    write_rows = stub_write_rows
+    psql_func.allocate_ids = stub_allocate_ids
+    psql_func.get_device_data = stub_get_device_data
+    psql_func.get_all_device_data = lambda: {}
+    psql_func.get_active_fruit_variety_list = lambda: []
+    psql_func.write_rollups = lambda device_rows, warehouse_rows: None
+    psql_func.create_rollup_tables = lambda: None
+
+psql_func.write_rows = logged_write_rows
+
+
+if __name__ == "__main__":
+
+    service = os.path.join(BASE_DIR, sys.argv[1])
+    sys.argv = [service] + sys.argv[2:]
+    os.chdir(BASE_DIR)
+    runpy.run_path(service, run_name="__main__")
@@ -5,30 +5,21 @@ import numpy as np
 import settings
 
 
-def normalize_fruit_data(data, white_standard):
-    """Converts the device readings to float values.
-    The average values of the set of readings are normalized and returned
+def normalize_fruit_data(mean_values, white_standard):
+    """Normalizes the device readings with the device's white standard.
+    The average values of the window, kept by DeviceState, are normalized
 
     Args:
-        data (list): List of strings containing device readings
+        mean_values (array): Mean readings of the window
         white_standard (list): Normalization values for specific device
 
     Returns:
-        list: Both raw values and normalized values
+        array: Normalized wavelength values
     
     """
-    LENGTH = len(white_standard)    
-    """Converting sensor readings to float
-    Converts all readings except Warehouse ID and Device ID
-    '1, 2, 3, 4, 5, 6, 82.5, WC0001, D20' -> [1.0, 2.0, 3.0, 4.0, 5.0, 6.0, 82.5]
-    """
-    sensor_data = data[0].split(',')
-    sensor_data = np.array(list(map(float,sensor_data[:-2])))
-    # Calculate mean values
-    raw_mean_values = sensor_data
+    LENGTH = len(white_standard)
     # Normalizes only the wavelength values
-    normalized_values = (raw_mean_values[: LENGTH] / white_standard)
-    return raw_mean_values, normalized_values
+    return mean_values[: LENGTH] / white_standard
 
 
 def predict_status(values, model):
@@ -45,10 +36,7 @@ def predict_status(values, model):
     """
 
     values = np.array([values])
-    print(values)
-    print('It has something to do with pred')
     fruit_status = model.predict_proba(values[0:1])
-    print(fruit_status)
     return int(fruit_status[0][0]*100)
 
 
@@ -94,3 +82,65 @@ def calculate_brix_level(predicted_brix):
     elif predicted_brix >= 15 and predicted_brix < 18:
         return 'D'
     return 'E'
+
+
+# Lower bounds of the brix levels B, C, D and E
+BRIX_LEVEL_BINS = np.array([9, 12, 15, 18])
+BRIX_LEVELS = np.array(['A', 'B', 'C', 'D', 'E'])
+
+
+def normalize_fruit_data_batch(values, white_standard):
+    """Normalizes many readings with the same white standard at once
+
+    Args:
+        values (array): (N, readings) matrix, e.g. from psql_func.history_readings
+        white_standard (list): Normalization values for specific device
+
+    Returns:
+        array: (N, len(white_standard)) normalized wavelength values
+    """
+    values = np.asarray(values, dtype=float)
+    return values[:, :len(white_standard)] / np.asarray(white_standard, dtype=float)
+
+
+def predict_status_batch(values, model):
+    """Classifies the fruit status of many readings in one model call.
+
+    Args:
+        values (array): (N, features) matrix of sensor readings (wavelength)
+        model (linear model): Model to classify fruits
+
+    Returns:
+        array: N classification values, as returned by predict_status
+    """
+    fruit_status = model.predict_proba(np.asarray(values, dtype=float))
+    return (fruit_status[:, 0] * 100).astype(int)
+
+
+def predict_brix_batch(values, model):
+    """Predicts the brix values of many readings in one model call.
+
+    Args:
+        values (array): (N, features) matrix of sensor readings (wavelength)
+        model (regression model): Model to predict brix values
+
+    Returns:
+        array: N predicted brix values
+    """
+    values = np.asarray(values, dtype=float)
+    predicted_brix_values = np.asarray(model.predict(values))
+
+    # Some models return nested values, keep the first output per row
+    return predicted_brix_values.reshape(len(values), -1)[:, 0]
+
+
+def calculate_brix_levels(predicted_brix):
+    """Finds the range of many brix values at once
+
+    Args:
+        predicted_brix (array): The predicted brix values
+
+    Returns:
+        array: The range under which each brix value falls
+    """
+    return BRIX_LEVELS[np.digitize(predicted_brix, BRIX_LEVEL_BINS)]
@@ -0,0 +1,201 @@
+# PSQL Library
+import psycopg2
+
+# Basic libraries
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+# Custom modules
+import settings
+
+
+class PoolTimeout(Exception):
+    """Raised when no connection becomes available in time"""
+
+
+class PooledConnection:
+    """A PSQL connection together with the statements prepared on it
+
+    Args:
+        conn (psycopg2.connection): The underlying connection
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.prepared = set()
+        self.last_used = time.monotonic()
+
+    def cursor(self, *args, **kwargs):
+        return self.conn.cursor(*args, **kwargs)
+
+    def commit(self):
+        self.conn.commit()
+
+    def execute_prepared(self, cur, name, query, params=()):
+        """Executes a server side prepared statement, preparing it on first use
+
+        Args:
+            cur (psycopg2.cursor): Cursor of this connection
+            name (str): Name of the prepared statement
+            query (str): Statement using $1, $2, ... placeholders
+            params (tuple): Values for the placeholders
+        """
+        if name not in self.prepared:
+            cur.execute(f"PREPARE {name} AS {query}")
+            self.prepared.add(name)
+
+        if params:
+            placeholders = ",".join(["%s"] * len(params))
+            cur.execute(f"EXECUTE {name} ({placeholders})", params)
+        else:
+            cur.execute(f"EXECUTE {name}")
+
+
+class ConnectionPool:
+    """Bounded, thread-safe pool of PSQL connections.
+
+    Connections are opened on demand up to max_connections, reused in LIFO
+    order and checked with a cheap query when they have been idle longer
+    than the health check interval. Broken connections are discarded.
+
+    Args:
+        max_connections (int): Upper bound of open connections
+        health_check_interval (float): Idle seconds after which a connection is checked
+        borrow_timeout (float): Seconds to wait for a free connection
+        connect_kwargs: Arguments passed to psycopg2.connect
+    """
+
+    def __init__(self, max_connections=settings.PSQL_POOL_MAX_CONNECTIONS,
+                 health_check_interval=settings.PSQL_POOL_HEALTH_CHECK_INTERVAL,
+                 borrow_timeout=settings.PSQL_POOL_BORROW_TIMEOUT,
+                 **connect_kwargs):
+        self.max_connections = max_connections
+        self.health_check_interval = health_check_interval
+        self.borrow_timeout = borrow_timeout
+        self.connect_kwargs = connect_kwargs
+
+        self._idle = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_connections)
+        self._closed = False
+
+    @contextmanager
+    def borrow(self):
+        """Lends a connection to the calling thread
+
+        The transaction is rolled back if the block raises, and the
+        connection is discarded if it turned out to be broken.
+
+        Yields:
+            PooledConnection: Connection owned by the caller until the block exits
+        """
+        if not self._slots.acquire(timeout=self.borrow_timeout):
+            raise PoolTimeout("No PSQL connection available after %ss"
+                              % self.borrow_timeout)
+
+        pooled = None
+        try:
+            pooled = self._checkout()
+            yield pooled
+        except BaseException:
+            if pooled is not None:
+                self._rollback_or_discard(pooled)
+            raise
+        finally:
+            if pooled is not None:
+                self._checkin(pooled)
+            self._slots.release()
+
+    def run(self, func, *args, retries=1):
+        """Calls func(connection, *args) with a borrowed connection
+
+        Connection level failures are retried on a fresh connection.
+
+        Returns:
+            The return value of func
+        """
+        while True:
+            try:
+                with self.borrow() as pooled:
+                    return func(pooled, *args)
+            except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+                if retries <= 0:
+                    raise
+                retries -= 1
+                logging.error("PSQL connection failed, retrying - %s" % e)
+
+    def closeall(self):
+        """Closes every idle connection, borrowed ones are closed on return"""
+        with self._lock:
+            self._closed = True
+            idle, self._idle = self._idle, []
+
+        for pooled in idle:
+            self._close(pooled)
+
+    def _connect(self):
+        conn = psycopg2.connect(**self.connect_kwargs)
+        logging.info("Opened PSQL connection")
+        return PooledConnection(conn)
+
+    def _checkout(self):
+        while True:
+            with self._lock:
+                pooled = self._idle.pop() if self._idle else None
+
+            if pooled is None:
+                return self._connect()
+
+            if self._healthy(pooled):
+                return pooled
+
+            self._close(pooled)
+
+    def _checkin(self, pooled):
+        if pooled.conn.closed:
+            return
+
+        pooled.last_used = time.monotonic()
+        with self._lock:
+            if not self._closed:
+                self._idle.append(pooled)
+                return
+
+        self._close(pooled)
+
+    def _healthy(self, pooled):
+        if pooled.conn.closed:
+            return False
+
+        if time.monotonic() - pooled.last_used < self.health_check_interval:
+            return True
+
+        try:
+            cur = pooled.conn.cursor()
+            cur.execute("SELECT 1")
+            cur.close()
+            pooled.conn.rollback()
+            return True
+        except Exception as e:
+            logging.error("Discarding broken PSQL connection - %s" % e)
+            return False
+
+    def _rollback_or_discard(self, pooled):
+        try:
+            pooled.conn.rollback()
+            # Forget statements prepared in the failed transaction
+            cur = pooled.conn.cursor()
+            cur.execute("DEALLOCATE ALL")
+            cur.close()
+            pooled.conn.commit()
+            pooled.prepared.clear()
+        except Exception:
+            self._close(pooled)
+
+    def _close(self, pooled):
+        try:
+            pooled.conn.close()
+        except Exception:
+            pass
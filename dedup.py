@@ -0,0 +1,83 @@
+# Basic libraries
+import hashlib
+import time
+from collections import OrderedDict
+
+# Custom modules
+import metrics
+import settings
+
+DUPLICATES = metrics.Counter("qlog_duplicate_messages_total",
+                             "Messages dropped as repeats of a recent payload")
+DEDUP_ENTRIES = metrics.Gauge("qlog_dedup_entries", "Payload digests remembered for deduplication")
+
+
+class DuplicateFilter:
+    """Drops repeats of payloads already received.
+
+    After a reconnect the broker redelivers the QoS 1 messages it had no
+    acknowledgement for, with the MQTT DUP flag set. Devices that retry a
+    publish send the same payload again, which the broker forwards without
+    the flag. Payloads carry the warehouse and device ID, so a digest of
+    the payload only matches repeats from the same device.
+
+    A redelivered payload seen within the horizon is always dropped. With
+    drop_repeats, a repeat without the flag is dropped too. Text payloads
+    carry no sequence number, so this also drops a device reporting
+    identical values twice within the horizon; without drop_repeats those
+    are kept and only broker redeliveries are dropped.
+
+    The digests are kept in arrival order, which makes expiring them and
+    evicting the oldest once max_entries is reached O(1).
+
+    Not thread-safe, call it from the thread that receives the messages.
+
+    Args:
+        horizon (float): Seconds a payload is remembered
+        max_entries (int): Digests kept at most, bounds the memory used
+        drop_repeats (bool): Also drop repeats without the DUP flag
+    """
+
+    def __init__(self, horizon=settings.DEDUP_HORIZON, max_entries=settings.DEDUP_MAX_ENTRIES,
+                 drop_repeats=settings.DEDUP_DROP_REPEATS):
+        self.horizon = horizon
+        self.max_entries = max_entries
+        self.drop_repeats = drop_repeats
+
+        # digest -> monotonic time it was first seen
+        self._seen = OrderedDict()
+        DEDUP_ENTRIES.set_function(lambda: len(self._seen))
+
+    def is_duplicate(self, payload, redelivered):
+        """Remembers the payload and tells if it repeats one seen within the horizon
+
+        Args:
+            payload (bytes): Raw message payload
+            redelivered (bool): DUP flag of the message
+
+        Returns:
+            bool: True if the message should be dropped
+        """
+        now = time.monotonic()
+        seen = self._seen
+
+        # Forget payloads older than the horizon
+        expired = now - self.horizon
+        while seen:
+            first = next(iter(seen.values()))
+            if first > expired:
+                break
+            seen.popitem(last=False)
+
+        digest = hashlib.blake2b(payload, digest_size=8).digest()
+        if digest in seen:
+            if redelivered or self.drop_repeats:
+                DUPLICATES.inc()
+                return True
+            # A genuine repeat, remembered from now on
+            del seen[digest]
+
+        seen[digest] = now
+        if len(seen) > self.max_entries:
+            seen.popitem(last=False)
+        return False
@@ -0,0 +1,137 @@
+# Basic libraries
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+# Custom modules
+import settings
+
+
+class DeviceSettingsCache:
+    """In-process cache of device settings with TTL and LRU eviction.
+
+    Entries are keyed by Device ID, which is what the settings query
+    matches on. They expire ttl seconds after they were loaded and the
+    least recently used entry is evicted once max_size devices are cached.
+    Unknown devices are cached as well, so they do not hit PSQL on every
+    window either.
+
+    Args:
+        loader (callable): loader(warehouse_id, device_id) returns the settings of one device
+        bulk_loader (callable): Returns {device_id: settings} for every device
+        ttl (float): Seconds an entry stays valid
+        max_size (int): Maximum number of cached devices
+    """
+
+    def __init__(self, loader, bulk_loader=None,
+                 ttl=settings.DEVICE_CACHE_TTL,
+                 max_size=settings.DEVICE_CACHE_MAX_SIZE):
+        self.loader = loader
+        self.bulk_loader = bulk_loader
+        self.ttl = ttl
+        self.max_size = max_size
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        # Bumped by invalidate() so loads started before it are not stored
+        self._generation = 0
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, warehouse_id, device_id):
+        """Returns the settings of a device, loading them on a miss
+
+        Args:
+            warehouse_id (str): Warehouse ID of the device
+            device_id (str): Device ID of the device
+        """
+        now = time.monotonic()
+
+        with self._lock:
+            entry = self._entries.get(device_id)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(device_id)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            generation = self._generation
+
+        value = self.loader(warehouse_id, device_id)
+        self._store(device_id, value, now, generation)
+        return value
+
+    def peek(self, device_id):
+        """Returns the cached settings of a device without loading, None on a miss
+
+        Used by callers that load the settings themselves, e.g. with asyncpg.
+        """
+        now = time.monotonic()
+
+        with self._lock:
+            entry = self._entries.get(device_id)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(device_id)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            return None
+
+    def put(self, device_id, value):
+        """Caches settings loaded by the caller"""
+        with self._lock:
+            generation = self._generation
+        self._store(device_id, value, time.monotonic(), generation)
+
+    def warm_up(self):
+        """Loads the settings of every device in one query
+
+        Returns:
+            int: Number of devices loaded
+        """
+        if self.bulk_loader is None:
+            return 0
+
+        with self._lock:
+            generation = self._generation
+
+        try:
+            values = self.bulk_loader()
+        except Exception as e:
+            logging.error("Device settings warm up failed - %s" % e)
+            return 0
+
+        now = time.monotonic()
+        for device_id, value in values.items():
+            self._store(device_id, value, now, generation)
+
+        logging.info("Device settings cache warmed up with %s devices" % len(values))
+        return len(values)
+
+    def invalidate(self, device_id=None):
+        """Drops one device, or every device if device_id is None"""
+        with self._lock:
+            self._generation += 1
+            if device_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(device_id, None)
+
+        logging.info("Invalidated device settings for %s"
+                     % (device_id if device_id is not None else "all devices"))
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def _store(self, device_id, value, now, generation):
+        with self._lock:
+            if generation != self._generation:
+                return
+            self._entries[device_id] = (now + self.ttl, value)
+            self._entries.move_to_end(device_id)
+
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
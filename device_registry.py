@@ -0,0 +1,144 @@
+# Basic libraries
+import logging
+import sys
+import threading
+
+# Scientific Libraries
+import numpy as np
+
+# Custom modules
+import settings
+
+
+class DeviceState:
+    """Window state of a single device.
+
+    Readings are not kept. The running mean and variance are updated as
+    each reading arrives (Welford), so memory and the cost of closing a
+    window are O(features). NaN readings are skipped per feature. The
+    accumulators are reused by every window of the device.
+
+    Uses __slots__ so tens of thousands of devices stay small in memory.
+    Warehouse IDs are interned, so devices of one warehouse share the string.
+
+    Args:
+        warehouse_id (str): Warehouse ID of the device
+        device_id (str): Device ID of the device
+        message_limit (int): Messages that complete a window
+    """
+
+    __slots__ = ("warehouse_id", "device_id", "message_limit", "message_count",
+                 "mean", "m2", "counts", "end_time")
+
+    def __init__(self, warehouse_id, device_id, message_limit=settings.MESSAGE_LIMIT):
+        self.warehouse_id = sys.intern(warehouse_id)
+        self.device_id = device_id
+        self.message_limit = message_limit
+        self.message_count = 0
+        self.end_time = -1
+
+        # Allocated with the first reading, once the number of values is known
+        self.mean = None
+        self.m2 = None
+        self.counts = None
+
+    @property
+    def name(self):
+        """Combination of warehouseID and deviceID"""
+        return f"{self.warehouse_id}/{self.device_id}"
+
+    @property
+    def pub_topic(self):
+        """Topic the feedback of the device is published to"""
+        return f"/{self.warehouse_id}/{self.device_id}"
+
+    def add(self, values):
+        """Adds a reading to the window
+
+        Args:
+            values (array): Float readings parsed by payload_parser
+        """
+        if self.mean is None or len(values) != len(self.mean):
+            if self.message_count:
+                logging.error("Reading of %s has %s values instead of %s, restarting window"
+                              % (self.name, len(values), len(self.mean)))
+            self._allocate(len(values))
+
+        self.message_count += 1
+
+        valid = ~np.isnan(values)
+        self.counts += valid
+        delta = np.where(valid, values - self.mean, 0.0)
+        self.mean += delta / np.maximum(self.counts, 1)
+        self.m2 += delta * np.where(valid, values - self.mean, 0.0)
+
+    def window_mean(self):
+        """Mean of every value over the window, NaN where all readings were NaN
+
+        Returns:
+            array: A copy, safe to use after reset()
+        """
+        return np.where(self.counts > 0, self.mean, np.nan)
+
+    def window_variance(self):
+        """Sample variance of every value over the window, NaN below two readings"""
+        return np.where(self.counts > 1, self.m2 / np.maximum(self.counts - 1, 1), np.nan)
+
+    def reset(self):
+        """Starts a new, empty window"""
+        self.message_count = 0
+        self.end_time = -1
+        if self.mean is not None:
+            self.mean.fill(0.0)
+            self.m2.fill(0.0)
+            self.counts.fill(0)
+
+    def _allocate(self, size):
+        self.message_count = 0
+        self.mean = np.zeros(size, dtype=np.float64)
+        self.m2 = np.zeros(size, dtype=np.float64)
+        self.counts = np.zeros(size, dtype=np.int64)
+
+    def __repr__(self):
+        return f"DeviceState({self.name}, count={self.message_count})"
+
+
+class DeviceRegistry:
+    """Indexes device state by (warehouse_id, device_id).
+
+    Args:
+        message_limit (int): Messages that complete a window
+    """
+
+    def __init__(self, message_limit=settings.MESSAGE_LIMIT):
+        self.message_limit = message_limit
+        self._devices = {}
+        self._lock = threading.Lock()
+
+    def get(self, warehouse_id, device_id):
+        """Returns the state of a device or None if it is unknown"""
+        return self._devices.get((warehouse_id, device_id))
+
+    def get_or_create(self, warehouse_id, device_id):
+        """Returns the state of a device, registering it on its first message"""
+        device = self._devices.get((warehouse_id, device_id))
+        if device is not None:
+            return device
+
+        with self._lock:
+            device = self._devices.get((warehouse_id, device_id))
+            if device is None:
+                device = DeviceState(warehouse_id, device_id, self.message_limit)
+                self._devices[(device.warehouse_id, device_id)] = device
+                logging.info("Registered device %s" % device.name)
+            return device
+
+    def __contains__(self, key):
+        return key in self._devices
+
+    def __len__(self):
+        return len(self._devices)
+
+    def __iter__(self):
+        # Iterates over a snapshot so devices can register meanwhile
+        return iter(list(self._devices.values()))
@@ -1,15 +1,17 @@
 # Basic libraries
+import functools
 import logging
+import signal
+import sys
 import threading
 import time
-import pickle
 from warnings import filterwarnings
 
 # MQTT Library
 import paho.mqtt.client as mqttClient
 
 # Custom modules
-import calculations, psql_func, settings
+import calculations, dedup, device_cache, device_registry, inference_batcher, metrics, model_registry, payload_parser, pipeline, profiler, psql_func, rollups, scheduler, settings, shard_router, spool
 filterwarnings("ignore")
 
 # Logging
@@ -22,6 +24,7 @@ logging.basicConfig(
 
 # Topics
 SUB_TOPIC = settings.SUB_TOPIC
+CONTROL_TOPIC = settings.CONTROL_TOPIC
 
 # MQTT Credentials
 USER = settings.MQTT_USER
@@ -35,58 +38,90 @@ MQTT_PORT = settings.MQTT_PORT
 Connected = False
 TIMEOUT = settings.TIMEOUT
 
-device_dictionary = {}
-device_list = []
+# Window state of every device, indexed by (warehouse_id, device_id)
+devices = device_registry.DeviceRegistry()
 
+# Spools readings to disk and drains them to PSQL in batches off the MQTT thread
+writer = spool.SpooledWriter(psql_func.write_rows, psql_func.allocate_ids,
+                             spool.Spool(f"{settings.SPOOL_DIR}ec2/"))
 
-def create_dictionary(warehouse_id, device_id):
-    """Creates a dictionary for every device.
-    Keeps track of message count.
-    Keeps track of time out
+# Per-minute and per-hour rollups of the readings, upserted in batches
+rollup = rollups.RollupAggregator(psql_func.write_rollups, psql_func.create_rollup_tables)
 
-    Args:
-        warehouse_id (str): Warehouse ID of the device
-        device_id (str): Device ID of the device
+# Repeated payloads, dropped on the network thread
+duplicates = dedup.DuplicateFilter()
 
-    Returns:
-        dict: Dictionary containing device information
-    """
+# Fires window time outs
+timeouts = scheduler.DeadlineScheduler()
+
+# Metrics, served on http://METRICS_HOST:EC2_METRICS_PORT/metrics
+MESSAGES_RECEIVED = metrics.Counter("qlog_messages_received_total", "Device messages received")
+PARSE_ERRORS = metrics.Counter("qlog_parse_errors_total", "Messages dropped as unparsable")
+PARSE_SECONDS = metrics.Histogram("qlog_parse_seconds", "Time to parse a payload")
+WINDOWS_COMPLETED = metrics.Counter("qlog_windows_completed_total", "Windows that reached the message limit")
+WINDOWS_TIMED_OUT = metrics.Counter("qlog_windows_timed_out_total", "Windows dropped by their time out")
+MQTT_CONNECTS = metrics.Counter("qlog_mqtt_connects_total", "Connections to the broker, including reconnects")
+MQTT_DISCONNECTS = metrics.Counter("qlog_mqtt_unexpected_disconnects_total", "Connections lost unexpectedly")
+PUBLISH_FAILURES = metrics.Counter("qlog_publish_failures_total", "Feedback publishes that failed")
+ACTIVE_DEVICES = metrics.Gauge("qlog_active_devices", "Devices with a window in progress",
+                               lambda: sum(1 for device in devices if device.message_count))
+KNOWN_DEVICES = metrics.Gauge("qlog_known_devices", "Devices seen since start", lambda: len(devices))
+SPOOL_PENDING = metrics.Gauge("qlog_spool_pending_readings", "Readings waiting to be written to PSQL",
+                              writer.pending)
+
+# Scores completed windows in micro-batches
+batcher = inference_batcher.InferenceBatcher()
+
+# Models are loaded on first use, varieties without a model share the default
+brix_models = model_registry.ModelRegistry('BRIX', settings.DEFAULT_BRIX_MODEL)
+clf_models = model_registry.ModelRegistry('CLF', settings.DEFAULT_CLF_MODEL)
 
-    logging.info(f"Creating dictionary for %s/%s" % (warehouse_id, device_id))
-    return {
-        "warehouse_id": warehouse_id,
-        "device_id": device_id,
-        "message_count": 0,
-        "message_limit": settings.MESSAGE_LIMIT,
-        "message_arr": [],
-        "end_time": -1,
-        "pub_topic": f"/{warehouse_id}/{device_id}",
-    }
+# Windows completed before the device settings were loaded at start up,
+# scored once they are or WARM_UP_WAIT has passed
+deferred_windows = []
+deferred_lock = threading.Lock()
+windows_released = threading.Event()
 
+# Device settings, so steady state windows do not query PSQL
+device_settings = device_cache.DeviceSettingsCache(psql_func.get_device_data,
+                                                   psql_func.get_all_device_data)
 
-def reset_variables(device_name):
+
+def reset_variables(device):
     """Resets variables for a specific device
 
     Args:
-        device_name (str): Combination of warehouseID and deviceID
+        device (DeviceState): State of the device
     """
 
-    global device_dictionary
-
     lock.acquire()
 
     try:
-        device_dictionary[device_name]["message_count"] = 0
-        device_dictionary[device_name]["message_arr"] = []
-        device_dictionary[device_name]["end_time"] = -1
-        logging.info('Reset value for %s' % device_name)
+        timeouts.cancel(device)
+        device.reset()
+        logging.info('Reset value for %s' % device.name)
     except Exception as e:
-        logging.error('Reset for %s failed - %s' % (device_name, e))
+        logging.error('Reset for %s failed - %s' % (device.name, e))
     finally:
         # Always called even if exception is raised
         lock.release()
 
 
+def on_timeout(device):
+    """Resets a device whose window did not fill up before its time out
+
+    Args:
+        device (DeviceState): State of the device
+    """
+    end_time = device.end_time
+
+    # The window may have completed while the time out was firing
+    if end_time != -1 and time.monotonic() >= end_time:
+        logging.error(f"Timeout exceeded for {device.name}")
+        WINDOWS_TIMED_OUT.inc()
+        reset_variables(device)
+
+
 """
 CALLBACKS
 """
@@ -96,120 +131,192 @@ def on_connect(client, userdata, flags, rc):
 
     if rc == 0:
         logging.info("Connected to broker")
+        MQTT_CONNECTS.inc()
         global Connected
         Connected = True
 
+        # Subscribe on every connect, the broker keeps the session and
+        # queues QoS 1 messages for it while the service is down
+        client.subscribe([(SUB_TOPIC, settings.MQTT_SUBSCRIBE_QOS),
+                          (CONTROL_TOPIC, settings.MQTT_SUBSCRIBE_QOS)])
+        metrics.readiness.set_ready("mqtt")
+
     else:
         logging.error("Connection failed from ec2 %s",str(rc))
 
 
 def on_disconnect(client, userdata, rc):
+    metrics.readiness.set_ready("mqtt", False)
     if rc == 0:
         global Connected
         Connected = False
         logging.info("Disconnected")
     else:
+        MQTT_DISCONNECTS.inc()
         logging.error("Still running in the ec2")
 
 
 def on_message(client, userdata, message):
-    global device_list, device_dictionary
+    """Parses the message and queues it for a pipeline worker, keeping the network thread free"""
+    if message.topic == CONTROL_TOPIC:
+        handle_control(message.payload)
+        return
 
-    # Read the message from the device
-    msg = str(message.payload.decode("utf-8"))
+    MESSAGES_RECEIVED.inc()
 
-    # Extract device id and warehouse id
-    warehouse_id = msg.split(",")[-2].strip()
-    device_id = msg.split(",")[-1].strip()
+    # Drop redeliveries and retransmits of recent payloads before they reach a window
+    if duplicates.is_duplicate(message.payload, message.dup):
+        return
 
-    # Create device name
-    device_name = f"{warehouse_id}/{device_id}"
+    # Parse the IDs and readings once, straight from the payload bytes
+    try:
+        with PARSE_SECONDS.time(), profiler.stage("parse"):
+            warehouse_id, device_id, readings = payload_parser.parse_payload(message.payload)
+    except payload_parser.PayloadError as e:
+        PARSE_ERRORS.inc()
+        logging.error("Dropping unparsable message - %s" % e)
+        return
 
-    # Create device dictionary
-    if device_name not in device_list:
-        device_dictionary[device_name] = create_dictionary(
-            warehouse_id, device_id
-        )
-        device_list.append(device_name)
+    ingest.submit(f"{warehouse_id}/{device_id}", client, warehouse_id, device_id, readings)
 
-    # Add message to device dictionary's message array
-    device_dictionary[device_name]["message_arr"].append(msg)
 
-    # Increment message count by 1
-    device_dictionary[device_name]["message_count"] += 1
+def handle_control(payload):
+    """Runs a command published on the control topic
 
-    # If device dictionary's message count is equal to the messsage limit
-    if (device_dictionary[device_name]["message_count"]
-            == device_dictionary[device_name]["message_limit"]
-       ):
+    'invalidate_settings'             -> Drops every cached device setting
+    'invalidate_settings,<device_id>' -> Drops the settings of one device
+    'profile[,seconds[,mode]]'        -> Profiles the process, see profiler.py
 
-        # Assign the device dictionary parameters to variables
-        message_arr = device_dictionary[device_name]["message_arr"]
-        pub_topic = device_dictionary[device_name]["pub_topic"]
+    Args:
+        payload (bytes): The command
+    """
+    try:
+        command, _, argument = payload.decode("utf-8").strip().partition(",")
+    except UnicodeDecodeError as e:
+        logging.error("Dropping undecodable control command - %s" % e)
+        return
+
+    if command == "invalidate_settings":
+        device_settings.invalidate(argument.strip() or None)
+    elif command == "profile":
+        profiler.handle_command(argument)
+    else:
+        logging.error("Unknown control command %s" % command)
 
-        # Get device settings from PSQL Table
-        try:
-            fruit, variety, white_standard, batch_number, vendor_code = psql_func.get_device_data(warehouse_id, device_id)[0]
-            white_standard = [float(x) for x in white_standard.values()]
 
-            brix_model = BRIX_MODEL_DICT[fruit][variety]
-            clf_model = CLF_MODEL_DICT[fruit][variety]
+def process_message(client, warehouse_id, device_id, readings):
+    """Adds a reading to its device's window and handles completed windows
 
-        except Exception as e:
-            logging.critical("Failed to load device data - %s" % e)
+    Args:
+        client (mqttClient): Client used to publish the feedback
+        warehouse_id (str): Warehouse ID of the device
+        device_id (str): Device ID of the device
+        readings (array): Readings parsed from the message
+    """
+    # Look up the device, registering it on its first message
+    device = devices.get_or_create(warehouse_id, device_id)
 
-            fruit, variety = 'default', 'default'
-            batch_number, vendor_code = 'default', 'default'
-            white_standard = settings.DEFAULT_WHITE_STANDARD
+    # Add the reading to the device's window, updating its running mean
+    device.add(readings)
 
-            brix_model = BRIX_MODEL_DICT['default']
-            clf_model = CLF_MODEL_DICT['default']
+    # Start the time out with the first message of the window
+    if device.end_time == -1:
+        device.end_time = time.monotonic() + TIMEOUT
+        timeouts.schedule(device, device.end_time)
+        logging.info(f"Timeout initiated for {device.name}")
 
-        # Normalize the message array with respective white standard
-        raw_mean_values, normalized_values = calculations.normalize_fruit_data(
-            message_arr, white_standard
-        )
+    # If the device's message count is equal to the messsage limit
+    if device.message_count == devices.message_limit:
+        WINDOWS_COMPLETED.inc()
 
-        # Predict brix
-        try:
-            predicted_brix = calculations.predict_brix(normalized_values, brix_model)
-        except Exception as e:
-            logging.error("Brix prediction failed - %s")
-            predicted_brix = -1
+        # Assign the device parameters to variables
+        window = (client, warehouse_id, device_id, device.pub_topic, device.window_mean())
 
-        # Assign a category to the brix value
-        brix_level = calculations.calculate_brix_level(predicted_brix)
+        # Resets variables for device
+        reset_variables(device)
 
-        # Classify status
-        try:
-            fruit_status = calculations.predict_status(normalized_values, clf_model)
-        except Exception as e:
-            logging.error("Status classification failed - %s")
-            fruit_status = -1
+        # Windows completing during start up wait for the device settings,
+        # without holding up the worker
+        if not windows_released.is_set():
+            with deferred_lock:
+                if not windows_released.is_set():
+                    deferred_windows.append(window)
+                    return
 
-        # Send feedback
-        message_to_client = f"{str(fruit_status)}{brix_level},{round(float(predicted_brix), 2)};"
-        print(message_to_client)
-        client.publish(pub_topic, message_to_client)
+        score_window(*window)
 
-        # Update to DB
-        try:
-            psql_func.write_data(warehouse_id,
-                                 device_id,
-                                 raw_mean_values,
-                                 predicted_brix,
-                                 fruit_status,
-                                 fruit,
-                                 variety,
-                                 batch_number,
-                                 vendor_code)
 
-        except Exception as e:
-            logging.error("Failed to store data in PSQL: %s" % e)
+def score_window(client, warehouse_id, device_id, pub_topic, raw_mean_values):
+    """Looks up the device settings and models and queues a completed window for scoring
+
+    Args:
+        client (mqttClient): Client used to publish the feedback
+        warehouse_id (str): Warehouse ID of the device
+        device_id (str): Device ID of the device
+        pub_topic (str): Feedback topic of the device
+        raw_mean_values (array): Readings of the window
+    """
+    # Get device settings from PSQL Table
+    try:
+        with profiler.stage("settings"):
+            fruit, variety, white_standard, batch_number, vendor_code, device_type = device_settings.get(warehouse_id, device_id)[0]
+        white_standard = [float(x) for x in white_standard.values()]
 
+        brix_model = brix_models.get(fruit, variety)
+        clf_model = clf_models.get(fruit, variety)
 
-        # Resets variables for device
-        reset_variables(device_name)
+    except Exception as e:
+        logging.critical("Failed to load device data - %s" % e)
+
+        fruit, variety = 'default', 'default'
+        batch_number, vendor_code = 'default', 'default'
+        white_standard = settings.DEFAULT_WHITE_STANDARD
+
+        brix_model = brix_models.default
+        clf_model = clf_models.default
+
+    # Normalize the window's mean readings with respective white standard
+    normalized_values = calculations.normalize_fruit_data(
+        raw_mean_values, white_standard
+    )
+
+    # Predict brix and classify status together with other windows
+    feedback = functools.partial(send_feedback, client, pub_topic,
+                                 warehouse_id, device_id, raw_mean_values)
+    batcher.submit(brix_model, clf_model, normalized_values, feedback)
+
+
+def send_feedback(client, pub_topic, warehouse_id, device_id, raw_mean_values,
+                  predicted_brix, brix_level, fruit_status):
+    """Publishes the scored window to the device and queues it for PSQL
+
+    Args:
+        client (mqttClient): Client used to publish the feedback
+        pub_topic (str): Feedback topic of the device
+        warehouse_id (str): Warehouse ID of the device
+        device_id (str): Device ID of the device
+        raw_mean_values (array): Readings of the window
+        predicted_brix (float): The predicted brix value
+        brix_level (str): The range under which the brix value falls
+        fruit_status (int): The classification value of the fruit
+    """
+    # Send feedback
+    message_to_client = f"{str(fruit_status)}{brix_level},{round(float(predicted_brix), 2)};"
+    with profiler.stage("publish"):
+        info = client.publish(pub_topic, message_to_client)
+    if info.rc != mqttClient.MQTT_ERR_SUCCESS:
+        PUBLISH_FAILURES.inc()
+        logging.error("Feedback to %s failed - %s" % (pub_topic, mqttClient.error_string(info.rc)))
+
+    # Update to DB
+    writer.add(warehouse_id, device_id, raw_mean_values)
+    rollup.add(warehouse_id, device_id, raw_mean_values)
+
+
+# Processes messages off the paho network thread
+ingest = pipeline.IngestPipeline(profiler.wrap(process_message))
+QUEUE_DEPTH = metrics.Gauge("qlog_queue_depth", "Messages waiting for a pipeline worker",
+                            ingest.depth)
 
 
 """
@@ -217,9 +324,9 @@ CLIENT FUNCTIONS
 """
 
 
-def create_client():
-    # Create client instance
-    client = mqttClient.Client()
+def create_client(client_id):
+    # Create client instance, with a persistent session
+    client = mqttClient.Client(client_id=client_id, clean_session=False)
     client.username_pw_set(USER, password=PASSWORD)
 
     # Callbacks
@@ -235,6 +342,62 @@ def client_disconnect(client):
     client.disconnect()
 
 
+def warm_up():
+    """Loads every device's settings and the models of the varieties in use
+
+    PSQL is retried until it answers, the models load in parallel.
+    """
+    delay = settings.WARM_UP_RETRY_DELAY
+    while True:
+        try:
+            fruit_varieties = psql_func.get_active_fruit_variety_list()
+            break
+        except Exception as e:
+            logging.error("Failed to list fruit varieties in use, retrying in %ss - %s"
+                          % (delay, e))
+            time.sleep(delay)
+            delay = min(delay * 2, settings.WARM_UP_MAX_RETRY_DELAY)
+    metrics.readiness.set_ready("psql")
+
+    loaders = [brix_models.preload(fruit_varieties), clf_models.preload(fruit_varieties)]
+    device_settings.warm_up()
+    release_windows()
+
+    failed = False
+    for loader in loaders:
+        try:
+            loader.result()
+        except Exception:
+            # Logged by the loader, windows are scored with whatever model loads on use
+            failed = True
+    if not failed:
+        metrics.readiness.set_ready("models")
+
+
+def release_windows():
+    """Stops deferring completed windows and scores the deferred ones"""
+    with deferred_lock:
+        if windows_released.is_set():
+            return
+        windows_released.set()
+        windows = list(deferred_windows)
+        deferred_windows.clear()
+
+    if windows:
+        logging.info("Scoring %s windows completed during start up" % len(windows))
+    for window in windows:
+        try:
+            score_window(*window)
+        except Exception as e:
+            logging.error("Scoring a window completed during start up failed - %s" % e)
+
+
+def shutdown(signum, frame):
+    """Turns SIGTERM from systemd into a normal exit so buffered rows are written"""
+    logging.info("Received signal %s, shutting down" % signum)
+    sys.exit(0)
+
+
 """
 MAIN LOOP
 """
@@ -244,95 +407,62 @@ if __name__ == "__main__":
     # Threading lock (to prevent to write statements occuring at the same time)
     lock = threading.Lock()
 
-    # Create client
-    client = create_client()
-
-    # Connect
-    client.connect(BROKER_ADDRESS, port=MQTT_PORT)
-    logging.info(f"Connected via Script ({USER})")
-
-    # Subscribe to MQTT Topic
-    client.subscribe(SUB_TOPIC)
-
-    # Load pickle models for brix
-    try:
-
-        BRIX_MODEL_DICT = {'default': settings.DEFAULT_BRIX_MODEL}
-        CLF_MODEL_DICT = {'default': settings.DEFAULT_CLF_MODEL}
-
-        # List of tuples -> [(fruit, variety), (fruit, variety)]
-        FRUIT_VARIETY_LIST = psql_func.get_fruit_variety_list()
-
-        DEFAULT_BRIX_MODEL = settings.DEFAULT_BRIX_MODEL
-        DEFAULT_CLF_MODEL = settings.DEFAULT_CLF_MODEL
-
-        for fruit, variety in FRUIT_VARIETY_LIST:
-
-            # Create dictionary for fruit if it doesn't exist
-            if fruit not in BRIX_MODEL_DICT:
-                BRIX_MODEL_DICT[fruit] = {}
-
-            BRIX_MODEL_DICT[fruit][variety] = None
-
-            # Create dictionary for fruit if it doesn't exist
-            if fruit not in CLF_MODEL_DICT:
-                CLF_MODEL_DICT[fruit] = {}
-
-            CLF_MODEL_DICT[fruit][variety] = None
-
-            # Assign models to variables
-            brix_file = f"{settings.MODEL_DIR}BRIX_{fruit}_{variety}.sav"
-            clf_file = f"{settings.MODEL_DIR}CLF_{fruit}_{variety}.sav"
-
-            # Load models and store in respective dictionary
-            try:
-                BRIX_MODEL_DICT[fruit][variety] = pickle.load(open(brix_file, 'rb'))
-            # Else, load default model and store it in respective dictionary
-            except:
-                BRIX_MODEL_DICT[fruit][variety] = pickle.load(open(DEFAULT_BRIX_MODEL, 'rb'))
-                logging.info("Using default brix model for %s-%s" %(fruit, variety))
-
-            # Load models and store in respective dictionary
-            try:
-                CLF_MODEL_DICT[fruit][variety] = pickle.load(open(clf_file, 'rb'))
-            # Else, load default model and store it in respective dictionary
-            except:
-                CLF_MODEL_DICT[fruit][variety] = pickle.load(open(DEFAULT_CLF_MODEL, 'rb'))
-                logging.info("Using default clf model for %s-%s" %(fruit, variety))
-
-        logging.info("Models loaded")
-
-    except Exception as e:
-        logging.error("Failed to load models - %s" % e)
-
-
-    # Start listening
+    # Subscribe to MQTT Topic, or to one shard's topic when run by supervisor.py
+    client_id = settings.EC2_CLIENT_ID
+    if len(sys.argv) == 3 and sys.argv[1] == "--shard":
+        shard = int(sys.argv[2])
+        SUB_TOPIC = shard_router.shard_topic(shard)
+        writer.spool.directory = f"{settings.SPOOL_DIR}ec2-shard-{shard}/"
+        metrics_port = settings.SHARD_METRICS_PORT + shard
+        client_id = f"{client_id}-shard-{shard}"
+    else:
+        metrics_port = settings.EC2_METRICS_PORT
+
+    # Expose the metrics and readiness endpoints first, so start up can be watched
+    metrics.readiness.require("mqtt", "psql", "models")
+    metrics.serve(metrics_port)
+
+    # Start writing readings and processing messages in the background
+    writer.start()
+    rollup.start()
+    batcher.start()
+    ingest.start()
+    signal.signal(signal.SIGTERM, shutdown)
+    profiler.install_signal_handler()
+
+    # Load device settings and hot models without delaying the subscription,
+    # windows completed meanwhile are scored after WARM_UP_WAIT at the latest
+    threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
+    release_timer = threading.Timer(settings.WARM_UP_WAIT, release_windows)
+    release_timer.daemon = True
+    release_timer.start()
+
+    # Connect and start listening, on_connect subscribes and paho retries
+    # until the broker is reachable
+    client = create_client(client_id)
+    client.connect_async(BROKER_ADDRESS, port=MQTT_PORT)
     client.loop_start()
+    logging.info(f"Connecting via Script ({USER}) as {client_id}")
 
-    # Time out functionality
-    while True:
-
-        for device_name in device_list:
-
-            end_time = device_dictionary[device_name]["end_time"]
-            message_count = device_dictionary[device_name]["message_count"]
-            message_limit = device_dictionary[device_name]["message_limit"]
-
-            # If device has sent one or more messages
-            if message_count >= 1:
-
-                # If timeout has not been set (when message_count == 1)
-                if end_time == -1:
-                    # Sets end_time to current time + TIMEOUT
-                    device_dictionary[device_name]["end_time"] = time.time() + TIMEOUT
-                    logging.info(f"Timeout initiated for {device_name}")
+    # Time out functionality, sleeps until the next window expires
+    try:
+        timeouts.run(on_timeout)
 
-                # If timeout has been set
-                if end_time != -1:
-                    # If time is past the end_time, resets the variables
-                    if time.time() > end_time:
-                        logging.error(f"Timeout exceeded for {device_name}")
-                        reset_variables(device_name)
+    except KeyboardInterrupt:
+        logging.info("Interrupted, shutting down")
 
-    client.loop_stop()
-    client.disconnect()
+    finally:
+        timeouts.stop()
+        client.loop_stop()
+        client.disconnect()
+
+        # Finish the queued messages, including windows still deferred
+        ingest.stop(settings.PIPELINE_STOP_TIMEOUT)
+        release_timer.cancel()
+        release_windows()
+        batcher.close(settings.PIPELINE_STOP_TIMEOUT)
+
+        # Write everything still buffered before exiting
+        writer.close(settings.BULK_WRITE_CLOSE_TIMEOUT)
+        rollup.close(settings.BULK_WRITE_CLOSE_TIMEOUT)
+        psql_func.pool.closeall()
@@ -0,0 +1,357 @@
+"""Exports QLog_data to Parquet files partitioned by warehouse and date.
+
+Rows are streamed in id order through a server-side cursor, one chunk at
+a time, and appended to one open file per partition:
+
+    <output>/warehouse_id=<warehouse>/date=<YYYY-MM-DD>/part-<checkpoint>-<first id>.parquet
+
+The layout is the Hive one: the partition columns are only stored in the
+paths and pyarrow.parquet.ParquetDataset and pandas read them back.
+
+Runs are incremental. Every checkpoint-rows rows the open files are
+completed and the state is saved in <output>/_export_state.json. Files
+written after the last saved checkpoint are removed by the next run.
+
+IDs are reserved in blocks by every ingest process, so rows are not
+committed in id order: a quiet process keeps filling an old block while
+others have moved far ahead. The state therefore keeps, next to the
+highest id scanned, the ranges of IDs below it that had no row yet. Every
+run first exports the rows committed into those gaps since, then the IDs
+after the highest one. Gaps older than gap-retention seconds are given up
+and logged, they are the unused ends of blocks of stopped processes. The
+newest id-lag IDs are left for a later run, which keeps the gaps few.
+
+Usage:
+    python export_parquet.py [--output DIR] [--chunk-rows N]
+"""
+
+# Basic libraries
+import argparse
+import json
+import logging
+import os
+import re
+import time
+from collections import OrderedDict
+from urllib.parse import quote
+
+# Arrow Libraries
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# Custom modules
+import psql_func
+import settings
+
+TABLE = "QLog_data"
+STATE_FILE = "_export_state.json"
+PART_FILE = re.compile(r"part-(\d+)-(\d+)\.parquet(\.tmp)?$")
+
+RANGE_QUERY = f'SELECT * FROM public."{TABLE}" WHERE id > %s AND id <= %s ORDER BY id'
+GAP_QUERY = f"""SELECT D.* FROM unnest(%s::bigint[], %s::bigint[]) AS G(low, high)
+                JOIN public."{TABLE}" D ON D.id BETWEEN G.low AND G.high ORDER BY D.id"""
+
+# Positions in the column order of psql_func.build_params
+ID_COLUMN, WAREHOUSE_COLUMN, DATE_COLUMN = 0, 1, 3
+
+ARROW_TYPES = {
+    "smallint": pa.int16(),
+    "integer": pa.int32(),
+    "bigint": pa.int64(),
+    "real": pa.float32(),
+    "double precision": pa.float64(),
+    "numeric": pa.float64(),
+    "boolean": pa.bool_(),
+    "date": pa.date32(),
+    "time without time zone": pa.time64("us"),
+    "timestamp without time zone": pa.timestamp("us"),
+    "timestamp with time zone": pa.timestamp("us", tz="UTC"),
+}
+
+
+def arrow_fields(columns):
+    """Arrow fields of the table columns, types without a mapping are exported as strings"""
+    return [pa.field(name, ARROW_TYPES.get(data_type, pa.string()))
+            for name, data_type in columns]
+
+
+def converter(arrow_type):
+    """Function turning a psycopg2 value into one pyarrow accepts for arrow_type"""
+    if arrow_type == pa.string():
+        return lambda value: (value if value is None or isinstance(value, str)
+                              else json.dumps(value) if isinstance(value, (dict, list))
+                              else str(value))
+    if pa.types.is_floating(arrow_type):
+        # numeric columns come back as Decimal
+        return lambda value: None if value is None else float(value)
+    return None
+
+
+def to_table(rows, schema, positions):
+    arrays = []
+    for index, field in zip(positions, schema):
+        convert = converter(field.type)
+        values = [row[index] for row in rows]
+        if convert is not None:
+            values = [convert(value) for value in values]
+        arrays.append(pa.array(values, type=field.type))
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+
+class PartitionWriters:
+    """Open Parquet files, one per partition, closing the least recently used
+
+    Files are written as .tmp and renamed once complete, their names start
+    with the checkpoint they belong to.
+
+    Args:
+        output (str): Root directory of the export
+        fields (list): Arrow fields of every table column
+        checkpoint (int): Checkpoint the files written next belong to
+        max_open (int): Files kept open at the same time
+        compression (str): Parquet compression codec
+    """
+
+    def __init__(self, output, fields, checkpoint, max_open=settings.EXPORT_MAX_OPEN_FILES,
+                 compression=settings.EXPORT_COMPRESSION):
+        self.output = output
+        self.checkpoint = checkpoint
+        self.partition_names = (fields[WAREHOUSE_COLUMN].name, fields[DATE_COLUMN].name)
+        # Columns stored in the files, the partition columns are in the paths
+        self.positions = [index for index in range(len(fields))
+                          if index not in (WAREHOUSE_COLUMN, DATE_COLUMN)]
+        self.schema = pa.schema([fields[index] for index in self.positions])
+        self.max_open = max_open
+        self.compression = compression
+        self.files_written = 0
+
+        # (warehouse_id, date) -> (ParquetWriter, path)
+        self._open = OrderedDict()
+
+    def write(self, partition, first_id, rows):
+        entry = self._open.get(partition)
+        if entry is None:
+            while len(self._open) >= self.max_open:
+                self._close(*self._open.popitem(last=False)[1])
+
+            directory = os.path.join(self.output, *(f"{name}={quote(value, safe='')}"
+                                                    for name, value in zip(self.partition_names,
+                                                                           partition)))
+            os.makedirs(directory, exist_ok=True)
+            path = os.path.join(directory, "part-%06d-%012d.parquet" % (self.checkpoint, first_id))
+            entry = (pq.ParquetWriter(path + ".tmp", self.schema,
+                                      compression=self.compression), path)
+            self._open[partition] = entry
+        else:
+            self._open.move_to_end(partition)
+
+        entry[0].write_table(to_table(rows, self.schema, self.positions))
+
+    def close(self):
+        """Completes every open file"""
+        while self._open:
+            self._close(*self._open.popitem(last=False)[1])
+
+    def _close(self, writer, path):
+        writer.close()
+        os.replace(path + ".tmp", path)
+        self.files_written += 1
+
+
+def load_state(output):
+    """Highest id scanned, the checkpoint saved last and the open gaps [low, high, first seen]"""
+    try:
+        with open(os.path.join(output, STATE_FILE)) as state_file:
+            state = json.load(state_file)
+    except FileNotFoundError:
+        state = {}
+
+    state.setdefault("last_id", 0)
+    state.setdefault("checkpoint", 0)
+    state.setdefault("gaps", [])
+    return state
+
+
+def save_state(output, state):
+    path = os.path.join(output, STATE_FILE)
+    with open(path + ".tmp", "w") as state_file:
+        json.dump(state, state_file)
+        state_file.flush()
+        os.fsync(state_file.fileno())
+    os.replace(path + ".tmp", path)
+
+
+def remove_incomplete(output, checkpoint):
+    """Removes files written after the last checkpoint by an interrupted run"""
+    for directory, _, files in os.walk(output):
+        for name in files:
+            match = PART_FILE.match(name)
+            if match and (match.group(3) or int(match.group(1)) > checkpoint):
+                os.remove(os.path.join(directory, name))
+                logging.info("Removed incomplete export file %s" % os.path.join(directory, name))
+
+
+def read_range(last_id, upper_id, chunk_rows):
+    """Rows with last_id < id <= upper_id, in id order"""
+    return psql_func.read_chunks(RANGE_QUERY, (last_id, upper_id), chunk_rows,
+                                 name="qlog_export")
+
+
+def read_gaps(gaps, chunk_rows):
+    """Rows committed into the gap ranges, in id order"""
+    return psql_func.read_chunks(GAP_QUERY, ([low for low, _, _ in gaps],
+                                             [high for _, high, _ in gaps]),
+                                 chunk_rows, name="qlog_export_gaps")
+
+
+def fill_gaps(gaps, ids):
+    """Removes exported ids from the gap ranges
+
+    Args:
+        gaps (list): [low, high, first seen] ranges, sorted and disjoint
+        ids (list): Exported ids, sorted
+
+    Returns:
+        list: The ranges still without a row
+    """
+    remaining = []
+    index = 0
+    for low, high, seen in gaps:
+        while index < len(ids) and ids[index] < low:
+            index += 1
+
+        start = low
+        while index < len(ids) and ids[index] <= high:
+            if ids[index] > start:
+                remaining.append([start, ids[index] - 1, seen])
+            start = ids[index] + 1
+            index += 1
+
+        if start <= high:
+            remaining.append([start, high, seen])
+    return remaining
+
+
+def expire_gaps(gaps, retention, now):
+    """Drops the gaps older than retention, logging the IDs given up"""
+    expired = [gap for gap in gaps if now - gap[2] > retention]
+    if expired:
+        logging.error("Gave up on %s IDs in %s gaps older than %ss, rows committed there "
+                      "later are not exported (e.g. ids %s-%s)"
+                      % (sum(high - low + 1 for low, high, _ in expired), len(expired),
+                         retention, expired[0][0], expired[0][1]))
+    return [gap for gap in gaps if now - gap[2] <= retention]
+
+
+def export(output, chunk_rows=settings.PSQL_STREAM_CHUNK_ROWS,
+           checkpoint_rows=settings.EXPORT_CHECKPOINT_ROWS, id_lag=settings.EXPORT_ID_LAG,
+           gap_retention=settings.EXPORT_GAP_RETENTION):
+    """Exports the rows committed since the last run
+
+    Args:
+        output (str): Root directory of the export
+        chunk_rows (int): Rows fetched per round-trip
+        checkpoint_rows (int): Rows after which files are completed and the state saved
+        id_lag (int): Newest IDs left for the next run
+        gap_retention (float): Seconds IDs without a row are scanned again
+
+    Returns:
+        int: Rows exported
+    """
+    os.makedirs(output, exist_ok=True)
+    state = load_state(output)
+    remove_incomplete(output, state["checkpoint"])
+
+    most_recent = psql_func.read_most_recent_id()
+    if most_recent == -1:
+        raise RuntimeError("Could not read the most recent id of %s" % TABLE)
+    upper_id = most_recent[0] - id_lag
+
+    now = time.time()
+    state["gaps"] = expire_gaps(state["gaps"], gap_retention, now)
+    if upper_id <= state["last_id"] and not state["gaps"]:
+        logging.info("Nothing to export after id %s" % state["last_id"])
+        save_state(output, state)
+        return 0
+
+    writers = PartitionWriters(output, arrow_fields(psql_func.get_table_columns(TABLE)),
+                               state["checkpoint"] + 1)
+    exported = since_checkpoint = 0
+
+    def write(rows):
+        partitions = OrderedDict()
+        for row in rows:
+            key = (str(row[WAREHOUSE_COLUMN]), str(row[DATE_COLUMN]))
+            partitions.setdefault(key, []).append(row)
+        for partition, partition_rows in partitions.items():
+            writers.write(partition, partition_rows[0][ID_COLUMN], partition_rows)
+        return len(rows)
+
+    def checkpoint():
+        writers.close()
+        state["checkpoint"] = writers.checkpoint
+        save_state(output, state)
+        writers.checkpoint += 1
+
+    # Rows committed since the last run into IDs it found without a row
+    if state["gaps"]:
+        late_ids = []
+        for rows in read_gaps(state["gaps"], chunk_rows):
+            since_checkpoint += write(rows)
+            late_ids.extend(row[ID_COLUMN] for row in rows)
+
+        exported += len(late_ids)
+        state["gaps"] = fill_gaps(state["gaps"], late_ids)
+        if late_ids:
+            logging.info("Exported %s rows committed after higher IDs" % len(late_ids))
+
+    # IDs after the highest one scanned, remembering those without a row
+    expected = state["last_id"] + 1
+    for rows in read_range(state["last_id"], max(upper_id, state["last_id"]), chunk_rows):
+        for row in rows:
+            if row[ID_COLUMN] > expected:
+                state["gaps"].append([expected, row[ID_COLUMN] - 1, now])
+            expected = row[ID_COLUMN] + 1
+
+        exported += len(rows)
+        since_checkpoint += write(rows)
+        state["last_id"] = rows[-1][ID_COLUMN]
+
+        if since_checkpoint >= checkpoint_rows:
+            checkpoint()
+            since_checkpoint = 0
+            logging.info("Exported %s rows, up to id %s" % (exported, state["last_id"]))
+
+    if expected <= upper_id:
+        state["gaps"].append([expected, upper_id, now])
+    state["last_id"] = max(upper_id, state["last_id"])
+
+    checkpoint()
+    logging.info("Exported %s rows into %s files, up to id %s, %s gaps with %s IDs left open"
+                 % (exported, writers.files_written, state["last_id"], len(state["gaps"]),
+                    sum(high - low + 1 for low, high, _ in state["gaps"])))
+    return exported
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--output", default=settings.EXPORT_DIR)
+    parser.add_argument("--chunk-rows", type=int, default=settings.PSQL_STREAM_CHUNK_ROWS)
+    parser.add_argument("--checkpoint-rows", type=int, default=settings.EXPORT_CHECKPOINT_ROWS)
+    parser.add_argument("--id-lag", type=int, default=settings.EXPORT_ID_LAG,
+                        help="Newest IDs left for the next run")
+    parser.add_argument("--gap-retention", type=float, default=settings.EXPORT_GAP_RETENTION,
+                        help="Seconds IDs without a row are scanned again")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+
+    logging.basicConfig(format="%(asctime)s - %(levelname)s %(message)s", level=logging.INFO)
+
+    args = parse_args()
+    try:
+        export(args.output, args.chunk_rows, args.checkpoint_rows, args.id_lag,
+               args.gap_retention)
+    finally:
+        psql_func.pool.closeall()
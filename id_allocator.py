@@ -0,0 +1,138 @@
+# Basic libraries
+import threading
+from collections import deque
+
+# Custom modules
+import settings
+
+
+class IdAllocator:
+    """Hands out primary keys for the main table without a query per row.
+
+    Keys are reserved in blocks from a PSQL sequence that increments by the
+    block size (hi-lo). Every nextval() returns the first key of a block
+    nobody else owns, so any number of ingest processes can insert at the
+    same time without colliding.
+
+    Args:
+        sequence (str): Name of the PSQL sequence
+        block_size (int): Number of keys reserved per nextval()
+        table (str): Table whose ID column the keys are used for
+    """
+
+    # Reserves blocks, psycopg2 and asyncpg placeholders
+    RESERVE_QUERY = "SELECT nextval(%s) FROM generate_series(1, %s)"
+    RESERVE_QUERY_ASYNC = "SELECT nextval($1) FROM generate_series(1, $2)"
+
+    def __init__(self, sequence=settings.QLOG_ID_SEQUENCE,
+                 block_size=settings.QLOG_ID_BLOCK_SIZE,
+                 table='public."QLog_data"'):
+        self.sequence = sequence
+        self.block_size = block_size
+        self.table = table
+
+        self._lock = threading.Lock()
+        # Reserved key ranges as [next, end) pairs, oldest first
+        self._blocks = deque()
+        self._sequence_ready = False
+
+    def allocate(self, pooled, count):
+        """Returns count unused primary keys
+
+        Args:
+            pooled (PooledConnection): Connection used if new blocks are needed
+            count (int): Number of keys
+
+        Returns:
+            list: The allocated keys in increasing order
+        """
+        with self._lock:
+            blocks = self._blocks_needed(count)
+            if blocks:
+                self._reserve(pooled, blocks)
+            return self._take(count)
+
+    async def allocate_async(self, conn, count):
+        """allocate() for an asyncpg connection, used by the asyncio service
+
+        Args:
+            conn (asyncpg.Connection): Connection used if new blocks are needed
+            count (int): Number of keys
+
+        Returns:
+            list: The allocated keys in increasing order
+        """
+        while True:
+            with self._lock:
+                blocks = self._blocks_needed(count)
+                if not blocks:
+                    return self._take(count)
+
+            # Other coroutines may take keys while this one waits, hence the loop
+            if not self._sequence_ready:
+                await self._create_sequence_async(conn)
+            rows = await conn.fetch(self.RESERVE_QUERY_ASYNC, self.sequence, blocks)
+            with self._lock:
+                self._add_blocks(row[0] for row in rows)
+
+    def _blocks_needed(self, count):
+        available = sum(end - start for start, end in self._blocks)
+        if available >= count:
+            return 0
+        return -(-(count - available) // self.block_size)
+
+    def _add_blocks(self, starts):
+        for start in sorted(starts):
+            self._blocks.append((start, start + self.block_size))
+
+    def _take(self, count):
+        ids = []
+        while len(ids) < count:
+            start, end = self._blocks[0]
+            take = min(count - len(ids), end - start)
+            ids.extend(range(start, start + take))
+
+            if start + take == end:
+                self._blocks.popleft()
+            else:
+                self._blocks[0] = (start + take, end)
+
+        return ids
+
+    def _reserve(self, pooled, blocks):
+        if not self._sequence_ready:
+            self._create_sequence(pooled)
+
+        cur = pooled.cursor()
+        cur.execute(self.RESERVE_QUERY, (self.sequence, blocks))
+        self._add_blocks(row[0] for row in cur.fetchall())
+        cur.close()
+
+    def _create_sequence(self, pooled):
+        """Creates the sequence once, starting above the current largest ID"""
+        cur = pooled.cursor()
+
+        # Serialize creation between processes starting at the same time
+        cur.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (self.sequence,))
+        cur.execute("SELECT to_regclass(%s)", (self.sequence,))
+
+        if cur.fetchone()[0] is None:
+            cur.execute(f"SELECT COALESCE(MAX(id), 0) + 1 FROM {self.table}")
+            cur.execute(self._create_query(cur.fetchone()[0]))
+
+        pooled.commit()
+        cur.close()
+        self._sequence_ready = True
+
+    async def _create_sequence_async(self, conn):
+        async with conn.transaction():
+            await conn.execute("SELECT pg_advisory_xact_lock(hashtext($1))", self.sequence)
+            if await conn.fetchval("SELECT to_regclass($1)", self.sequence) is None:
+                start = await conn.fetchval(f"SELECT COALESCE(MAX(id), 0) + 1 FROM {self.table}")
+                await conn.execute(self._create_query(start))
+
+        self._sequence_ready = True
+
+    def _create_query(self, start):
+        return (f"CREATE SEQUENCE {self.sequence} "
+                f"INCREMENT BY {int(self.block_size)} START WITH {int(start)}")
@@ -0,0 +1,155 @@
+# Basic libraries
+import logging
+import threading
+import time
+
+# Scientific Libraries
+import numpy as np
+
+# Custom modules
+import calculations
+import metrics
+import profiler
+import settings
+
+INFERENCE_SECONDS = metrics.Histogram("qlog_inference_seconds", "Time to score a batch of windows")
+INFERENCE_BATCH_SIZE = metrics.Histogram("qlog_inference_batch_windows", "Windows scored per batch",
+                                         buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256, 512))
+
+
+class InferenceBatcher:
+    """Scores completed windows in micro-batches.
+
+    Windows are collected for a few milliseconds, grouped by the models
+    they use and scored with one predict call per group instead of one per
+    window. Grouping is by model object, so every (fruit, variety) falling
+    back to the default models shares a single batch. If a batch call
+    fails, its windows are scored one by one so a single bad row only
+    affects itself.
+
+    Args:
+        batch_window (float): Seconds to collect windows before scoring
+        max_batch (int): Windows that trigger scoring immediately
+    """
+
+    def __init__(self, batch_window=settings.INFERENCE_BATCH_WINDOW,
+                 max_batch=settings.INFERENCE_BATCH_MAX):
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+
+        self._pending = []
+        self._first_added = None
+        self._condition = threading.Condition()
+        self._thread = None
+        self._closing = False
+
+    def start(self):
+        """Starts the scoring thread"""
+        self._thread = threading.Thread(target=self._run,
+                                        name="inference-batcher",
+                                        daemon=True)
+        self._thread.start()
+        return self
+
+    def submit(self, brix_model, clf_model, normalized_values, callback):
+        """Queues a window for scoring
+
+        Args:
+            brix_model (regression model): Model to predict brix values
+            clf_model (linear model): Model to classify fruits
+            normalized_values (array): Normalized readings of the window
+            callback (callable): Called as callback(predicted_brix, brix_level, fruit_status)
+        """
+        with self._condition:
+            if not self._pending:
+                self._first_added = time.monotonic()
+            self._pending.append((brix_model, clf_model,
+                                  normalized_values, callback))
+
+            # Wake the scoring thread to start the batch window or score now
+            if len(self._pending) == 1 or len(self._pending) >= self.max_batch:
+                self._condition.notify()
+
+    def close(self, timeout=None):
+        """Scores the pending windows and stops the scoring thread"""
+        with self._condition:
+            self._closing = True
+            self._condition.notify()
+
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while True:
+                    if self._pending:
+                        wait = self.batch_window - (time.monotonic() - self._first_added)
+                        if (wait <= 0 or self._closing
+                                or len(self._pending) >= self.max_batch):
+                            break
+                    elif self._closing:
+                        return
+                    else:
+                        wait = None
+                    self._condition.wait(wait)
+
+                batch, self._pending = self._pending, []
+
+            for group in self._group(batch).values():
+                self._score(group)
+
+    @staticmethod
+    def _group(batch):
+        groups = {}
+        for item in batch:
+            key = (id(item[0]), id(item[1]))
+            groups.setdefault(key, []).append(item)
+        return groups
+
+    def _score(self, group):
+        brix_model, clf_model, _, _ = group[0]
+
+        try:
+            with INFERENCE_SECONDS.time(), profiler.stage("inference"):
+                values = np.stack([item[2] for item in group])
+                predicted_brix = calculations.predict_brix_batch(values, brix_model)
+                brix_levels = calculations.calculate_brix_levels(predicted_brix)
+                fruit_status = calculations.predict_status_batch(values, clf_model)
+            INFERENCE_BATCH_SIZE.observe(len(group))
+        except Exception as e:
+            logging.error("Batch inference of %s windows failed, scoring one by one - %s"
+                          % (len(group), e))
+            for item in group:
+                self._score_one(item)
+            return
+
+        for item, brix, level, status in zip(group, predicted_brix,
+                                             brix_levels, fruit_status):
+            self._deliver(item[3], brix, str(level), int(status))
+
+    def _score_one(self, item):
+        brix_model, clf_model, normalized_values, callback = item
+
+        try:
+            predicted_brix = calculations.predict_brix(normalized_values, brix_model)
+        except Exception as e:
+            logging.error("Brix prediction failed - %s" % e)
+            predicted_brix = -1
+
+        brix_level = calculations.calculate_brix_level(predicted_brix)
+
+        try:
+            fruit_status = calculations.predict_status(normalized_values, clf_model)
+        except Exception as e:
+            logging.error("Status classification failed - %s" % e)
+            fruit_status = -1
+
+        self._deliver(callback, predicted_brix, brix_level, fruit_status)
+
+    @staticmethod
+    def _deliver(callback, predicted_brix, brix_level, fruit_status):
+        try:
+            callback(predicted_brix, brix_level, fruit_status)
+        except Exception as e:
+            logging.error("Inference callback failed - %s" % e)
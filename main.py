@@ -1,16 +1,16 @@
 # Basic libraries
 import logging
+import signal
+import sys
 import threading
 import time
-import pickle
 from warnings import filterwarnings
-import numpy as np
 
 # MQTT Library
 import paho.mqtt.client as mqttClient
 
 # Custom modules
-import calculations, psql_func, settings
+import dedup, device_registry, metrics, payload_parser, pipeline, profiler, psql_func, rollups, scheduler, settings, spool
 filterwarnings("ignore")
 
 # Logging
@@ -36,58 +36,72 @@ MQTT_PORT = settings.MQTT_PORT
 Connected = False
 TIMEOUT = settings.TIMEOUT
 
-device_dictionary = {}
-device_list = []
+# Window state of every device, indexed by (warehouse_id, device_id)
+devices = device_registry.DeviceRegistry()
 
+# Spools readings to disk and drains them to PSQL in batches off the MQTT thread
+writer = spool.SpooledWriter(psql_func.write_rows, psql_func.allocate_ids,
+                             spool.Spool(f"{settings.SPOOL_DIR}main/"))
 
-def create_dictionary(warehouse_id, device_id):
-    """Creates a dictionary for every device.
-    Keeps track of message count.
-    Keeps track of time out
+# Per-minute and per-hour rollups of the readings, upserted in batches
+rollup = rollups.RollupAggregator(psql_func.write_rollups, psql_func.create_rollup_tables)
 
-    Args:
-        warehouse_id (str): Warehouse ID of the device
-        device_id (str): Device ID of the device
+# Repeated payloads, dropped on the network thread
+duplicates = dedup.DuplicateFilter()
 
-    Returns:
-        dict: Dictionary containing device information
-    """
+# Fires window time outs
+timeouts = scheduler.DeadlineScheduler()
 
-    
-    return {
-        "warehouse_id": warehouse_id,
-        "device_id": device_id,
-        "message_count": 0,
-        "message_limit": settings.MESSAGE_LIMIT,
-        "message_arr": [],
-        "end_time": -1,
-        "pub_topic": f"/{warehouse_id}/{device_id}",
-    }
-
-
-def reset_variables(device_name):
+# Metrics, served on http://METRICS_HOST:MAIN_METRICS_PORT/metrics
+MESSAGES_RECEIVED = metrics.Counter("qlog_messages_received_total", "Device messages received")
+PARSE_ERRORS = metrics.Counter("qlog_parse_errors_total", "Messages dropped as unparsable")
+PARSE_SECONDS = metrics.Histogram("qlog_parse_seconds", "Time to parse a payload")
+WINDOWS_COMPLETED = metrics.Counter("qlog_windows_completed_total", "Windows that reached the message limit")
+WINDOWS_TIMED_OUT = metrics.Counter("qlog_windows_timed_out_total", "Windows dropped by their time out")
+MQTT_CONNECTS = metrics.Counter("qlog_mqtt_connects_total", "Connections to the broker, including reconnects")
+MQTT_DISCONNECTS = metrics.Counter("qlog_mqtt_unexpected_disconnects_total", "Connections lost unexpectedly")
+ACTIVE_DEVICES = metrics.Gauge("qlog_active_devices", "Devices with a window in progress",
+                               lambda: sum(1 for device in devices if device.message_count))
+KNOWN_DEVICES = metrics.Gauge("qlog_known_devices", "Devices seen since start", lambda: len(devices))
+SPOOL_PENDING = metrics.Gauge("qlog_spool_pending_readings", "Readings waiting to be written to PSQL",
+                              writer.pending)
+
+
+def reset_variables(device):
     """Resets variables for a specific device
 
     Args:
-        device_name (str): Combination of warehouseID and deviceID
+        device (DeviceState): State of the device
     """
 
-    global device_dictionary
-
     lock.acquire()
 
     try:
-        device_dictionary[device_name]["message_count"] = 0
-        device_dictionary[device_name]["message_arr"] = []
-        device_dictionary[device_name]["end_time"] = -1
-        logging.info('Reset value for %s' % device_name)
+        timeouts.cancel(device)
+        device.reset()
+        logging.info('Reset value for %s' % device.name)
     except Exception as e:
-        logging.error('Reset for %s failed - %s' % (device_name, e))
+        logging.error('Reset for %s failed - %s' % (device.name, e))
     finally:
         # Always called even if exception is raised
         lock.release()
 
 
+def on_timeout(device):
+    """Resets a device whose window did not fill up before its time out
+
+    Args:
+        device (DeviceState): State of the device
+    """
+    end_time = device.end_time
+
+    # The window may have completed while the time out was firing
+    if end_time != -1 and time.monotonic() >= end_time:
+        logging.error(f"Timeout exceeded for {device.name}")
+        WINDOWS_TIMED_OUT.inc()
+        reset_variables(device)
+
+
 """
 CALLBACKS
 """
@@ -97,9 +111,13 @@ def on_connect(client, userdata, flags, rc):
 
     if rc == 0:
         logging.info("Connected to broker successfully")
+        MQTT_CONNECTS.inc()
         global Connected
         Connected = True
 
+        # QoS 1 on a persistent session, readings are queued while we are away
+        client.subscribe(SUB_TOPIC, qos=settings.MQTT_SUBSCRIBE_QOS)
+
     else:
         logging.error("Connection failed printing rc " )
         
@@ -111,51 +129,64 @@ def on_disconnect(client, userdata, rc):
         Connected = False
         logging.info("Disconnected")
     else:
+        MQTT_DISCONNECTS.inc()
         logging.error("Still running printing rc ")
 
 
 def on_message(client, userdata, message):
+    """Parses the message and queues it for a pipeline worker, keeping the network thread free"""
+    MESSAGES_RECEIVED.inc()
 
-    global device_list, device_dictionary
-    # Read the message from the device
-    msg = str(message.payload.decode("utf-8"))
-    print("This is the message recieved",msg)
-    # Extract device id and warehouse id
-    warehouse_id = msg.split(",")[-2].strip()
-    device_id = msg.split(",")[-1].strip()
-    #CH4 = msg.split(",")[-4].strip()
-    #CO2 = msg.split(",")[-3].strip()
-
-    # Create device name
-    device_name = f"{warehouse_id}/{device_id}"
-
-    # Create device dictionary
-    if device_name not in device_list:
-        device_dictionary[device_name] = create_dictionary(
-            warehouse_id, device_id
-        )
-        device_list.append(device_name)
-    print("dictionary")
-    # Add message to device dictionary's message array
-    device_dictionary[device_name]["message_arr"].append(msg)
-
-    # Increment message count by 1
-    device_dictionary[device_name]["message_count"] += 1
-
-    # If device dictionary's message count is equal to the messsage limit
-    if (device_dictionary[device_name]["message_count"]
-                >= device_dictionary[device_name]["message_limit"]
-       ):
-    
-        # Assign the device dictionary parameters to variables
-        message_arr = device_dictionary[device_name]["message_arr"]
-        pub_topic = device_dictionary[device_name]["pub_topic"]
+    # Drop redeliveries and retransmits of recent payloads before they reach a window
+    if duplicates.is_duplicate(message.payload, message.dup):
+        return
+
+    # Parse the IDs and readings once, straight from the payload bytes
+    try:
+        with PARSE_SECONDS.time(), profiler.stage("parse"):
+            warehouse_id, device_id, readings = payload_parser.parse_payload(message.payload)
+    except payload_parser.PayloadError as e:
+        PARSE_ERRORS.inc()
+        logging.error("Dropping unparsable message - %s" % e)
+        return
+
+    ingest.submit(f"{warehouse_id}/{device_id}", client, warehouse_id, device_id, readings)
+
+
+def process_message(client, warehouse_id, device_id, readings):
+    """Adds a reading to its device's window and handles completed windows
+
+    Args:
+        client (mqttClient): Client used to publish the feedback
+        warehouse_id (str): Warehouse ID of the device
+        device_id (str): Device ID of the device
+        readings (array): Readings parsed from the message
+    """
+    # Look up the device, registering it on its first message
+    device = devices.get_or_create(warehouse_id, device_id)
+
+    # Add the reading to the device's window, updating its running mean
+    device.add(readings)
+
+    # Start the time out with the first message of the window
+    if device.end_time == -1:
+        device.end_time = time.monotonic() + TIMEOUT
+        timeouts.schedule(device, device.end_time)
+        logging.info(f"Timeout initiated for {device.name}")
+
+    # If the device's message count has reached the messsage limit
+    if device.message_count >= devices.message_limit:
+        WINDOWS_COMPLETED.inc()
+
+        # Assign the device parameters to variables
+        raw_mean_values = device.window_mean()
+        pub_topic = device.pub_topic
     
         # Get device settings from PSQL Table
         #try:
             #fruit, variety, white_standard, batch_number, vendor_code, device_type = psql_func.get_device_data(warehouse_id, device_id)[0]
             
-            #device_dictionary[device_name]["device_type"] = device_type
+            #device.device_type = device_type
             #white_standard = [float(x) for x in white_standard.values()]
 
             #brix_model = BRIX_MODEL_DICT[fruit][variety]
@@ -176,8 +207,8 @@ def on_message(client, userdata, message):
         
     
         # Normalize the message array with respective white standard
-        #raw_mean_values, normalized_values = calculations.normalize_fruit_data(
-            #message_arr, white_standard
+        #normalized_values = calculations.normalize_fruit_data(
+            #raw_mean_values, white_standard
         #)
 
         #np.append(raw_mean_values,CH4)
@@ -214,24 +245,17 @@ def on_message(client, userdata, message):
     
 
         # Update to DB
-        print("Tried psql dump")
-        message_arr = message_arr[0].split(',')
-        message_arr = np.array(list(map(float,message_arr[:-2])))
-        print(message_arr)
-        try:
-        
-            psql_func.write_data(warehouse_id,
-                                 device_id,
-                                 message_arr
-                                 )
+        writer.add(warehouse_id, device_id, raw_mean_values)
+        rollup.add(warehouse_id, device_id, raw_mean_values)
 
-        except Exception as e:
-            print("error is == ",e)
-            logging.error("Failed to store data in PSQL: %s" % e)
+        # Resets variables for device
+        reset_variables(device)
 
 
-        # Resets variables for device
-        reset_variables(device_name)
+# Processes messages off the paho network thread
+ingest = pipeline.IngestPipeline(profiler.wrap(process_message))
+QUEUE_DEPTH = metrics.Gauge("qlog_queue_depth", "Messages waiting for a pipeline worker",
+                            ingest.depth)
 
 
 """
@@ -240,8 +264,8 @@ CLIENT FUNCTIONS
 
 
 def create_client():
-    # Create client instance
-    client = mqttClient.Client()
+    # Create client instance, with a persistent session
+    client = mqttClient.Client(client_id=settings.MAIN_CLIENT_ID, clean_session=False)
     client.username_pw_set(USER, password=PASSWORD)
 
     # Callbacks
@@ -257,6 +281,12 @@ def client_disconnect(client):
     client.disconnect()
 
 
+def shutdown(signum, frame):
+    """Turns SIGTERM from systemd into a normal exit so buffered rows are written"""
+    logging.info("Received signal %s, shutting down" % signum)
+    sys.exit(0)
+
+
 """
 MAIN LOOP
 """
@@ -269,12 +299,9 @@ if __name__ == "__main__":
     # Create client
     client = create_client()
 
-    # Connect
+    # Connect, on_connect subscribes
     client.connect(BROKER_ADDRESS, port=MQTT_PORT)
-    logging.info(f"Connected via Script ({USER})")
-
-    # Subscribe to MQTT Topic
-    client.subscribe(SUB_TOPIC)
+    logging.info(f"Connected via Script ({USER}) as {settings.MAIN_CLIENT_ID}")
 
     # Load pickle models for brix
     #try:
@@ -328,35 +355,35 @@ if __name__ == "__main__":
         #logging.error("Failed to load models - %s" % e)
 
 
+    # Expose the metrics endpoint
+    metrics.serve(settings.MAIN_METRICS_PORT)
+
+    # Start writing readings and processing messages in the background
+    writer.start()
+    rollup.start()
+    ingest.start()
+    signal.signal(signal.SIGTERM, shutdown)
+    profiler.install_signal_handler()
+
     # Start listening
     client.loop_start()
 
-    # Time out functionality
-    while True:
-
-        for device_name in device_list:
-
-            end_time = device_dictionary[device_name]["end_time"]
-            message_count = device_dictionary[device_name]["message_count"]
-            message_limit = device_dictionary[device_name]["message_limit"]
-
-            # If device has sent one or more messages
-            if message_count >= 1:
-
-                # If timeout has not been set (when message_count == 1)
-                if end_time == -1:
-                    # Sets end_time to current time + TIMEOUT
-                    device_dictionary[device_name]["end_time"] = time.time() + TIMEOUT
-                    logging.info(f"Timeout initiated for {device_name}")
-
-                # If timeout has been set
-                if end_time != -1:
-                    # If time is past the end_time, resets the variables
-                
-                    if time.time() > end_time:
-                            logging.error(f"Timeout exceeded for {device_name}")
-                            reset_variables(device_name)
-    print("All good")
-    client.loop_stop()
-    client.disconnect()
-    prtin("Successul")
+    # Time out functionality, sleeps until the next window expires
+    try:
+        timeouts.run(on_timeout)
+
+    except KeyboardInterrupt:
+        logging.info("Interrupted, shutting down")
+
+    finally:
+        timeouts.stop()
+        client.loop_stop()
+        client.disconnect()
+
+        # Finish the queued messages
+        ingest.stop(settings.PIPELINE_STOP_TIMEOUT)
+
+        # Write everything still buffered before exiting
+        writer.close(settings.BULK_WRITE_CLOSE_TIMEOUT)
+        rollup.close(settings.BULK_WRITE_CLOSE_TIMEOUT)
+        psql_func.pool.closeall()
@@ -0,0 +1,256 @@
+"""Prometheus style metrics served over a local HTTP endpoint.
+
+Metrics register themselves with the module level registry when created,
+usually at import time of the module they instrument:
+
+    MESSAGES = metrics.Counter("qlog_messages_received_total", "Messages received")
+    MESSAGES.inc()
+
+    with PARSE_SECONDS.time():
+        ...
+
+metrics.serve(port) exposes every registered metric in the Prometheus text
+format on http://127.0.0.1:<port>/metrics, and the readiness of the process
+on /ready: 200 once every component passed to readiness.require() was
+marked ready, 503 with the components still pending before that.
+"""
+
+# Basic libraries
+import bisect
+import logging
+import math
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Custom modules
+import settings
+
+# Seconds, from 0.1 ms up to 10 s
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_registry = []
+_registry_lock = threading.Lock()
+
+
+def _register(metric):
+    with _registry_lock:
+        if any(existing.name == metric.name for existing in _registry):
+            raise ValueError("Metric %s is already registered" % metric.name)
+        _registry.append(metric)
+
+
+def _format(value):
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+
+class Counter:
+    """Value that only goes up"""
+
+    kind = "counter"
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self._value = 0.0
+        self._lock = threading.Lock()
+        _register(self)
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    def value(self):
+        return self._value
+
+    def samples(self):
+        return [(self.name, self._value)]
+
+
+class Gauge:
+    """Value that goes up and down, or is read from a function when scraped"""
+
+    kind = "gauge"
+
+    def __init__(self, name, documentation, function=None):
+        self.name = name
+        self.documentation = documentation
+        self.function = function
+        self._value = 0.0
+        self._lock = threading.Lock()
+        _register(self)
+
+    def set(self, value):
+        self._value = value
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def set_function(self, function):
+        """Reads the value from function() on every scrape"""
+        self.function = function
+
+    def value(self):
+        if self.function is not None:
+            return self.function()
+        return self._value
+
+    def samples(self):
+        try:
+            return [(self.name, self.value())]
+        except Exception as e:
+            logging.error("Gauge %s failed - %s" % (self.name, e))
+            return []
+
+
+class Histogram:
+    """Distribution of observed values, e.g. latencies in seconds"""
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(sorted(buckets))
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0.0
+        self._lock = threading.Lock()
+        _register(self)
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+
+    @contextmanager
+    def time(self):
+        """Observes the seconds spent in the with block"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def samples(self):
+        with self._lock:
+            counts = list(self._counts)
+            total = self._sum
+
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (math.inf,), counts):
+            cumulative += count
+            samples.append((f'{self.name}_bucket{{le="{_format(bound)}"}}', cumulative))
+        samples.append((f"{self.name}_sum", total))
+        samples.append((f"{self.name}_count", cumulative))
+        return samples
+
+
+class Readiness:
+    """Components a process waits for before it reports ready"""
+
+    def __init__(self):
+        self._pending = set()
+        self._lock = threading.Lock()
+
+    def require(self, *components):
+        """Marks components as not ready yet, e.g. 'mqtt' or 'psql'"""
+        with self._lock:
+            self._pending.update(components)
+
+    def set_ready(self, component, ready=True):
+        with self._lock:
+            if ready:
+                if component in self._pending:
+                    self._pending.discard(component)
+                    logging.info("%s ready" % component)
+            else:
+                self._pending.add(component)
+
+    def pending(self):
+        with self._lock:
+            return sorted(self._pending)
+
+    def is_ready(self):
+        with self._lock:
+            return not self._pending
+
+
+readiness = Readiness()
+READY = Gauge("qlog_ready", "1 once every required component is ready",
+              lambda: int(readiness.is_ready()))
+
+
+def render():
+    """Every registered metric in the Prometheus text format"""
+    with _registry_lock:
+        metrics = list(_registry)
+
+    lines = []
+    for metric in metrics:
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for name, value in metric.samples():
+            lines.append(f"{name} {_format(value)}")
+    return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        path = self.path.split("?")[0]
+        if path == "/metrics":
+            status, body = 200, render()
+        elif path == "/ready":
+            pending = readiness.pending()
+            status, body = ((503, "waiting for %s\n" % ", ".join(pending)) if pending
+                            else (200, "ready\n"))
+        else:
+            self.send_error(404)
+            return
+
+        body = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes would flood the service log
+        pass
+
+
+def serve(port, host=settings.METRICS_HOST):
+    """Serves /metrics and /ready from a background thread
+
+    Args:
+        port (int): Port to listen on, 0 disables the endpoint
+        host (str): Interface to listen on, local only by default
+
+    Returns:
+        ThreadingHTTPServer: The server, or None if disabled or the port is taken
+    """
+    if not port:
+        return None
+
+    try:
+        server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    except OSError as e:
+        logging.error("Metrics endpoint on %s:%s failed - %s" % (host, port, e))
+        return None
+
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics",
+                     daemon=True).start()
+    logging.info("Serving metrics on http://%s:%s/metrics" % (host, port))
+    return server
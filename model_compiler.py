@@ -0,0 +1,396 @@
+"""Compiles sklearn models into plain NumPy arrays.
+
+Supported estimators are exported to a compact .npz next to their .sav
+file. Inference then needs no sklearn input validation or dispatch:
+
+    Linear regressors       X @ coef.T + intercept
+    Logistic regression     Sigmoid or softmax of the linear decision
+    Single decision trees   Vectorized walk over the node arrays
+
+Anything else (e.g. random forests) keeps using the unpickled sklearn object.
+A model is only written out if it matches the original on random inputs.
+The .npz records the SHA-256 of the .sav it was compiled from, so a
+replaced .sav is never shadowed by an old compiled model.
+The sklearn outputs on those inputs are kept in a .reference.npz, so a
+compiled model can be checked without the pinned sklearn installed.
+
+Usage:
+    python model_compiler.py [model_dir]          Compile every .sav file
+    python model_compiler.py --check [model_dir]  Re-check the .npz files against
+                                                  sklearn and the reference outputs
+"""
+
+# Basic libraries
+import glob
+import hashlib
+import logging
+import os
+import pickle
+import sys
+
+# Scientific Libraries
+import numpy as np
+
+# Custom modules
+import settings
+
+LINEAR_REGRESSORS = {"LinearRegression", "Ridge", "RidgeCV", "Lasso", "LassoCV",
+                     "ElasticNet", "ElasticNetCV", "LinearSVR", "SGDRegressor",
+                     "BayesianRidge", "HuberRegressor"}
+LOGISTIC_CLASSIFIERS = {"LogisticRegression", "LogisticRegressionCV"}
+TREES = {"DecisionTreeClassifier", "DecisionTreeRegressor"}
+
+PARITY_SAMPLES = 1000
+PARITY_RTOL = 1e-6
+PARITY_ATOL = 1e-9
+
+
+class CompiledLinearModel:
+    """Linear regressor, predict matches the sklearn output shape"""
+
+    kind = "linear"
+
+    def __init__(self, coef, intercept):
+        self.coef = np.asarray(coef, dtype=np.float64)
+        self.intercept = np.asarray(intercept, dtype=np.float64)
+        self.n_features = self.coef.shape[-1]
+
+    def predict(self, values):
+        return np.asarray(values, dtype=np.float64) @ self.coef.T + self.intercept
+
+    def arrays(self):
+        return {"coef": self.coef, "intercept": self.intercept}
+
+
+class CompiledLogisticModel:
+    """Logistic regression classifier"""
+
+    kind = "logistic"
+
+    def __init__(self, coef, intercept, classes, multinomial):
+        self.coef = np.asarray(coef, dtype=np.float64)
+        self.intercept = np.asarray(intercept, dtype=np.float64)
+        self.classes = np.asarray(classes)
+        self.multinomial = bool(multinomial)
+        self.n_features = self.coef.shape[-1]
+
+    def predict_proba(self, values):
+        decision = np.asarray(values, dtype=np.float64) @ self.coef.T + self.intercept
+
+        if decision.shape[1] == 1:
+            positive = 1.0 / (1.0 + np.exp(-decision[:, 0]))
+            return np.column_stack([1.0 - positive, positive])
+
+        if self.multinomial:
+            decision = np.exp(decision - decision.max(axis=1, keepdims=True))
+        else:
+            decision = 1.0 / (1.0 + np.exp(-decision))
+        return decision / decision.sum(axis=1, keepdims=True)
+
+    def predict(self, values):
+        return self.classes[np.argmax(self.predict_proba(values), axis=1)]
+
+    def arrays(self):
+        return {"coef": self.coef, "intercept": self.intercept,
+                "classes": self.classes, "multinomial": np.array(self.multinomial)}
+
+
+class CompiledTreeModel:
+    """Single decision tree classifier or regressor"""
+
+    kind = "tree"
+
+    def __init__(self, children_left, children_right, feature, threshold,
+                 value, classes=None, n_features=None):
+        self.children_left = np.asarray(children_left, dtype=np.int64)
+        self.children_right = np.asarray(children_right, dtype=np.int64)
+        self.feature = np.asarray(feature, dtype=np.int64)
+        self.threshold = np.asarray(threshold, dtype=np.float64)
+        self.value = np.asarray(value, dtype=np.float64)
+        self.classes = None if classes is None else np.asarray(classes)
+        self.n_features = int(n_features)
+
+    def _leaves(self, values):
+        # sklearn evaluates trees on float32 inputs
+        values = np.asarray(values, dtype=np.float32)
+        rows = np.arange(len(values))
+        nodes = np.zeros(len(values), dtype=np.int64)
+
+        active = self.children_left[nodes] != -1
+        while active.any():
+            current = nodes[active]
+            go_left = (values[rows[active], self.feature[current]]
+                       <= self.threshold[current])
+            nodes[active] = np.where(go_left, self.children_left[current],
+                                     self.children_right[current])
+            active = self.children_left[nodes] != -1
+
+        return nodes
+
+    def predict_proba(self, values):
+        counts = self.value[self._leaves(values), 0, :]
+        return counts / counts.sum(axis=1, keepdims=True)
+
+    def predict(self, values):
+        leaves = self._leaves(values)
+        if self.classes is not None:
+            return self.classes[np.argmax(self.value[leaves, 0, :], axis=1)]
+
+        predictions = self.value[leaves, :, 0]
+        return predictions[:, 0] if predictions.shape[1] == 1 else predictions
+
+    def arrays(self):
+        arrays = {"children_left": self.children_left,
+                  "children_right": self.children_right,
+                  "feature": self.feature, "threshold": self.threshold,
+                  "value": self.value, "n_features": np.array(self.n_features)}
+        if self.classes is not None:
+            arrays["classes"] = self.classes
+        return arrays
+
+
+def compile_model(model):
+    """Exports a sklearn model to NumPy arrays
+
+    Args:
+        model (sklearn estimator): The unpickled model
+
+    Returns:
+        Compiled model, or None if the estimator type is not supported
+    """
+    name = type(model).__name__
+
+    if name in LINEAR_REGRESSORS:
+        return CompiledLinearModel(model.coef_, model.intercept_)
+
+    if name in LOGISTIC_CLASSIFIERS:
+        # 'warn' (sklearn 0.20/0.21) behaves like 'ovr'. Newer versions,
+        # including those without the attribute, are multinomial unless
+        # the solver is liblinear
+        multi_class = getattr(model, "multi_class", "auto")
+        multinomial = (multi_class == "multinomial"
+                       or (multi_class in ("auto", "deprecated")
+                           and getattr(model, "solver", "") != "liblinear"))
+        return CompiledLogisticModel(model.coef_, model.intercept_,
+                                     model.classes_, multinomial)
+
+    if name in TREES:
+        tree = model.tree_
+        n_features = getattr(model, "n_features_in_", None)
+        if n_features is None:
+            n_features = model.n_features_
+        return CompiledTreeModel(tree.children_left, tree.children_right,
+                                 tree.feature, tree.threshold, tree.value,
+                                 getattr(model, "classes_", None), n_features)
+
+    return None
+
+
+def source_digest(sav_path):
+    """SHA-256 hex digest of a .sav file"""
+    digest = hashlib.sha256()
+    with open(sav_path, 'rb') as model_file:
+        for chunk in iter(lambda: model_file.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def save_compiled(compiled, path, source_sha256=""):
+    """Writes a compiled model to a compressed .npz file
+
+    Args:
+        compiled: Model returned by compile_model
+        path (str): Destination .npz
+        source_sha256 (str): Digest of the .sav the model was compiled from
+    """
+    np.savez_compressed(path, kind=np.array(compiled.kind),
+                        source_sha256=np.array(source_sha256), **compiled.arrays())
+
+
+def is_current(npz_path, sav_path):
+    """True if the .npz was compiled from the current contents of the .sav file"""
+    with np.load(npz_path, allow_pickle=False) as data:
+        if "source_sha256" not in data.files:
+            return False
+        recorded = str(data["source_sha256"])
+
+    return recorded == source_digest(sav_path)
+
+
+def load_compiled(path):
+    """Reads a compiled model written by save_compiled"""
+    with np.load(path, allow_pickle=False) as data:
+        kind = str(data["kind"])
+
+        if kind == "linear":
+            return CompiledLinearModel(data["coef"], data["intercept"])
+
+        if kind == "logistic":
+            return CompiledLogisticModel(data["coef"], data["intercept"],
+                                         data["classes"], bool(data["multinomial"]))
+
+        if kind == "tree":
+            classes = data["classes"] if "classes" in data.files else None
+            return CompiledTreeModel(data["children_left"], data["children_right"],
+                                     data["feature"], data["threshold"], data["value"],
+                                     classes, int(data["n_features"]))
+
+    raise ValueError("Unknown compiled model kind %s in %s" % (kind, path))
+
+
+def compiled_path(sav_path):
+    """Returns the .npz path belonging to a .sav model"""
+    return os.path.splitext(sav_path)[0] + ".npz"
+
+
+def reference_path(sav_path):
+    """Returns the path of the reference outputs belonging to a .sav model"""
+    return os.path.splitext(sav_path)[0] + ".reference.npz"
+
+
+def parity_inputs(compiled, samples=PARITY_SAMPLES, seed=0):
+    """Random inputs covering the range the model was trained on"""
+    rng = np.random.RandomState(seed)
+
+    if isinstance(compiled, CompiledTreeModel):
+        # Spread samples around the split thresholds so every branch is used
+        split = compiled.feature >= 0
+        low = np.full(compiled.n_features, -1.0)
+        high = np.full(compiled.n_features, 1.0)
+        for feature in range(compiled.n_features):
+            thresholds = compiled.threshold[split & (compiled.feature == feature)]
+            if len(thresholds):
+                margin = max(1.0, np.ptp(thresholds))
+                low[feature] = thresholds.min() - margin
+                high[feature] = thresholds.max() + margin
+        return rng.uniform(low, high, size=(samples, compiled.n_features))
+
+    return rng.normal(0.0, 2.0, size=(samples, compiled.n_features))
+
+
+def model_outputs(model, values):
+    """predict, and predict_proba if the model has it, on values"""
+    outputs = {"predict": np.asarray(model.predict(values))}
+    if hasattr(model, "predict_proba"):
+        outputs["predict_proba"] = np.asarray(model.predict_proba(values))
+    return outputs
+
+
+def outputs_match(actual, expected):
+    """Compares the outputs of model_outputs, probabilities only if both have them"""
+    for name in ("predict_proba", "predict"):
+        if name not in expected or name not in actual:
+            continue
+
+        if expected[name].dtype.kind in "fc":
+            if expected[name].shape != actual[name].shape or not np.allclose(
+                    actual[name], expected[name], rtol=PARITY_RTOL, atol=PARITY_ATOL):
+                return False
+        elif not np.array_equal(actual[name], expected[name]):
+            return False
+
+    return "predict" in actual and "predict" in expected
+
+
+def check_parity(model, compiled, samples=PARITY_SAMPLES):
+    """Compares compiled and sklearn outputs on random inputs
+
+    Returns:
+        bool: True if predict (and predict_proba, if present) agree
+    """
+    values = parity_inputs(compiled, samples)
+    return outputs_match(model_outputs(compiled, values), model_outputs(model, values))
+
+
+def save_reference(model, compiled, path, samples=PARITY_SAMPLES):
+    """Writes the parity inputs and the sklearn outputs on them"""
+    values = parity_inputs(compiled, samples)
+    np.savez_compressed(path, inputs=values, **model_outputs(model, values))
+
+
+def check_reference(compiled, path):
+    """Compares a compiled model with the sklearn outputs saved by save_reference
+
+    Returns:
+        bool: True if the outputs agree
+    """
+    with np.load(path, allow_pickle=False) as data:
+        expected = {name: data[name] for name in data.files}
+
+    return outputs_match(model_outputs(compiled, expected.pop("inputs")), expected)
+
+
+def compile_file(sav_path):
+    """Compiles one .sav file, writing the .npz only if it passes the parity check
+
+    Returns:
+        str: 'compiled', 'unsupported' or 'mismatch'
+    """
+    with open(sav_path, 'rb') as model_file:
+        model = pickle.load(model_file)
+
+    compiled = compile_model(model)
+    if compiled is None:
+        logging.info("%s: %s is not supported, keeping sklearn"
+                     % (sav_path, type(model).__name__))
+        return "unsupported"
+
+    if not check_parity(model, compiled):
+        logging.error("%s: compiled model does not match sklearn, not written" % sav_path)
+        return "mismatch"
+
+    save_compiled(compiled, compiled_path(sav_path), source_digest(sav_path))
+    save_reference(model, compiled, reference_path(sav_path))
+    return "compiled"
+
+
+def check_file(sav_path):
+    """Checks an existing .npz against its .sav file and its reference outputs
+
+    Returns:
+        str: 'ok', 'unsupported', 'missing', 'stale' or 'mismatch'
+    """
+    with open(sav_path, 'rb') as model_file:
+        model = pickle.load(model_file)
+
+    if compile_model(model) is None:
+        return "unsupported"
+
+    npz_path, reference = compiled_path(sav_path), reference_path(sav_path)
+    for path in (npz_path, reference):
+        if not os.path.exists(path):
+            logging.error("%s: %s is missing, run model_compiler.py" % (sav_path, path))
+            return "missing"
+
+    if not is_current(npz_path, sav_path):
+        logging.error("%s: %s was compiled from another file, run model_compiler.py"
+                      % (sav_path, npz_path))
+        return "stale"
+
+    compiled = load_compiled(npz_path)
+    if not (check_parity(model, compiled) and check_reference(compiled, reference)):
+        return "mismatch"
+    return "ok"
+
+
+if __name__ == '__main__':
+
+    logging.basicConfig(format="%(levelname)s %(message)s", level=logging.INFO)
+
+    args = sys.argv[1:]
+    check = "--check" in args
+    args = [arg for arg in args if arg != "--check"]
+    model_dir = args[0] if args else settings.MODEL_DIR
+
+    failed = False
+    for sav_path in sorted(glob.glob(os.path.join(model_dir, "*.sav"))):
+        if check:
+            result = check_file(sav_path)
+            ok = result in ("ok", "unsupported")
+        else:
+            result = compile_file(sav_path)
+            ok = result != "mismatch"
+        print(f"{sav_path}: {result}")
+        failed = failed or not ok
+
+    sys.exit(1 if failed else 0)
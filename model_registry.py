@@ -0,0 +1,162 @@
+# Basic libraries
+import logging
+import os
+import pickle
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+# Custom modules
+import model_compiler
+import settings
+
+
+class ModelRegistry:
+    """Loads the brix or classifier model of a fruit variety on first use.
+
+    Models are cached by file, so varieties without their own model share
+    the single default instance. Resident models are evicted least recently
+    used first once their combined file size exceeds max_bytes; the default
+    model is never evicted. A compiled .npz written by model_compiler is
+    used instead of the pickle when it was compiled from the same .sav bytes.
+
+    Args:
+        prefix (str): File prefix of the models, e.g. 'BRIX' or 'CLF'
+        default_path (str): Model used when a variety has no model of its own
+        model_dir (str): Directory containing the .sav files
+        max_bytes (int): Budget of resident models, measured by file size
+    """
+
+    def __init__(self, prefix, default_path, model_dir=settings.MODEL_DIR,
+                 max_bytes=settings.MODEL_CACHE_MAX_BYTES):
+        self.prefix = prefix
+        self.default_path = default_path
+        self.model_dir = model_dir
+        self.max_bytes = max_bytes
+
+        # path -> (model, size), least recently used first
+        self._models = OrderedDict()
+        self._resident_bytes = 0
+        self._default = None
+
+        # (fruit, variety) -> path of the model file to use
+        self._paths = {}
+
+        self._lock = threading.Lock()
+        self._load_locks = {}
+
+    @property
+    def default(self):
+        """The default model, loaded on first use"""
+        if self._default is None:
+            with self._load_lock(self.default_path):
+                if self._default is None:
+                    self._default, _ = self._load(self.default_path)
+        return self._default
+
+    def get(self, fruit, variety):
+        """Returns the model of a fruit variety, falling back to the default model
+
+        Args:
+            fruit (str): Fruit name
+            variety (str): Fruit variety
+        """
+        path = self._path(fruit, variety)
+        if path == self.default_path:
+            return self.default
+
+        with self._lock:
+            cached = self._models.get(path)
+            if cached is not None:
+                self._models.move_to_end(path)
+                return cached[0]
+
+        with self._load_lock(path):
+            with self._lock:
+                cached = self._models.get(path)
+                if cached is not None:
+                    return cached[0]
+
+            try:
+                model, size = self._load(path)
+            except Exception as e:
+                logging.error("Failed to load %s, using default model - %s" % (path, e))
+                self._paths[(fruit, variety)] = self.default_path
+                return self.default
+
+            self._insert(path, model, size)
+            return model
+
+    def preload(self, fruit_varieties):
+        """Loads the given models in a background thread
+
+        Varieties whose model fails to load fall back to the default model,
+        so only a default model that cannot be loaded fails the preload.
+
+        Args:
+            fruit_varieties (list): (fruit, variety) tuples expected to be used soon
+
+        Returns:
+            Future: Done once loaded, its result() raises what made the preload fail
+        """
+        loaded = Future()
+
+        def load():
+            try:
+                self.default
+                for fruit, variety in fruit_varieties:
+                    self.get(fruit, variety)
+            except Exception as e:
+                logging.critical("Preloading %s models failed - %s" % (self.prefix, e))
+                loaded.set_exception(e)
+                return
+
+            logging.info("Preloaded %s models for %s varieties"
+                         % (self.prefix, len(fruit_varieties)))
+            loaded.set_result(len(fruit_varieties))
+
+        threading.Thread(target=load, name=f"preload-{self.prefix}", daemon=True).start()
+        return loaded
+
+    def resident_bytes(self):
+        """Combined file size of the cached models, excluding the default"""
+        with self._lock:
+            return self._resident_bytes
+
+    def _path(self, fruit, variety):
+        path = self._paths.get((fruit, variety))
+        if path is None:
+            path = f"{self.model_dir}{self.prefix}_{fruit}_{variety}.sav"
+            if not os.path.exists(path):
+                logging.info("Using default %s model for %s-%s" % (self.prefix, fruit, variety))
+                path = self.default_path
+            self._paths[(fruit, variety)] = path
+        return path
+
+    def _load_lock(self, path):
+        with self._lock:
+            return self._load_locks.setdefault(path, threading.Lock())
+
+    def _insert(self, path, model, size):
+        with self._lock:
+            self._models[path] = (model, size)
+            self._resident_bytes += size
+
+            while self._resident_bytes > self.max_bytes and len(self._models) > 1:
+                evicted, (_, evicted_size) = self._models.popitem(last=False)
+                self._resident_bytes -= evicted_size
+                logging.info("Evicted model %s" % evicted)
+
+    @staticmethod
+    def _load(path):
+        """Loads a model, preferring its compiled .npz if it matches the .sav
+
+        Returns:
+            tuple: (model, size of the file it was loaded from)
+        """
+        npz_path = model_compiler.compiled_path(path)
+        if os.path.exists(npz_path) and model_compiler.is_current(npz_path, path):
+            return model_compiler.load_compiled(npz_path), os.path.getsize(npz_path)
+
+        with open(path, 'rb') as model_file:
+            return pickle.load(model_file), os.path.getsize(path)
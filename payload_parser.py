@@ -0,0 +1,140 @@
+"""Parses device payloads in a single pass over the raw MQTT bytes.
+
+Two payload formats are accepted:
+
+Text (default)
+    '1, 2, 3, 4, 5, 6, 82.5, WC0001, D20'
+    Comma separated readings followed by the Warehouse ID and Device ID
+
+Binary (opt-in)
+    Header: magic (2 bytes), version (uint8), reading count (uint8),
+            Warehouse ID (16 bytes), Device ID (16 bytes), IDs NUL padded
+    Body:   reading count little endian float32 values
+"""
+
+# Basic libraries
+import struct
+
+# Scientific Libraries
+import numpy as np
+
+BINARY_MAGIC = b"\xb5\x1b"
+BINARY_VERSION = 1
+BINARY_HEADER = struct.Struct("<2sBB16s16s")
+BINARY_ID_SIZE = 16
+
+
+class PayloadError(ValueError):
+    """Raised when a payload cannot be parsed"""
+
+
+def is_binary(payload):
+    """Returns True if the payload uses the binary layout"""
+    return payload[:2] == BINARY_MAGIC
+
+
+def parse_ids(payload):
+    """Extracts only the Warehouse ID and Device ID of a payload
+
+    Args:
+        payload (bytes): Raw MQTT payload
+
+    Returns:
+        tuple: (warehouse_id, device_id)
+    """
+    if is_binary(payload):
+        _, _, _, warehouse_id, device_id = _unpack_header(payload)
+        return warehouse_id, device_id
+
+    try:
+        _, warehouse_id, device_id = payload.rsplit(b",", 2)
+    except ValueError:
+        raise PayloadError("Payload has no Warehouse ID and Device ID")
+
+    return _decode_id(warehouse_id.strip()), _decode_id(device_id.strip())
+
+
+def parse_payload(payload):
+    """Parses a payload into IDs and readings
+
+    '1, 2, 3, 4, 5, 6, 82.5, WC0001, D20'
+        -> ('WC0001', 'D20', array([1., 2., 3., 4., 5., 6., 82.5]))
+
+    Args:
+        payload (bytes): Raw MQTT payload
+
+    Returns:
+        tuple: (warehouse_id, device_id, readings as a float64 array)
+    """
+    if is_binary(payload):
+        return _parse_binary(payload)
+
+    try:
+        readings, warehouse_id, device_id = payload.rsplit(b",", 2)
+        values = np.array(readings.split(b","), dtype=np.float64)
+    except ValueError as e:
+        raise PayloadError("Invalid text payload - %s" % e)
+
+    return _decode_id(warehouse_id.strip()), _decode_id(device_id.strip()), values
+
+
+def pack_binary_payload(warehouse_id, device_id, readings):
+    """Builds a binary payload, as sent by devices that opted into it
+
+    Args:
+        warehouse_id (str): Warehouse ID of the device
+        device_id (str): Device ID of the device
+        readings (list): Sensor readings
+
+    Returns:
+        bytes: The encoded payload
+
+    Raises:
+        PayloadError: If an ID does not fit in its 16 bytes
+    """
+    ids = []
+    for name, value in (("Warehouse ID", warehouse_id), ("Device ID", device_id)):
+        encoded = value.encode("utf-8")
+        if len(encoded) > BINARY_ID_SIZE:
+            raise PayloadError("%s %r is longer than %s bytes" % (name, value, BINARY_ID_SIZE))
+        ids.append(encoded)
+
+    readings = np.asarray(readings, dtype="<f4")
+    header = BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, len(readings), *ids)
+    return header + readings.tobytes()
+
+
+def _decode_id(raw):
+    try:
+        value = raw.decode("utf-8")
+    except UnicodeDecodeError as e:
+        raise PayloadError("ID is not valid UTF-8 - %s" % e)
+
+    if not value:
+        raise PayloadError("Payload has an empty Warehouse ID or Device ID")
+    return value
+
+
+def _unpack_header(payload):
+    if len(payload) < BINARY_HEADER.size:
+        raise PayloadError("Binary payload shorter than its header")
+
+    magic, version, count, warehouse_id, device_id = BINARY_HEADER.unpack_from(payload)
+    if version != BINARY_VERSION:
+        raise PayloadError("Unsupported binary payload version %s" % version)
+
+    return (magic, version, count,
+            _decode_id(warehouse_id.rstrip(b"\0")),
+            _decode_id(device_id.rstrip(b"\0")))
+
+
+def _parse_binary(payload):
+    _, _, count, warehouse_id, device_id = _unpack_header(payload)
+
+    if len(payload) != BINARY_HEADER.size + 4 * count:
+        raise PayloadError("Binary payload length does not match %s readings" % count)
+
+    # Reads the float32 values in place, the only copy is the float64 result
+    values = np.frombuffer(payload, dtype="<f4", count=count,
+                           offset=BINARY_HEADER.size).astype(np.float64)
+    return warehouse_id, device_id, values
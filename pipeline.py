@@ -0,0 +1,164 @@
+# Basic libraries
+import logging
+import queue
+import threading
+import time
+import zlib
+
+# Custom modules
+import settings
+
+# Backpressure policies when a worker queue is full
+BLOCK = "block"
+DROP_NEWEST = "drop_newest"
+DROP_OLDEST = "drop_oldest"
+
+_STOP = object()
+
+
+class IngestPipeline:
+    """Hands messages from the paho network thread to a pool of workers.
+
+    Every worker owns a bounded queue. Messages are routed by key, so all
+    messages of one device are handled by the same worker and in order.
+    When a queue is full the backpressure policy decides what happens:
+
+        block        Wait up to block_timeout for space, then drop the message
+        drop_newest  Drop the incoming message
+        drop_oldest  Drop the oldest queued message to make room
+
+    Args:
+        handler (callable): Called with the submitted arguments on a worker thread
+        workers (int): Number of worker threads
+        queue_size (int): Capacity of each worker queue
+        policy (str): Backpressure policy
+        block_timeout (float): Seconds the block policy waits for space
+    """
+
+    def __init__(self, handler,
+                 workers=settings.PIPELINE_WORKERS,
+                 queue_size=settings.PIPELINE_QUEUE_SIZE,
+                 policy=settings.PIPELINE_BACKPRESSURE,
+                 block_timeout=settings.PIPELINE_BLOCK_TIMEOUT):
+        if policy not in (BLOCK, DROP_NEWEST, DROP_OLDEST):
+            raise ValueError("Unknown backpressure policy %s" % policy)
+
+        self.handler = handler
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self.queue_size = queue_size
+
+        self._queues = [queue.Queue(maxsize=queue_size) for _ in range(workers)]
+        self._threads = []
+
+        self._stats_lock = threading.Lock()
+        self.submitted = 0
+        self.processed = 0
+        self.failed = 0
+        self.dropped = 0
+        self._last_full_warning = 0
+
+    def start(self):
+        """Starts the worker threads"""
+        for index, work_queue in enumerate(self._queues):
+            thread = threading.Thread(target=self._work, args=(work_queue,),
+                                      name=f"ingest-worker-{index}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def submit(self, key, *args):
+        """Queues handler(*args) on the worker that owns key
+
+        Args:
+            key (str or bytes): Routing key, e.g. the device name
+
+        Returns:
+            bool: False if the message was dropped
+        """
+        if isinstance(key, str):
+            key = key.encode("utf-8")
+        work_queue = self._queues[zlib.crc32(key) % len(self._queues)]
+
+        with self._stats_lock:
+            self.submitted += 1
+
+        try:
+            if self.policy == BLOCK:
+                work_queue.put(args, timeout=self.block_timeout)
+            else:
+                work_queue.put_nowait(args)
+            return True
+        except queue.Full:
+            pass
+
+        if self.policy == DROP_OLDEST:
+            try:
+                work_queue.get_nowait()
+                work_queue.task_done()
+                self._count_drop()
+                work_queue.put_nowait(args)
+                return True
+            except (queue.Empty, queue.Full):
+                pass
+
+        self._count_drop()
+        return False
+
+    def depth(self):
+        """Number of messages waiting in all worker queues"""
+        return sum(work_queue.qsize() for work_queue in self._queues)
+
+    def stats(self):
+        """Returns counters and queue depths for monitoring"""
+        with self._stats_lock:
+            return {
+                "submitted": self.submitted,
+                "processed": self.processed,
+                "failed": self.failed,
+                "dropped": self.dropped,
+                "depth": self.depth(),
+                "worker_depths": [work_queue.qsize() for work_queue in self._queues],
+                "capacity": self.queue_size * len(self._queues),
+            }
+
+    def stop(self, timeout=None):
+        """Processes the queued messages and stops the workers
+
+        Args:
+            timeout (float): Maximum seconds to wait for each worker
+        """
+        for work_queue in self._queues:
+            work_queue.put(_STOP)
+
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def _count_drop(self):
+        now = time.monotonic()
+        with self._stats_lock:
+            self.dropped += 1
+            dropped = self.dropped
+            warn = now - self._last_full_warning >= settings.PIPELINE_WARNING_INTERVAL
+            if warn:
+                self._last_full_warning = now
+
+        if warn:
+            logging.warning("Ingest queue full (depth %s, policy %s), %s messages dropped so far"
+                            % (self.depth(), self.policy, dropped))
+
+    def _work(self, work_queue):
+        while True:
+            args = work_queue.get()
+            try:
+                if args is _STOP:
+                    return
+                self.handler(*args)
+                with self._stats_lock:
+                    self.processed += 1
+            except Exception as e:
+                logging.error("Processing message failed - %s" % e)
+                with self._stats_lock:
+                    self.failed += 1
+            finally:
+                work_queue.task_done()
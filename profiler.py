@@ -0,0 +1,247 @@
+"""On-demand profiling of a running ingest process.
+
+A profiling session runs for a bounded duration and is started by SIGUSR1
+or the control topic ('profile[,seconds[,mode]]'). Two modes exist:
+
+    sample    Samples the stack of every thread at a fixed interval and
+              writes collapsed stacks, ready for flamegraph.pl or speedscope
+    cprofile  Runs the functions passed through wrap() under cProfile and
+              writes a pstats file
+
+Both modes also time the stages marked with stage() and write a summary.
+Reports go to LOG_DIR as profile-<pid>-<time>.*
+
+While no session is running, stage() returns a shared no-op context manager
+and wrap() adds a single check, so the hooks can stay in the hot path.
+"""
+
+# Basic libraries
+import contextlib
+import cProfile
+import functools
+import logging
+import os
+import pstats
+import signal
+import sys
+import threading
+import time
+
+# Custom modules
+import settings
+
+MODES = ("sample", "cprofile")
+
+_NULL_STAGE = contextlib.nullcontext()
+
+# The running session, None while profiling is off
+_session = None
+_session_lock = threading.Lock()
+
+
+class _StageTimer:
+
+    __slots__ = ("session", "name", "start")
+
+    def __init__(self, session, name):
+        self.session = session
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        self.session.record(self.name, time.perf_counter() - self.start)
+
+
+class ProfileSession:
+    """A single bounded profiling run
+
+    Args:
+        duration (float): Seconds to profile
+        mode (str): 'sample' or 'cprofile'
+        interval (float): Seconds between stack samples
+        log_dir (str): Directory the reports are written to
+    """
+
+    def __init__(self, duration, mode="sample", interval=settings.PROFILE_INTERVAL,
+                 log_dir=settings.LOG_DIR):
+        if mode not in MODES:
+            raise ValueError("Unknown profiling mode %s" % mode)
+
+        self.duration = min(duration, settings.PROFILE_MAX_DURATION)
+        self.mode = mode
+        self.interval = interval
+        self.log_dir = log_dir
+
+        self._lock = threading.Lock()
+        # name -> [count, total seconds, max seconds]
+        self._stages = {}
+        # (thread name, collapsed stack) -> samples
+        self._stacks = {}
+        self._profiles = []
+        self._local = threading.local()
+        self._samples = 0
+
+    def stage(self, name):
+        return _StageTimer(self, name)
+
+    def record(self, name, elapsed):
+        with self._lock:
+            stats = self._stages.get(name)
+            if stats is None:
+                self._stages[name] = [1, elapsed, elapsed]
+            else:
+                stats[0] += 1
+                stats[1] += elapsed
+                if elapsed > stats[2]:
+                    stats[2] = elapsed
+
+    def call_profiled(self, func, args, kwargs):
+        """Runs func under this thread's cProfile profile"""
+        profile = getattr(self._local, "profile", None)
+        if profile is None:
+            profile = cProfile.Profile()
+            self._local.profile = profile
+            with self._lock:
+                self._profiles.append(profile)
+
+        try:
+            return profile.runcall(func, *args, **kwargs)
+        except ValueError as e:
+            # Another profiler is active, e.g. on interpreters with one global profiler
+            if "profil" not in str(e):
+                raise
+            return func(*args, **kwargs)
+
+    def run(self):
+        """Collects until the duration has passed, then writes the reports"""
+        deadline = time.monotonic() + self.duration
+        own_thread = threading.get_ident()
+
+        try:
+            while time.monotonic() < deadline:
+                if self.mode == "sample":
+                    self._sample(own_thread)
+                    time.sleep(self.interval)
+                else:
+                    time.sleep(min(1.0, max(0.0, deadline - time.monotonic())))
+        finally:
+            _end(self)
+            self._write_reports()
+
+    def _sample(self, own_thread):
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+
+        for ident, frame in sys._current_frames().items():
+            if ident == own_thread:
+                continue
+
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            stack.append(names.get(ident, str(ident)))
+
+            key = ";".join(reversed(stack))
+            self._stacks[key] = self._stacks.get(key, 0) + 1
+
+        self._samples += 1
+
+    def _write_reports(self):
+        os.makedirs(self.log_dir, exist_ok=True)
+        prefix = os.path.join(self.log_dir, "profile-%s-%s"
+                              % (os.getpid(), time.strftime("%Y%m%d-%H%M%S")))
+
+        if self.mode == "sample":
+            with open(prefix + ".collapsed", "w") as report:
+                for stack, count in sorted(self._stacks.items()):
+                    report.write(f"{stack} {count}\n")
+        elif self._profiles:
+            stats = pstats.Stats(self._profiles[0])
+            for profile in self._profiles[1:]:
+                stats.add(profile)
+            stats.dump_stats(prefix + ".pstats")
+
+        with open(prefix + ".stages.txt", "w") as report:
+            report.write(f"{'stage':<16}{'count':>10}{'total s':>12}{'mean ms':>12}{'max ms':>12}\n")
+            for name, (count, total, longest) in sorted(self._stages.items(),
+                                                        key=lambda item: -item[1][1]):
+                report.write(f"{name:<16}{count:>10}{total:>12.3f}"
+                             f"{total / count * 1000:>12.3f}{longest * 1000:>12.3f}\n")
+
+        logging.info("Profile written to %s.* (%s, %ss, %s samples)"
+                     % (prefix, self.mode, self.duration, self._samples))
+
+
+def stage(name):
+    """Times the with block as a pipeline stage while a session is running
+
+    Args:
+        name (str): Stage name, e.g. 'parse' or 'db_write'
+    """
+    session = _session
+    if session is None:
+        return _NULL_STAGE
+    return session.stage(name)
+
+
+def wrap(func):
+    """Lets cprofile sessions profile every call of func"""
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        session = _session
+        if session is None or session.mode != "cprofile":
+            return func(*args, **kwargs)
+        return session.call_profiled(func, args, kwargs)
+
+    return wrapper
+
+
+def start(duration=settings.PROFILE_DURATION, mode="sample"):
+    """Starts a profiling session in a background thread
+
+    Args:
+        duration (float): Seconds to profile, capped at PROFILE_MAX_DURATION
+        mode (str): 'sample' or 'cprofile'
+
+    Returns:
+        bool: False if a session is already running
+    """
+    global _session
+
+    session = ProfileSession(duration, mode)
+    with _session_lock:
+        if _session is not None:
+            logging.error("Profiling already running, ignoring request")
+            return False
+        _session = session
+
+    logging.info("Profiling for %ss (%s)" % (session.duration, mode))
+    threading.Thread(target=session.run, name="profiler", daemon=True).start()
+    return True
+
+
+def _end(session):
+    global _session
+    with _session_lock:
+        if _session is session:
+            _session = None
+
+
+def handle_command(argument):
+    """Starts a session from the control topic argument 'seconds[,mode]'"""
+    seconds, _, mode = argument.partition(",")
+    try:
+        duration = float(seconds) if seconds.strip() else settings.PROFILE_DURATION
+        return start(duration, mode.strip() or "sample")
+    except ValueError as e:
+        logging.error("Invalid profile command %s - %s" % (argument, e))
+        return False
+
+
+def install_signal_handler(signum=signal.SIGUSR1):
+    """Starts a sampling session with the default duration on signum"""
+    signal.signal(signum, lambda signum, frame: start())
@@ -1,21 +1,26 @@
-# SSH and PSQL Library
-from sshtunnel import SSHTunnelForwarder
-import psycopg2
+# PSQL Library
+from psycopg2.extras import execute_values
 
 # Misc Libraries
+import functools
 import json
 from datetime import datetime
+import numpy as np
 import pytz
 
 # Custom Modules
+import db_pool
+from id_allocator import IdAllocator
 import settings
-import math
 
 # Global settings
 DEVICE_SETTINGS_TABLE = settings.PSQL_DEVICE_SETTINGS_TABLE
 DEVICE_READINGS = settings.DEVICE_READINGS
 TIMEZONE = pytz.timezone(settings.TIMEZONE)
 
+# Settings of one device, $1 placeholders work for prepared statements and asyncpg
+DEVICE_DATA_QUERY = """SELECT fruit_name AS fruit, variety, white_standard, batch_number, vendor_code, device_type FROM devices D, fruit_varieties V, fruits F, device_types T WHERE D.device_id=$1 AND D.FRUIT_VARIETY_ID = V.ID AND V.FRUIT_ID = F.ID AND D.device_type_id = T.id"""
+
 
 def create_dictionary(keys, values):
     """Creates a dictionary of sensor names and its respective sensor values
@@ -35,78 +40,208 @@ def create_dictionary(keys, values):
     return json.dumps({key: value for key, value in zip(keys, values)})
 
 
-def write_data(warehouse_id, device_id,device_readings):
-    """ Writes the data passed to the main table
+def build_params(id_pk, warehouse_id, device_id, device_readings, now):
+    """ Builds the insert parameters of a single reading
 
     Parameters
     ----------
+    id_pk: int
+        Primary key of the row
     warehouse_id: str
         Warehouse ID of the device
     device_id: str
         Device ID of the device
     device_readings: list of float values
         List of data collected by the device
-    brix: float
-        The brix predicted by the model for the current reading
-    status: float
-        The status of the fruit for the current reading
-    """
-    print("Psql write")
-    print(device_readings)
-    # Time related data
-    now = datetime.now(tz=TIMEZONE)
+    now: datetime
+        Time at which the reading was collected
+
+    Returns
+    -------
+    Tuple of values in the column order of the main table
+    """
     date_stamp = str(now.date())
     time_stamp = str(now.time())
 
-    # Unique Key
-    device_info = f"{warehouse_id}/{device_id}/{date_stamp}/{time_stamp}"
-    # ID (Primary Key)
-    id_pk = read_most_recent_id()[0] + 1
-    for reading in range(len(device_readings)):
-        if math.isnan(device_readings[reading]):
-            device_readings[reading]=0.0
-    
-    # Device readings
-    sensor_dict = create_dictionary(DEVICE_READINGS, device_readings)
-    print(device_readings)
-
-    # SQL insert query
-    insert_query = """INSERT INTO public."QLog_data"(
-                          VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s))"""
-    # Data to be inserted
-    print(sensor_dict)
-    #params = (id_pk, warehouse_id, device_id, sensor_dict, fruit, variety,
-    #          batch_number, vendor_code, brix, status, date_stamp, time_stamp, device_info,
-    #          device_readings[0],device_readings[1],device_readings[2],device_readings[3],
-    #          device_readings[4],device_readings[5],device_readings[6])
-
-    # Data to be inserted
-    #default gas1 and gas2 
+    # Missing readings are stored as 0
+    device_readings = np.asarray(device_readings, dtype=np.float64)
+    device_readings = np.where(np.isnan(device_readings), 0.0, device_readings).tolist()
+
+    # default gas2
     g2 = 0
-    params = (id_pk,warehouse_id,time_stamp,date_stamp,device_readings[0],device_readings[1],device_readings[2],device_readings[3],device_id,device_readings[4],g2)
+    return (id_pk, warehouse_id, time_stamp, date_stamp,
+            device_readings[0], device_readings[1], device_readings[2],
+            device_readings[3], device_id, device_readings[4], g2)
+
+
+def allocate_ids(count):
+    """ Reserves primary keys for readings written later
+
+    Parameters
+    ----------
+    count: int
+        Number of keys
+
+    Returns
+    -------
+    List of unused keys
+    """
+    return pool.run(_allocate_ids, count)
+
+
+def _allocate_ids(pooled, count):
+    ids = id_allocator.allocate(pooled, count)
+    pooled.commit()
+    return ids
+
+
+def write_rows(rows, ids=None):
+    """ Writes a batch of readings to the main table in a single statement
+
+    Parameters
+    ----------
+    rows: list of tuples
+        (warehouse_id, device_id, device_readings, now) for every reading
+    ids: list of int, optional
+        Keys from allocate_ids. Rows whose key already exists are skipped,
+        so a batch can be written again after a crash without duplicates
+
+    Returns
+    -------
+    The number of rows written
+    """
+    if not rows:
+        return 0
+    return pool.run(_write_rows, rows, ids)
+
+
+def _write_rows(pooled, rows, ids=None):
+    cur = pooled.cursor()
+
+    # ID (Primary Key), taken from blocks reserved in the ID sequence
+    if ids is None:
+        ids = id_allocator.allocate(pooled, len(rows))
+    params = [build_params(id_pk, warehouse_id, device_id,
+                           device_readings, now)
+              for id_pk, (warehouse_id, device_id, device_readings, now)
+              in zip(ids, rows)]
+
+    # SQL insert query, expanded to a multi-row VALUES list
+    insert_query = """INSERT INTO public."QLog_data" VALUES %s ON CONFLICT (id) DO NOTHING"""
+
     # Executing and commiting
+    execute_values(cur, insert_query, params, page_size=len(params))
+    pooled.commit()
+    return len(params)
+
+
+def write_data(warehouse_id, device_id, device_readings):
+    """ Writes the data passed to the main table
+
+    Parameters
+    ----------
+    warehouse_id: str
+        Warehouse ID of the device
+    device_id: str
+        Device ID of the device
+    device_readings: list of float values
+        List of data collected by the device
+    """
+    now = datetime.now(tz=TIMEZONE)
+    write_rows([(warehouse_id, device_id, device_readings, now)])
+
+
+# Rollup tables, one row per bucket and DEVICE_READINGS channel
+ROLLUP_TABLES = (
+    f"""CREATE TABLE IF NOT EXISTS public."{settings.PSQL_DEVICE_ROLLUP_TABLE}" (
+        granularity text NOT NULL, bucket_start timestamptz NOT NULL,
+        warehouse_id text NOT NULL, device_id text NOT NULL, channel text NOT NULL,
+        count bigint NOT NULL, sum double precision NOT NULL,
+        min double precision NOT NULL, max double precision NOT NULL,
+        mean double precision NOT NULL,
+        PRIMARY KEY (granularity, warehouse_id, device_id, bucket_start, channel))""",
+    f"""CREATE TABLE IF NOT EXISTS public."{settings.PSQL_WAREHOUSE_ROLLUP_TABLE}" (
+        granularity text NOT NULL, bucket_start timestamptz NOT NULL,
+        warehouse_id text NOT NULL, channel text NOT NULL,
+        count bigint NOT NULL, sum double precision NOT NULL,
+        min double precision NOT NULL, max double precision NOT NULL,
+        mean double precision NOT NULL,
+        PRIMARY KEY (granularity, warehouse_id, bucket_start, channel))""",
+)
+
+# Upserts add to the stored bucket, $n placeholders for asyncpg, %s for execute_values
+_ROLLUP_MERGE = """ON CONFLICT ({keys}) DO UPDATE SET
+    count = R.count + EXCLUDED.count, sum = R.sum + EXCLUDED.sum,
+    min = LEAST(R.min, EXCLUDED.min), max = GREATEST(R.max, EXCLUDED.max),
+    mean = (R.sum + EXCLUDED.sum) / (R.count + EXCLUDED.count)"""
+
+DEVICE_ROLLUP_UPSERT = (
+    f"""INSERT INTO public."{settings.PSQL_DEVICE_ROLLUP_TABLE}" AS R
+    (granularity, bucket_start, warehouse_id, device_id, channel, count, sum, min, max, mean)
+    VALUES {{values}} """
+    + _ROLLUP_MERGE.format(keys="granularity, warehouse_id, device_id, bucket_start, channel"))
+
+WAREHOUSE_ROLLUP_UPSERT = (
+    f"""INSERT INTO public."{settings.PSQL_WAREHOUSE_ROLLUP_TABLE}" AS R
+    (granularity, bucket_start, warehouse_id, channel, count, sum, min, max, mean)
+    VALUES {{values}} """
+    + _ROLLUP_MERGE.format(keys="granularity, warehouse_id, bucket_start, channel"))
+
+
+def create_rollup_tables():
+    """ Creates the rollup tables if they are missing
+    """
+    pool.run(_create_rollup_tables)
+
+
+def _create_rollup_tables(pooled):
+    cur = pooled.cursor()
+    for statement in ROLLUP_TABLES:
+        cur.execute(statement)
+    pooled.commit()
+
+
+def rollup_params(row):
+    """ Appends the mean to a rollup row from rollups.to_rows
+    """
+    count, total = row[-4], row[-3]
+    return row + (total / count,)
+
+
+def write_rollups(device_rows, warehouse_rows):
+    """ Adds aggregated buckets to the rollup tables in one transaction
+
+    Both upserts are committed together. If this raises, neither was
+    applied and the caller may add the rows to its next batch. The one
+    exception is a connection lost during COMMIT itself, whose outcome is
+    unknown; it is raised as RuntimeError and not retried here.
+
+    Parameters
+    ----------
+    device_rows: list of tuples
+        (granularity, bucket_start, warehouse_id, device_id, channel, count, sum, min, max)
+    warehouse_rows: list of tuples
+        (granularity, bucket_start, warehouse_id, channel, count, sum, min, max)
+    """
+    if device_rows or warehouse_rows:
+        pool.run(_write_rollups, device_rows, warehouse_rows)
+
+
+def _write_rollups(pooled, device_rows, warehouse_rows):
+    cur = pooled.cursor()
+
+    # Sorted, so concurrent ingest processes lock shared rows in the same order
+    for query, rows in ((DEVICE_ROLLUP_UPSERT, device_rows),
+                        (WAREHOUSE_ROLLUP_UPSERT, warehouse_rows)):
+        if rows:
+            params = [rollup_params(row) for row in sorted(rows)]
+            execute_values(cur, query.format(values="%s"), params, page_size=len(params))
+
+    # pool.run retries connection errors, which would apply a committed batch twice
     try:
-        conn = psycopg2.connect(database=settings.PSQL_DB_NAME,
-                                user=settings.PSQL_USER,
-                                password=settings.PSQL_PASSWORD,
-                                host=settings.PSQL_HOST,
-                                port=settings.PSQL_PORT)
-
-        cur = conn.cursor()
-        x  = cur.execute(insert_query, params)
+        pooled.commit()
     except Exception as e:
-        print("Exception", e)
-        conn = psycopg2.connect(database=settings.PSQL_DB_NAME,
-                                user=settings.PSQL_USER,
-                                password=settings.PSQL_PASSWORD,
-                                host=settings.PSQL_HOST,
-                                port=settings.PSQL_PORT)
-        cur = conn.cursor()
-        x  = cur.execute(insert_query, params)
-    #print(cur.fetch())
-    print("done with write")
-    conn.commit()
-
+        raise RuntimeError("Rollup commit outcome unknown - %s" % e) from e
 
 
 def get_device_data(warehouse_id: str, device_id: str):
@@ -124,19 +259,35 @@ def get_device_data(warehouse_id: str, device_id: str):
     The fruit name, fruit variety, batch number and vendor code
     associated with the device
     """
+    return pool.run(_get_device_data, device_id)
 
-    fetch_query = """SELECT fruit_name AS fruit, variety, white_standard, batch_number, vendor_code, device_type FROM devices D, fruit_varieties V, fruits F, device_types T WHERE D.device_id=%s AND D.FRUIT_VARIETY_ID = V.ID AND V.FRUIT_ID = F.ID AND D.device_type_id = T.id"""
-    #print(fetch_query)
-    try:
-        cur.execute(fetch_query, (device_id,))
-    except Exception as e:
-        conn = psycopg2.connect(database=settings.PSQL_DB_NAME,
-                                user=settings.PSQL_USER,
-                                password=settings.PSQL_PASSWORD,
-                                host=settings.PSQL_HOST,port=settings.PSQL_PORT)
-        cur = conn.cursor()
-        cur.execute(fetch_query, (device_id,))
+
+def _get_device_data(pooled, device_id):
+    cur = pooled.cursor()
+    pooled.execute_prepared(cur, "get_device_data", DEVICE_DATA_QUERY, (device_id,))
     response = cur.fetchall()
+    pooled.commit()
+    return response
+
+
+def get_all_device_data():
+    """ Returns the settings of every device in one query
+
+    Returns
+    -------
+    Dictionary of device ID to the rows get_device_data returns for it
+    """
+    return pool.run(_get_all_device_data)
+
+
+def _get_all_device_data(pooled):
+    fetch_query = """SELECT D.device_id, fruit_name AS fruit, variety, white_standard, batch_number, vendor_code, device_type FROM devices D, fruit_varieties V, fruits F, device_types T WHERE D.FRUIT_VARIETY_ID = V.ID AND V.FRUIT_ID = F.ID AND D.device_type_id = T.id"""
+    cur = pooled.cursor()
+    cur.execute(fetch_query)
+    response = {}
+    for device_id, *row in cur.fetchall():
+        response.setdefault(device_id, []).append(tuple(row))
+    pooled.commit()
     return response
 
 
@@ -144,72 +295,302 @@ def read_most_recent_id():
     """
     Returns the most recent ID from the warehouse data table
     """
-    query = """SELECT ID FROM public."QLog_data"
-                ORDER BY id DESC LIMIT 1;"""
-
     try:
-        cur.execute(query)
-        return cur.fetchall()[0]
+        return pool.run(_read_most_recent_id)
     except Exception:
         return -1
 
 
-def read_most_recent_item(warehouse_id, device_id):
-    """
-    params: warehouse_id, device_id: To uniquely identify the device
-    return: Latest status value and device info for specific device
+def _read_most_recent_id(pooled):
+    query = """SELECT ID FROM public."QLog_data"
+                ORDER BY id DESC LIMIT 1"""
+    cur = pooled.cursor()
+    pooled.execute_prepared(cur, "read_most_recent_id", query)
+    response = cur.fetchall()
+    pooled.commit()
+    # Empty table, the first ID will be 1
+    return response[0] if response else (0,)
+
+
+# Flips 0 to 1 on the latest reading of every (warehouse_id, device_id) in
+# the arrays $1 and $2 and returns the resulting status, in one statement
+FLIP_STATUS_QUERY = """WITH latest AS (
+    SELECT T.warehouse_id, T.device_id, W.device_info
+    FROM unnest($1::text[], $2::text[]) AS T(warehouse_id, device_id)
+    CROSS JOIN LATERAL (SELECT device_info FROM warehouse_data
+                        WHERE warehouse_id=T.warehouse_id AND device_id=T.device_id
+                        ORDER BY id DESC LIMIT 1) W)
+UPDATE warehouse_data D
+SET status = CASE WHEN D.status::text = '0' THEN '1' ELSE D.status END
+FROM latest L WHERE D.device_info = L.device_info
+RETURNING L.warehouse_id, L.device_id, D.status"""
+
+# Indexes the flip statement relies on, built without blocking writers
+STATUS_INDEXES = {
+    "warehouse_data_device_recent_idx": """CREATE INDEX CONCURRENTLY IF NOT EXISTS
+       warehouse_data_device_recent_idx ON warehouse_data (warehouse_id, device_id, id)""",
+    "warehouse_data_device_info_idx": """CREATE INDEX CONCURRENTLY IF NOT EXISTS
+       warehouse_data_device_info_idx ON warehouse_data (device_info)""",
+}
+
+# A failed or interrupted concurrent build leaves an INVALID index behind,
+# which IF NOT EXISTS would keep forever
+INVALID_INDEXES_QUERY = """SELECT C.relname FROM pg_index I
+JOIN pg_class C ON C.oid = I.indexrelid
+WHERE C.relname = ANY(%s) AND NOT I.indisvalid"""
+
+
+def create_status_indexes():
+    """ Creates the indexes used by flip_statuses if they are missing or invalid
     """
-    query = """SELECT status, device_info from warehouse_data WHERE warehouse_id=%s AND device_id=%s
-                ORDER BY id DESC limit 1"""
+    pool.run(_create_status_indexes)
+
 
+def _create_status_indexes(pooled):
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction
+    pooled.conn.autocommit = True
     try:
-        cur.execute(query, (warehouse_id, device_id))
-        return cur.fetchall()[0]
-    except:
-        return (-1, -1)
+        cur = pooled.cursor()
+        cur.execute(INVALID_INDEXES_QUERY, (list(STATUS_INDEXES),))
+        for (name,) in cur.fetchall():
+            cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
 
+        for statement in STATUS_INDEXES.values():
+            cur.execute(statement)
+    finally:
+        pooled.conn.autocommit = False
 
-def update_item(status, device_info):
-    """
-    params: fruit_status: The flipped fruit status to be updated
-            device_info: To uniquely identify the device
-    return: The updated status
-    """
-    status = 1 if status == 0 else status
 
-    if device_info != -1:
-        query = """UPDATE warehouse_data SET status=%s WHERE device_info=%s"""
-        cur.execute(query, (str(status), device_info))
-        conn.commit()
+def flip_statuses(devices):
+    """ Flips the status of the latest reading of several devices in one transaction
 
-    return status
+    Parameters
+    ----------
+    devices: list of tuples
+        (warehouse_id, device_id) of every device to flip
+
+    Returns
+    -------
+    dict mapping (warehouse_id, device_id) to the updated status value,
+    devices without readings are missing
+    """
+    if not devices:
+        return {}
+    return pool.run(_flip_statuses, devices)
+
+
+def _flip_statuses(pooled, devices):
+    cur = pooled.cursor()
+    pooled.execute_prepared(cur, "flip_statuses", FLIP_STATUS_QUERY,
+                            ([warehouse_id for warehouse_id, _ in devices],
+                             [device_id for _, device_id in devices]))
+    response = {(warehouse_id, device_id): status
+                for warehouse_id, device_id, status in cur.fetchall()}
+    pooled.commit()
+    return response
 
 
 def flip_status(warehouse_id, device_id):
     """
     params: warehouse_id, device_id: To uniquely identify the device
-    return: The updated status value
+    return: The updated status value, -1 if the device has no readings
+    """
+    return flip_statuses([(warehouse_id, device_id)]).get((warehouse_id, device_id), -1)
+
+
+def get_table_columns(table):
+    """ Returns the columns of a table in their stored order
+
+    Parameters
+    ----------
+    table: str
+        Table name in the public schema, e.g. QLog_data
+
+    Returns
+    -------
+    List of (column name, PSQL data type)
+    """
+    return pool.run(_get_table_columns, table)
+
+
+def _get_table_columns(pooled, table):
+    query = """SELECT column_name, data_type FROM information_schema.columns
+               WHERE table_schema='public' AND table_name=%s ORDER BY ordinal_position"""
+    cur = pooled.cursor()
+    cur.execute(query, (table,))
+    response = cur.fetchall()
+    pooled.commit()
+    return response
+
+
+def read_chunks(query, params=(), chunk_size=settings.PSQL_STREAM_CHUNK_ROWS,
+                name="qlog_stream"):
+    """ Streams the result of a query through a server-side cursor
+
+    Only one chunk is held in memory at a time. A pooled connection is
+    borrowed until the generator is exhausted or closed.
+
+    Parameters
+    ----------
+    query: str
+        Query with %s placeholders
+    params: tuple
+        Values for the placeholders
+    chunk_size: int
+        Rows fetched per round-trip and yielded together
+    name: str
+        Name of the server-side cursor
+
+    Yields
+    ------
+    List of at most chunk_size row tuples
+    """
+    with pool.borrow() as pooled:
+        cur = pooled.cursor(name=name)
+        cur.itersize = chunk_size
+        try:
+            cur.execute(query, params)
+            while True:
+                rows = cur.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            cur.close()
+        pooled.commit()
+
+
+# Positions in the column order of build_params
+HISTORY_ID_COLUMN, HISTORY_WAREHOUSE_COLUMN, HISTORY_TIME_COLUMN, HISTORY_DATE_COLUMN = 0, 1, 2, 3
+HISTORY_DEVICE_COLUMN = 8
+HISTORY_READING_COLUMNS = (4, 5, 6, 7, 9, 10)
+
+
+@functools.lru_cache(maxsize=None)
+def main_table_columns():
+    """ Quoted column names of the main table, looked up once
     """
+    return ['"%s"' % name for name, _ in get_table_columns("QLog_data")]
 
-    status, device_info = read_most_recent_item(warehouse_id, device_id)
-    status = update_item(status, device_info)
-    return status
+
+def history_dtype():
+    """ NumPy dtype of the chunks yielded by read_history
+
+    id, warehouse_id, device_id, timestamp (local time) and one float
+    field per reading column, named like the columns of the main table
+    """
+    names = [name.strip('"') for name in main_table_columns()]
+    return np.dtype([("id", np.int64), ("warehouse_id", object), ("device_id", object),
+                     ("timestamp", "datetime64[us]")]
+                    + [(names[index], np.float64) for index in HISTORY_READING_COLUMNS])
+
+
+def read_history(warehouse_id, device_id=None, start=None, end=None,
+                 chunk_size=settings.PSQL_STREAM_CHUNK_ROWS):
+    """ Streams the readings of a device or a warehouse over a time range
+
+    Rows come from a server-side cursor in chronological order, so memory
+    is bounded by chunk_size whatever the range.
+
+    Parameters
+    ----------
+    warehouse_id: str
+        Warehouse ID of the devices
+    device_id: str, optional
+        Device ID, every device of the warehouse if not given
+    start, end: datetime, optional
+        Readings at or after start and before end, naive values are in TIMEZONE
+    chunk_size: int
+        Rows per yielded array
+
+    Yields
+    ------
+    Structured array of at most chunk_size readings, see history_dtype
+    """
+    dtype = history_dtype()
+    names = main_table_columns()
+    date_column, time_column = names[HISTORY_DATE_COLUMN], names[HISTORY_TIME_COLUMN]
+
+    conditions = [f"{names[HISTORY_WAREHOUSE_COLUMN]} = %s"]
+    params = [warehouse_id]
+    if device_id is not None:
+        conditions.append(f"{names[HISTORY_DEVICE_COLUMN]} = %s")
+        params.append(device_id)
+    for bound, operator in ((start, ">="), (end, "<")):
+        if bound is not None:
+            if bound.tzinfo is not None:
+                bound = bound.astimezone(TIMEZONE)
+            conditions.append(f"({date_column}, {time_column}) {operator} (%s, %s)")
+            params.extend((str(bound.date()), str(bound.time())))
+
+    columns = [HISTORY_ID_COLUMN, HISTORY_WAREHOUSE_COLUMN, HISTORY_DEVICE_COLUMN,
+               HISTORY_DATE_COLUMN, HISTORY_TIME_COLUMN] + list(HISTORY_READING_COLUMNS)
+    query = (f"SELECT {', '.join(names[index] for index in columns)} "
+             f"FROM public.\"QLog_data\" WHERE {' AND '.join(conditions)} "
+             f"ORDER BY {date_column}, {time_column}, {names[HISTORY_ID_COLUMN]}")
+
+    for rows in read_chunks(query, tuple(params), chunk_size, name="qlog_history"):
+        chunk = np.empty(len(rows), dtype=dtype)
+        chunk["id"] = [row[0] for row in rows]
+        chunk["warehouse_id"] = [row[1] for row in rows]
+        chunk["device_id"] = [row[2] for row in rows]
+        chunk["timestamp"] = np.array([f"{row[3]}T{row[4]}" for row in rows],
+                                      dtype="datetime64[us]")
+        # NULL readings become NaN
+        readings = np.array([row[5:] for row in rows], dtype=np.float64)
+        for index, name in enumerate(dtype.names[4:]):
+            chunk[name] = readings[:, index]
+        yield chunk
+
+
+def history_readings(chunk):
+    """ (N, readings) float matrix of a read_history chunk, for the batch functions of calculations
+    """
+    return np.column_stack([chunk[name] for name in chunk.dtype.names[4:]])
 
 
 def get_fruit_variety_list():
-    fetch_query = """SELECT fruit_name AS fruit, variety from fruits, fruit_varieties"""
+    """
+    return: (fruit, variety) of every variety in the catalogue
+    """
+    return pool.run(_get_fruit_variety_list)
+
+
+def _get_fruit_variety_list(pooled):
+    fetch_query = """SELECT fruit_name AS fruit, variety FROM fruits F, fruit_varieties V WHERE V.FRUIT_ID = F.ID"""
+    cur = pooled.cursor()
     cur.execute(fetch_query)
     response = cur.fetchall()
+    pooled.commit()
     return response
 
 
-conn = psycopg2.connect(database=settings.PSQL_DB_NAME,
-                        user=settings.PSQL_USER,
-                        password=settings.PSQL_PASSWORD,
-                        host=settings.PSQL_HOST,
-                        port=settings.PSQL_PORT)
+def get_active_fruit_variety_list():
+    """
+    return: (fruit, variety) of every variety assigned to a device
+    """
+    return pool.run(_get_active_fruit_variety_list)
 
-cur = conn.cursor()
+
+def _get_active_fruit_variety_list(pooled):
+    fetch_query = """SELECT DISTINCT fruit_name AS fruit, variety FROM devices D, fruit_varieties V, fruits F WHERE D.FRUIT_VARIETY_ID = V.ID AND V.FRUIT_ID = F.ID"""
+    cur = pooled.cursor()
+    cur.execute(fetch_query)
+    response = cur.fetchall()
+    pooled.commit()
+    return response
+
+
+# Connections are opened on first use and shared by every thread
+pool = db_pool.ConnectionPool(database=settings.PSQL_DB_NAME,
+                              user=settings.PSQL_USER,
+                              password=settings.PSQL_PASSWORD,
+                              host=settings.PSQL_HOST,
+                              port=settings.PSQL_PORT,
+                              connect_timeout=settings.PSQL_CONNECT_TIMEOUT)
+
+# Primary keys for the main table, safe across ingest processes
+id_allocator = IdAllocator()
 
 if __name__ == '__main__':
 
@@ -219,7 +600,4 @@ if __name__ == '__main__':
     f, v, w, b, vc, t = r[0]
 
     device_readings = [5733.02, 1181.52, 284.845, 184.935, 229.075, 158.735, 81.2] 
-    brix = 120
-    status = 1
-
-    write_data(warehouse_id, device_id, device_readings, brix, status, f, v, b, vc)
+    write_data(warehouse_id, device_id, device_readings)
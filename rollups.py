@@ -0,0 +1,228 @@
+# Basic libraries
+import logging
+import threading
+from datetime import datetime
+import pytz
+
+# Scientific Libraries
+import numpy as np
+
+# Custom modules
+import metrics
+import settings
+
+TIMEZONE = pytz.timezone(settings.TIMEZONE)
+CHANNELS = settings.DEVICE_READINGS
+
+# Granularity -> fields zeroed to get the start of the bucket
+TRUNCATE = {
+    'minute': {'second': 0, 'microsecond': 0},
+    'hour': {'minute': 0, 'second': 0, 'microsecond': 0},
+}
+
+# Rows of the statistics array kept for every bucket
+COUNT, SUM, MIN, MAX = range(4)
+
+ROLLUP_SECONDS = metrics.Histogram("qlog_rollup_write_seconds", "Time to upsert a batch of rollups")
+ROLLUP_ROWS = metrics.Counter("qlog_rollup_rows_written_total", "Rollup rows upserted")
+ROLLUP_FAILURES = metrics.Counter("qlog_rollup_write_failures_total", "Rollup batches that failed to write")
+ROLLUP_DROPPED = metrics.Counter("qlog_rollup_buckets_dropped_total",
+                                 "Device buckets dropped because too many were waiting")
+
+
+def empty_stats():
+    stats = np.zeros((4, len(CHANNELS)))
+    stats[MIN] = np.inf
+    stats[MAX] = -np.inf
+    return stats
+
+
+def merge_stats(stats, other):
+    stats[COUNT] += other[COUNT]
+    stats[SUM] += other[SUM]
+    np.minimum(stats[MIN], other[MIN], out=stats[MIN])
+    np.maximum(stats[MAX], other[MAX], out=stats[MAX])
+
+
+def to_rows(buckets):
+    """Turns buckets into per-channel device and warehouse rollup rows
+
+    Warehouse buckets are merged from the device buckets here, so the
+    ingest path only updates one bucket per granularity.
+
+    Args:
+        buckets (dict): (granularity, bucket_start, warehouse_id, device_id) -> statistics
+
+    Returns:
+        tuple: (device rows, warehouse rows), each row being
+            (granularity, bucket_start, warehouse_id, [device_id,] channel, count, sum, min, max)
+    """
+    warehouses = {}
+    device_rows = []
+    for (granularity, bucket_start, warehouse_id, device_id), stats in buckets.items():
+        key = (granularity, bucket_start, warehouse_id)
+        if key in warehouses:
+            merge_stats(warehouses[key], stats)
+        else:
+            warehouses[key] = stats.copy()
+        device_rows.extend((granularity, bucket_start, warehouse_id, device_id) + row
+                           for row in _channel_rows(stats))
+
+    warehouse_rows = [key + row for key, stats in warehouses.items()
+                      for row in _channel_rows(stats)]
+    return device_rows, warehouse_rows
+
+
+def _channel_rows(stats):
+    # Channels without a single valid reading in the bucket are left out
+    return [(channel, int(stats[COUNT, index]), float(stats[SUM, index]),
+             float(stats[MIN, index]), float(stats[MAX, index]))
+            for index, channel in enumerate(CHANNELS) if stats[COUNT, index]]
+
+
+class RollupAggregator:
+    """Aggregates window readings into per-minute and per-hour rollups.
+
+    Every reading written to the main table is also added here, to one
+    bucket per granularity of its device. Buckets hold count, sum, min and
+    max of every DEVICE_READINGS channel and are upserted in batches,
+    adding to whatever is already stored, so several ingest processes can
+    maintain the same rollups. write_rollups applies a batch in a single
+    transaction, so a failed batch was not applied and is merged back and
+    retried with the next one; only a connection lost during COMMIT can
+    leave it counted twice. The number of waiting buckets is capped by
+    max_buckets.
+
+    Args:
+        write_rollups (callable): Upserts (device rows, warehouse rows) in one
+            transaction, see to_rows
+        create_tables (callable): Called before the first upsert, and retried
+            before every flush until it succeeds
+        flush_interval (float): Seconds between upserts
+        granularities (tuple): Bucket sizes, keys of TRUNCATE
+        max_buckets (int): Device buckets kept while PSQL is unavailable
+    """
+
+    def __init__(self, write_rollups, create_tables=None,
+                 flush_interval=settings.ROLLUP_FLUSH_INTERVAL,
+                 granularities=settings.ROLLUP_GRANULARITIES,
+                 max_buckets=settings.ROLLUP_MAX_BUCKETS):
+        self.write_rollups = write_rollups
+        self.create_tables = create_tables
+        self.flush_interval = flush_interval
+        self.granularities = granularities
+        self.max_buckets = max_buckets
+
+        self._tables_ready = create_tables is None
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Starts the flushing thread"""
+        self._thread = threading.Thread(target=self._run,
+                                        name="rollup-writer",
+                                        daemon=True)
+        self._thread.start()
+        return self
+
+    def add(self, warehouse_id, device_id, device_readings, now=None):
+        """Adds a reading to the current buckets of its device
+
+        Args:
+            warehouse_id (str): Warehouse ID of the device
+            device_id (str): Device ID of the device
+            device_readings (list): Float values, NaN for missing channels
+            now (datetime): Time of the reading, defaults to the current time
+        """
+        if now is None:
+            now = datetime.now(tz=TIMEZONE)
+
+        values = np.asarray(device_readings, dtype=np.float64)[:len(CHANNELS)]
+        valid = ~np.isnan(values)
+        sums = np.where(valid, values, 0.0)
+
+        with self._lock:
+            for granularity in self.granularities:
+                key = (granularity, now.replace(**TRUNCATE[granularity]),
+                       warehouse_id, device_id)
+                stats = self._buckets.get(key)
+                if stats is None:
+                    stats = self._buckets[key] = empty_stats()
+
+                stats[COUNT, :len(values)] += valid
+                stats[SUM, :len(values)] += sums
+                # fmin and fmax skip NaN readings
+                np.fmin(stats[MIN, :len(values)], values, out=stats[MIN, :len(values)])
+                np.fmax(stats[MAX, :len(values)], values, out=stats[MAX, :len(values)])
+
+    def take(self):
+        """Removes and returns every bucket aggregated so far"""
+        with self._lock:
+            buckets, self._buckets = self._buckets, {}
+        return buckets
+
+    def restore(self, buckets):
+        """Merges buckets that could not be written back, oldest are dropped beyond max_buckets"""
+        with self._lock:
+            for key, stats in buckets.items():
+                current = self._buckets.get(key)
+                if current is None:
+                    self._buckets[key] = stats
+                else:
+                    merge_stats(current, stats)
+
+            excess = len(self._buckets) - self.max_buckets
+            if excess > 0:
+                for key in sorted(self._buckets, key=lambda key: key[1])[:excess]:
+                    del self._buckets[key]
+                ROLLUP_DROPPED.inc(excess)
+                logging.error("Dropped %s rollup buckets, PSQL is behind" % excess)
+
+    def flush(self):
+        """Upserts every bucket aggregated so far
+
+        Returns:
+            bool: False if the write failed and the buckets were kept
+        """
+        if not self._ensure_tables():
+            return False
+
+        buckets = self.take()
+        if not buckets:
+            return True
+
+        device_rows, warehouse_rows = to_rows(buckets)
+        try:
+            with ROLLUP_SECONDS.time():
+                self.write_rollups(device_rows, warehouse_rows)
+        except Exception as e:
+            ROLLUP_FAILURES.inc()
+            logging.error("Writing %s rollup buckets failed - %s" % (len(buckets), e))
+            self.restore(buckets)
+            return False
+
+        ROLLUP_ROWS.inc(len(device_rows) + len(warehouse_rows))
+        return True
+
+    def close(self, timeout=None):
+        """Stops the flushing thread and writes the remaining buckets"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self.flush()
+
+    def _ensure_tables(self):
+        if not self._tables_ready:
+            try:
+                self.create_tables()
+                self._tables_ready = True
+            except Exception as e:
+                logging.error("Creating the rollup tables failed - %s" % e)
+        return self._tables_ready
+
+    def _run(self):
+        self._ensure_tables()
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
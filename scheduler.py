@@ -0,0 +1,100 @@
+# Basic libraries
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+
+class DeadlineScheduler:
+    """Fires a callback for keys whose deadline has passed.
+
+    Deadlines are kept in a min-heap, so the waiting thread sleeps until
+    the earliest deadline instead of polling every device. Rescheduling or
+    cancelling a key leaves its old heap entry behind; stale entries are
+    skipped when they reach the top of the heap.
+
+    Times are time.monotonic() values.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._deadlines = {}
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._stopped = False
+
+    def schedule(self, key, deadline):
+        """Sets (or moves) the deadline of a key
+
+        Args:
+            key (hashable): Identifies the timer, e.g. the device name
+            deadline (float): time.monotonic() value at which the timer fires
+        """
+        with self._condition:
+            self._deadlines[key] = deadline
+            heapq.heappush(self._heap, (deadline, next(self._counter), key))
+
+            # Wake the runner if this is the new earliest deadline
+            if self._heap[0][2] == key:
+                self._condition.notify()
+
+    def cancel(self, key):
+        """Removes the deadline of a key, if any"""
+        with self._condition:
+            self._deadlines.pop(key, None)
+
+    def deadline(self, key):
+        """Returns the pending deadline of a key or None"""
+        with self._condition:
+            return self._deadlines.get(key)
+
+    def __len__(self):
+        with self._condition:
+            return len(self._deadlines)
+
+    def stop(self):
+        """Makes run() return"""
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+
+    def run(self, callback):
+        """Calls callback(key) for every expired key until stop() is called
+
+        Args:
+            callback (callable): Called outside the scheduler lock
+        """
+        while True:
+            with self._condition:
+                expired = self._wait_for_expired()
+                if expired is None:
+                    return
+
+            for key in expired:
+                try:
+                    callback(key)
+                except Exception as e:
+                    logging.error("Deadline callback for %s failed - %s" % (key, e))
+
+    def _wait_for_expired(self):
+        while not self._stopped:
+            now = time.monotonic()
+            expired = []
+
+            while self._heap and self._heap[0][0] <= now:
+                deadline, _, key = heapq.heappop(self._heap)
+                # Skip entries that were cancelled or rescheduled
+                if self._deadlines.get(key) == deadline:
+                    del self._deadlines[key]
+                    expired.append(key)
+
+            if expired:
+                return expired
+
+            if self._heap:
+                self._condition.wait(self._heap[0][0] - now)
+            else:
+                self._condition.wait()
+
+        return None
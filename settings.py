@@ -7,6 +7,7 @@ BASE_DIR = "/home/ubuntu/qzense_mqtt/"
 LOG_DIR = f"{BASE_DIR}log/"
 
 MQTT_LOG_FILE = f'{LOG_DIR}mqtt.log'
+SHARD_LOG_FILE = f'{LOG_DIR}shards.log'
 STATUS_UPDATE_LOG_FILE = f'{LOG_DIR}status_update.log'
 
 MODEL_DIR = f'{BASE_DIR}models/'
@@ -19,6 +20,7 @@ MQTT_PORT = 1883
 
 SUB_TOPIC = '/proto/out'
 UPDATE_SUB_TOPIC = '/update/out'
+CONTROL_TOPIC = '/qlog/control'
 
 MQTT_USER = 'Qzense'
 MQTT_PASSWORD = 'Qzenselabs'
@@ -26,6 +28,14 @@ MQTT_PASSWORD = 'Qzenselabs'
 MQTT_USER2 = "proto"
 MQTT_PASSWORD2 = "qzense"
 
+# Persistent sessions, the broker queues QoS 1 messages while a service restarts
+# Shard workers append -shard-<k> to the client ID
+EC2_CLIENT_ID = 'qlog-ec2'
+MAIN_CLIENT_ID = 'qlog-main'
+ASYNC_CLIENT_ID = 'qlog-async'
+STATUS_UPDATE_CLIENT_ID = 'qlog-status-update'
+MQTT_SUBSCRIBE_QOS = 1
+
 
 # Device Settings
 TIMEOUT = 10
@@ -34,6 +44,9 @@ MESSAGE_LIMIT = 2
 DEFAULT_BRIX_MODEL = f"{MODEL_DIR}default_brix.sav"
 DEFAULT_CLF_MODEL = f"{MODEL_DIR}default_clf.sav"
 
+# Budget of resident brix and classifier models each, in bytes of .sav files
+MODEL_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
 DEFAULT_WHITE_STANDARD = [1, 1, 1, 1, 1, 1]
 DEVICE_READINGS = ['temperature', 'humidity','gas1','gas2','gas3','gas4']
 
@@ -55,3 +68,106 @@ PSQL_PASSWORD = 'eFirst2019'
 
 PSQL_MAIN_TABLE = 'warehouse_data'
 PSQL_DEVICE_SETTINGS_TABLE = 'devices'
+PSQL_DEVICE_ROLLUP_TABLE = 'QLog_rollup_device'
+PSQL_WAREHOUSE_ROLLUP_TABLE = 'QLog_rollup_warehouse'
+
+# Connection pool settings
+PSQL_CONNECT_TIMEOUT = 10
+PSQL_POOL_MAX_CONNECTIONS = 8
+PSQL_POOL_HEALTH_CHECK_INTERVAL = 30
+PSQL_POOL_BORROW_TIMEOUT = 30
+
+# Rows fetched per round-trip when streaming query results
+PSQL_STREAM_CHUNK_ROWS = 10000
+
+# Primary keys of the main table are reserved in blocks from this sequence
+QLOG_ID_SEQUENCE = 'qlog_data_id_block_seq'
+QLOG_ID_BLOCK_SIZE = 1000
+
+# Ingest pipeline settings
+# Backpressure policy when a worker queue is full: block, drop_newest or drop_oldest
+PIPELINE_WORKERS = 4
+PIPELINE_QUEUE_SIZE = 10000
+PIPELINE_BACKPRESSURE = 'block'
+PIPELINE_BLOCK_TIMEOUT = 1.0
+PIPELINE_WARNING_INTERVAL = 60
+PIPELINE_STOP_TIMEOUT = 30
+
+# Start up, seconds completed windows wait for the device settings and
+# delays between attempts to reach PSQL
+WARM_UP_WAIT = 60
+WARM_UP_RETRY_DELAY = 1
+WARM_UP_MAX_RETRY_DELAY = 30
+
+# Device settings cache, seconds an entry is valid and cached devices
+DEVICE_CACHE_TTL = 600
+DEVICE_CACHE_MAX_SIZE = 50000
+
+# Repeated payloads, seconds a payload is remembered and payloads remembered.
+# Redeliveries with the MQTT DUP flag are always dropped. DEDUP_DROP_REPEATS
+# also drops device retransmits, and identical readings within the horizon
+DEDUP_HORIZON = 30
+DEDUP_MAX_ENTRIES = 100000
+DEDUP_DROP_REPEATS = True
+
+# Inference batching, seconds to collect windows and windows per batch
+INFERENCE_BATCH_WINDOW = 0.005
+INFERENCE_BATCH_MAX = 256
+
+# Bulk write settings, used by the spooled and asyncio writers
+BULK_WRITE_MAX_ROWS = 500
+BULK_WRITE_MAX_DELAY = 1.0
+BULK_WRITE_RETRY_DELAY = 5.0
+BULK_WRITE_CLOSE_TIMEOUT = 30
+
+# Local spool of readings, one directory per process, sizes in bytes
+SPOOL_DIR = f'{BASE_DIR}spool/'
+SPOOL_SEGMENT_BYTES = 16 * 1024 * 1024
+SPOOL_MAX_BYTES = 1024 * 1024 * 1024
+SPOOL_FSYNC_INTERVAL = 0.1
+
+# Rollups of the readings, bucket sizes, seconds between upserts and
+# device buckets kept while PSQL is unavailable
+ROLLUP_GRANULARITIES = ('minute', 'hour')
+ROLLUP_FLUSH_INTERVAL = 10
+ROLLUP_MAX_BUCKETS = 200000
+
+# Parquet export of the main table, see export_parquet.py
+EXPORT_DIR = f'{BASE_DIR}export/'
+EXPORT_CHECKPOINT_ROWS = 1000000
+EXPORT_MAX_OPEN_FILES = 64
+EXPORT_COMPRESSION = 'snappy'
+EXPORT_ID_LAG = 10 * QLOG_ID_BLOCK_SIZE
+# Seconds IDs without a row are scanned again for rows committed late
+EXPORT_GAP_RETENTION = 7 * 24 * 3600
+
+# asyncio service settings
+ASYNC_DB_POOL_SIZE = 10
+ASYNC_RECONNECT_INTERVAL = 5
+
+# Sharding, routers share SUB_TOPIC and forward each device to one worker
+SHARD_COUNT = 4
+SHARD_ROUTERS = 2
+SHARD_GROUP = 'qlog'
+SHARD_TOPIC = '/proto/shard/{}'
+SHARD_VIRTUAL_NODES = 64
+SHARD_RESTART_DELAY = 1
+SHARD_MAX_RESTART_DELAY = 60
+SHARD_STOP_TIMEOUT = 60
+
+# Metrics endpoints, http://METRICS_HOST:<port>/metrics, 0 disables one
+# Shard workers listen on SHARD_METRICS_PORT + shard
+METRICS_HOST = '127.0.0.1'
+EC2_METRICS_PORT = 9108
+STATUS_UPDATE_METRICS_PORT = 9109
+MAIN_METRICS_PORT = 9110
+SHARD_METRICS_PORT = 9120
+
+# On-demand profiling, default and maximum seconds and stack sample interval
+PROFILE_DURATION = 30
+PROFILE_MAX_DURATION = 600
+PROFILE_INTERVAL = 0.005
+
+# Status flipping, seconds to collect flip requests and devices per transaction
+STATUS_FLIP_BATCH_WINDOW = 0.002
+STATUS_FLIP_BATCH_MAX = 500
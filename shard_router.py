@@ -0,0 +1,158 @@
+"""Routes device messages to per-shard topics.
+
+Routers consume SUB_TOPIC through an MQTT shared subscription, so the
+broker spreads the raw traffic over however many routers run. Each message
+is republished unchanged to the topic of the shard owning its
+warehouse_id/device_id on a consistent hash ring. One ec2_mqtt.py worker
+subscribes to each shard topic, so every message of a window reaches the
+same process no matter which router handled it.
+
+Changing SHARD_COUNT only moves about 1/SHARD_COUNT of the devices. Windows
+in progress on a moved device are dropped by the old worker's time out.
+
+Usage:
+    python shard_router.py
+"""
+
+# Basic libraries
+import bisect
+import hashlib
+import logging
+import signal
+import sys
+from warnings import filterwarnings
+
+# MQTT Library
+import paho.mqtt.client as mqttClient
+
+# Custom modules
+import payload_parser
+import settings
+filterwarnings("ignore")
+
+# Topics
+SUB_TOPIC = settings.SUB_TOPIC
+SHARED_SUB_TOPIC = f"$share/{settings.SHARD_GROUP}/{SUB_TOPIC}"
+
+# MQTT Credentials
+USER = settings.MQTT_USER
+PASSWORD = settings.MQTT_PASSWORD
+
+BROKER_ADDRESS = settings.BROKER_ADDRESS
+MQTT_PORT = settings.MQTT_PORT
+
+
+class HashRing:
+    """Consistent hash ring mapping device keys to shards
+
+    Args:
+        shards (int): Number of shards
+        virtual_nodes (int): Points per shard on the ring, evens out the load
+    """
+
+    def __init__(self, shards=settings.SHARD_COUNT,
+                 virtual_nodes=settings.SHARD_VIRTUAL_NODES):
+        self.shards = shards
+
+        points = sorted((self._hash(f"shard-{shard}-{node}"), shard)
+                        for shard in range(shards)
+                        for node in range(virtual_nodes))
+        self._points = [point for point, _ in points]
+        self._owners = [shard for _, shard in points]
+
+    def shard(self, key):
+        """Returns the shard owning a key
+
+        Args:
+            key (str): 'warehouse_id/device_id'
+        """
+        index = bisect.bisect(self._points, self._hash(key)) % len(self._points)
+        return self._owners[index]
+
+    @staticmethod
+    def _hash(key):
+        return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big")
+
+
+def shard_topic(shard):
+    """Topic the worker of a shard subscribes to"""
+    return settings.SHARD_TOPIC.format(shard)
+
+
+ring = HashRing()
+
+
+"""
+CALLBACKS
+"""
+
+
+def on_connect(client, userdata, flags, rc):
+    if rc == 0:
+        logging.info("Router connected to broker")
+        client.subscribe(SHARED_SUB_TOPIC, qos=settings.MQTT_SUBSCRIBE_QOS)
+    else:
+        logging.error("Router connection failed %s", str(rc))
+
+
+def on_disconnect(client, userdata, rc):
+    if rc == 0:
+        logging.info("Router disconnected")
+    else:
+        logging.error("Router lost connection %s", str(rc))
+
+
+def on_message(client, userdata, message):
+    """Forwards a message to the shard of its device"""
+    try:
+        warehouse_id, device_id = payload_parser.parse_ids(message.payload)
+    except payload_parser.PayloadError as e:
+        logging.error("Dropping unroutable message - %s" % e)
+        return
+
+    shard = ring.shard(f"{warehouse_id}/{device_id}")
+    client.publish(shard_topic(shard), message.payload, qos=message.qos)
+
+
+def create_client():
+    # Create client instance
+    client = mqttClient.Client()
+    client.username_pw_set(USER, password=PASSWORD)
+
+    # Callbacks
+    client.on_connect = on_connect
+    client.on_message = on_message
+    client.on_disconnect = on_disconnect
+
+    return client
+
+
+def shutdown(signum, frame):
+    logging.info("Router received signal %s, shutting down" % signum)
+    sys.exit(0)
+
+
+"""
+MAIN LOOP
+"""
+
+if __name__ == "__main__":
+
+    logging.basicConfig(
+        filename=settings.SHARD_LOG_FILE,
+        filemode="a",
+        format="%(asctime)s - %(levelname)s %(message)s",
+        level=logging.INFO,
+    )
+
+    signal.signal(signal.SIGTERM, shutdown)
+
+    client = create_client()
+    client.connect(BROKER_ADDRESS, port=MQTT_PORT)
+
+    try:
+        client.loop_forever()
+    except KeyboardInterrupt:
+        logging.info("Router interrupted, shutting down")
+    finally:
+        client.disconnect()
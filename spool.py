@@ -0,0 +1,604 @@
+"""Local write-ahead spool for readings on their way to PSQL.
+
+Readings are appended to segment files in the spool directory before they
+are written to PSQL, so an RDS outage or a crash costs neither the MQTT
+callbacks nor the readings. Each record is
+
+    length (uint32) | crc32 (uint32) | JSON [warehouse_id, device_id, readings, time]
+
+Appends are fsynced in batches. checkpoint.json records how far the spool
+has been drained and the primary keys reserved for the batch being
+written. After a crash that batch is written again with the same keys,
+and ON CONFLICT skips whatever had already been committed. A torn record
+at the end of a segment is truncated away on open.
+
+Disk use is bounded by max_bytes. Once it is exceeded the oldest segment
+is dropped and its readings are lost.
+"""
+
+# Basic libraries
+import fcntl
+import json
+import logging
+import os
+import struct
+import threading
+import time
+import zlib
+from datetime import datetime
+import pytz
+
+# Custom modules
+import metrics
+import profiler
+import settings
+
+DB_WRITE_SECONDS = metrics.Histogram("qlog_db_write_seconds", "Time to write a batch of readings to PSQL")
+DB_WRITE_FAILURES = metrics.Counter("qlog_db_write_failures_total", "Batches PSQL failed to write")
+ROWS_WRITTEN = metrics.Counter("qlog_db_rows_written_total", "Readings written to PSQL")
+SPOOL_DROPPED = metrics.Counter("qlog_spool_dropped_total", "Readings dropped because the spool was full")
+
+TIMEZONE = pytz.timezone(settings.TIMEZONE)
+
+RECORD_HEADER = struct.Struct("<II")
+SEGMENT_PREFIX = "segment-"
+SEGMENT_SUFFIX = ".log"
+CHECKPOINT_FILE = "checkpoint.json"
+LOCK_FILE = "lock"
+
+
+class SpoolError(Exception):
+    """Raised when the spool directory cannot be used"""
+
+
+class Spool:
+    """Segmented append-only log of readings
+
+    Not thread safe, SpooledWriter serializes access with its own lock.
+
+    Args:
+        directory (str): Directory of the segment files, one per process
+        segment_bytes (int): Size at which a new segment is started
+        max_bytes (int): Disk budget of all segments
+    """
+
+    def __init__(self, directory=settings.SPOOL_DIR,
+                 segment_bytes=settings.SPOOL_SEGMENT_BYTES,
+                 max_bytes=settings.SPOOL_MAX_BYTES):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+
+        # Segment numbers oldest first, and their sizes in bytes
+        self._segments = []
+        self._sizes = {}
+
+        self._write_file = None
+        self._lock_file = None
+
+        # Drained up to here, and durable up to here
+        self._read_position = (0, 0)
+        self._synced_position = (0, 0)
+
+        # Keys reserved for the batch being written, persisted in the checkpoint
+        self._batch_ids = []
+        # End position and size of the batch handed out by read()
+        self._batch = None
+
+        # Readings appended but not yet committed
+        self._pending = 0
+
+    def open(self):
+        """Locks the directory and recovers the readings left by the last run
+
+        Returns:
+            int: Readings waiting to be drained
+        """
+        os.makedirs(self.directory, exist_ok=True)
+
+        self._lock_file = open(self._path(LOCK_FILE), "a")
+        try:
+            fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self._lock_file.close()
+            raise SpoolError("Spool %s is used by another process" % self.directory)
+
+        self._segments = sorted(
+            int(name[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)])
+            for name in os.listdir(self.directory)
+            if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX))
+
+        checkpoint = self._load_checkpoint()
+        if checkpoint is not None and checkpoint["segment"] in self._segments:
+            self._read_position = (checkpoint["segment"], checkpoint["offset"])
+            self._batch_ids = checkpoint.get("ids", [])
+        elif self._segments:
+            self._read_position = (self._segments[0], 0)
+
+        # Segments before the checkpoint were drained before they could be deleted
+        for segment in [s for s in self._segments if s < self._read_position[0]]:
+            self._delete_segment(segment)
+
+        self._pending = sum(self._recover(segment) for segment in self._segments)
+
+        # Continue in a fresh segment, everything recovered is durable
+        next_segment = self._segments[-1] + 1 if self._segments else 0
+        if self._pending == 0:
+            for segment in list(self._segments):
+                self._delete_segment(segment)
+            self._batch_ids = []
+            self._read_position = (next_segment, 0)
+
+        self._open_segment(next_segment)
+        self._synced_position = (next_segment, 0)
+        self._save_checkpoint()
+
+        if self._pending:
+            logging.info("Recovered %s readings from spool %s"
+                         % (self._pending, self.directory))
+        return self._pending
+
+    def append(self, row):
+        """Appends a reading, durable after the next sync
+
+        Args:
+            row (tuple): (warehouse_id, device_id, device_readings, now)
+
+        Returns:
+            int: Readings dropped to stay within max_bytes
+        """
+        warehouse_id, device_id, device_readings, now = row
+        payload = json.dumps([warehouse_id, device_id,
+                              [float(reading) for reading in device_readings],
+                              now.isoformat()]).encode("utf-8")
+
+        current = self._segments[-1]
+        if self._sizes[current] >= self.segment_bytes:
+            self._roll()
+            current = self._segments[-1]
+
+        self._write_file.write(RECORD_HEADER.pack(len(payload), zlib.crc32(payload)))
+        self._write_file.write(payload)
+        self._sizes[current] += RECORD_HEADER.size + len(payload)
+        self._pending += 1
+
+        return self._enforce_limit()
+
+    def flush(self):
+        """Hands the appended records to the OS
+
+        Returns:
+            tuple: (fd, position), fsync the fd outside the writer lock, close
+                it and pass position to mark_synced
+        """
+        self._write_file.flush()
+        position = (self._segments[-1], self._sizes[self._segments[-1]])
+        return os.dup(self._write_file.fileno()), position
+
+    def mark_synced(self, position):
+        """Makes records up to position visible to read()"""
+        self._synced_position = max(self._synced_position, position)
+
+    def sync(self):
+        """flush() and fsync in one step"""
+        fd, position = self.flush()
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        self.mark_synced(position)
+
+    def read(self, max_records):
+        """Returns the next durable readings to write
+
+        A batch whose keys were reserved before a crash is returned with
+        exactly the same readings and keys.
+
+        Returns:
+            tuple: (rows, ids), ids is None if keys still have to be reserved
+        """
+        if self._batch_ids:
+            max_records = min(max_records, len(self._batch_ids))
+
+        rows = []
+        segment, offset = self._read_position
+        while len(rows) < max_records:
+            if segment == self._synced_position[0]:
+                limit = self._synced_position[1]
+            elif segment < self._synced_position[0]:
+                limit = self._sizes[segment]
+            else:
+                break
+
+            for payload, offset in self._scan(segment, offset, limit,
+                                              max_records - len(rows)):
+                rows.append(self._decode(payload))
+
+            if offset < self._sizes[segment] or segment == self._segments[-1]:
+                break
+            # Segment done, continue with the next one
+            segment, offset = self._segments[self._segments.index(segment) + 1], 0
+
+        self._batch = ((segment, offset), len(rows))
+        ids = self._batch_ids[:len(rows)] if self._batch_ids else None
+        return rows, ids
+
+    def begin(self, ids):
+        """Persists the keys reserved for the batch returned by read()"""
+        self._batch_ids = list(ids)
+        self._save_checkpoint()
+
+    def commit(self):
+        """Marks the batch returned by read() as written"""
+        if self._batch is None:
+            return
+
+        self._read_position, count = self._batch
+        self._batch = None
+        self._batch_ids = []
+        self._pending -= count
+        self._save_checkpoint()
+
+        for segment in [s for s in self._segments[:-1] if s < self._read_position[0]]:
+            self._delete_segment(segment)
+
+    def abort(self):
+        """Forgets the batch returned by read(), it is read again next time"""
+        self._batch = None
+
+    def pending(self):
+        """Readings not yet written to PSQL"""
+        return self._pending
+
+    def close(self):
+        """Syncs and releases the spool, pending readings are kept for the next run"""
+        if self._write_file is not None:
+            self.sync()
+            self._write_file.close()
+            self._write_file = None
+            self._save_checkpoint()
+
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _segment_path(self, segment):
+        return self._path(f"{SEGMENT_PREFIX}{segment:012d}{SEGMENT_SUFFIX}")
+
+    def _open_segment(self, segment):
+        self._write_file = open(self._segment_path(segment), "ab")
+        self._segments.append(segment)
+        self._sizes[segment] = 0
+        self._sync_directory()
+
+    def _roll(self):
+        self.sync()
+        self._write_file.close()
+        self._open_segment(self._segments[-1] + 1)
+
+    def _delete_segment(self, segment):
+        os.remove(self._segment_path(segment))
+        self._segments.remove(segment)
+        self._sizes.pop(segment, None)
+
+    def _scan(self, segment, offset, limit, max_records=None):
+        """Yields (payload, end offset) of the valid records from offset up to limit"""
+        count = 0
+        with open(self._segment_path(segment), "rb") as segment_file:
+            segment_file.seek(offset)
+            while offset + RECORD_HEADER.size <= limit:
+                if max_records is not None and count >= max_records:
+                    return
+
+                length, crc = RECORD_HEADER.unpack(segment_file.read(RECORD_HEADER.size))
+                end = offset + RECORD_HEADER.size + length
+                if end > limit:
+                    return
+
+                payload = segment_file.read(length)
+                if zlib.crc32(payload) != crc:
+                    return
+
+                offset = end
+                count += 1
+                yield payload, offset
+
+    def _recover(self, segment):
+        """Counts the undrained records of a segment, truncating a torn tail"""
+        size = os.path.getsize(self._segment_path(segment))
+        start = self._read_position[1] if segment == self._read_position[0] else 0
+
+        end, count = start, 0
+        for _, end in self._scan(segment, start, size):
+            count += 1
+
+        if end < size:
+            logging.error("Truncating %s corrupt bytes from spool segment %s"
+                          % (size - end, segment))
+            with open(self._segment_path(segment), "r+b") as segment_file:
+                segment_file.truncate(end)
+                os.fsync(segment_file.fileno())
+
+        self._sizes[segment] = end
+        return count
+
+    def _enforce_limit(self):
+        dropped = 0
+        while (sum(self._sizes.values()) > self.max_bytes
+               and len(self._segments) > 1):
+            oldest = self._segments[0]
+
+            # Keep the segment a batch is being written from
+            if self._batch is not None and oldest <= self._batch[0][0]:
+                break
+
+            if oldest == self._read_position[0]:
+                count = sum(1 for _ in self._scan(oldest, self._read_position[1],
+                                                  self._sizes[oldest]))
+                self._read_position = (self._segments[1], 0)
+                self._batch_ids = []
+            else:
+                count = 0
+
+            self._delete_segment(oldest)
+            self._pending -= count
+            dropped += count
+
+        if dropped:
+            SPOOL_DROPPED.inc(dropped)
+            self._save_checkpoint()
+            logging.error("Spool full, dropped %s readings" % dropped)
+        return dropped
+
+    @staticmethod
+    def _decode(payload):
+        warehouse_id, device_id, device_readings, now = json.loads(payload)
+        return warehouse_id, device_id, device_readings, datetime.fromisoformat(now)
+
+    def _load_checkpoint(self):
+        try:
+            with open(self._path(CHECKPOINT_FILE)) as checkpoint_file:
+                return json.load(checkpoint_file)
+        except FileNotFoundError:
+            return None
+        except ValueError as e:
+            logging.error("Ignoring unreadable spool checkpoint - %s" % e)
+            return None
+
+    def _save_checkpoint(self):
+        segment, offset = self._read_position
+        tmp_path = self._path(CHECKPOINT_FILE + ".tmp")
+
+        with open(tmp_path, "w") as checkpoint_file:
+            json.dump({"segment": segment, "offset": offset,
+                       "ids": self._batch_ids}, checkpoint_file)
+            checkpoint_file.flush()
+            os.fsync(checkpoint_file.fileno())
+
+        os.replace(tmp_path, self._path(CHECKPOINT_FILE))
+        self._sync_directory()
+
+    def _sync_directory(self):
+        fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+class SpooledWriter:
+    """Spools device readings locally and drains them to PSQL in batches.
+
+    add() only appends to the spool; a background thread fsyncs the
+    appends every fsync_interval seconds and writes durable readings to
+    PSQL once max_rows are waiting or the oldest has waited max_delay. While PSQL is failing readings stay on
+    disk and are retried every retry_delay seconds, and readings left on
+    close are written by the next run.
+
+    Args:
+        write_rows (callable): write_rows(rows, ids), e.g. psql_func.write_rows
+        allocate_ids (callable): allocate_ids(count), e.g. psql_func.allocate_ids
+        spool (Spool): The spool, opened by start()
+        max_rows (int): Number of waiting rows that triggers a write
+        max_delay (float): Seconds a reading may wait before it is written
+        fsync_interval (float): Seconds between fsyncs of new readings
+        retry_delay (float): Seconds to wait after a failed write
+    """
+
+    def __init__(self, write_rows, allocate_ids, spool,
+                 max_rows=settings.BULK_WRITE_MAX_ROWS,
+                 max_delay=settings.BULK_WRITE_MAX_DELAY,
+                 fsync_interval=settings.SPOOL_FSYNC_INTERVAL,
+                 retry_delay=settings.BULK_WRITE_RETRY_DELAY):
+        self.write_rows = write_rows
+        self.allocate_ids = allocate_ids
+        self.spool = spool
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self.fsync_interval = fsync_interval
+        self.retry_delay = retry_delay
+
+        self._condition = threading.Condition()
+        self._thread = None
+        self._closing = False
+
+        # Appended readings not yet fsynced, and when the first was appended
+        self._unsynced = 0
+        self._first_unsynced = None
+        self._syncing = False
+
+        # When the oldest unwritten reading was appended
+        self._first_pending = None
+        self._retry_at = 0
+
+        # Sequence numbers used by flush() to wait for earlier readings
+        self._added = 0
+        self._done = 0
+        self._flush_target = 0
+
+    def start(self):
+        """Opens the spool and starts the background thread"""
+        recovered = self.spool.open()
+        with self._condition:
+            self._added = self._done + recovered
+            if recovered:
+                # Left by the last run, written straight away
+                self._first_pending = time.monotonic() - self.max_delay
+
+        self._thread = threading.Thread(target=self._run,
+                                        name="spooled-writer",
+                                        daemon=True)
+        self._thread.start()
+        return self
+
+    def add(self, warehouse_id, device_id, device_readings):
+        """Appends a reading to the spool
+
+        Args:
+            warehouse_id (str): Warehouse ID of the device
+            device_id (str): Device ID of the device
+            device_readings (list): Float values collected by the device
+        """
+        now = datetime.now(tz=TIMEZONE)
+
+        with self._condition:
+            dropped = self.spool.append((warehouse_id, device_id, device_readings, now))
+            self._added += 1
+            self._done += dropped
+
+            if not self._unsynced:
+                self._first_unsynced = time.monotonic()
+            if self._first_pending is None:
+                self._first_pending = time.monotonic()
+            self._unsynced += 1
+
+            if self._unsynced >= self.max_rows or self.spool.pending() >= self.max_rows:
+                self._condition.notify_all()
+
+    def flush(self, timeout=None):
+        """Writes every reading added so far and waits for it
+
+        Args:
+            timeout (float): Maximum seconds to wait, None waits forever
+
+        Returns:
+            bool: True if all readings were written within the timeout
+        """
+        with self._condition:
+            target = self._added
+            self._flush_target = max(self._flush_target, target)
+            self._retry_at = 0
+            self._condition.notify_all()
+            return self._condition.wait_for(lambda: self._done >= target,
+                                            timeout=timeout)
+
+    def close(self, timeout=None):
+        """Makes one last attempt to drain the spool and closes it
+
+        Args:
+            timeout (float): Maximum seconds to wait for the final write
+        """
+        with self._condition:
+            self._closing = True
+            self._retry_at = 0
+            self._condition.notify_all()
+
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+        with self._condition:
+            if self.spool.pending():
+                logging.error("Spooled writer closed with %s unwritten readings, "
+                              "written on next start" % self.spool.pending())
+            self.spool.close()
+
+    def pending(self):
+        """Number of readings waiting to be written"""
+        with self._condition:
+            return self.spool.pending()
+
+    def _sync_due(self, now):
+        if not self._unsynced or self._syncing:
+            return False
+        return (self._closing or self._flush_target > self._done
+                or self._unsynced >= self.max_rows
+                or now - self._first_unsynced >= self.fsync_interval)
+
+    def _drain_due(self, now):
+        if not self.spool.pending() or now < self._retry_at:
+            return False
+        return (self._closing or self._flush_target > self._done
+                or self.spool.pending() >= self.max_rows
+                or now - self._first_pending >= self.max_delay)
+
+    def _wait_time(self, now):
+        deadlines = []
+        if self._unsynced:
+            deadlines.append(self._first_unsynced + self.fsync_interval)
+        if self.spool.pending():
+            deadlines.append(max(self._first_pending + self.max_delay, self._retry_at))
+        return max(0, min(deadlines) - now) if deadlines else None
+
+    def _sync(self):
+        """fsyncs the appended readings without holding the lock, called with it held"""
+        fd, position = self.spool.flush()
+        self._unsynced = 0
+        self._syncing = True
+        self._condition.release()
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+            self._condition.acquire()
+            self._syncing = False
+        self.spool.mark_synced(position)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while True:
+                    now = time.monotonic()
+                    if self._sync_due(now):
+                        self._sync()
+                        continue
+                    if self._drain_due(now):
+                        if self._unsynced:
+                            self._sync()
+                        break
+                    if self._closing and not self._unsynced:
+                        return
+                    self._condition.wait(self._wait_time(now))
+
+                rows, ids = self.spool.read(self.max_rows)
+                if not rows:
+                    # Everything pending was dropped while syncing
+                    self.spool.abort()
+                    continue
+
+            try:
+                if ids is None:
+                    ids = self.allocate_ids(len(rows))
+                    with self._condition:
+                        self.spool.begin(ids)
+                with DB_WRITE_SECONDS.time(), profiler.stage("db_write"):
+                    self.write_rows(rows, ids)
+
+            except Exception as e:
+                DB_WRITE_FAILURES.inc()
+                logging.error("Spooled write of %s readings failed - %s" % (len(rows), e))
+                with self._condition:
+                    self.spool.abort()
+                    if self._closing:
+                        return
+                    self._retry_at = time.monotonic() + self.retry_delay
+                continue
+
+            with self._condition:
+                self.spool.commit()
+                ROWS_WRITTEN.inc(len(rows))
+                self._done += len(rows)
+                self._first_pending = time.monotonic() if self.spool.pending() else None
+                self._condition.notify_all()
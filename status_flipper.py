@@ -0,0 +1,117 @@
+# Basic libraries
+import logging
+import threading
+import time
+
+# Custom modules
+import metrics
+import psql_func
+import settings
+
+FLIP_SECONDS = metrics.Histogram("qlog_status_flip_seconds", "Time to flip a batch of statuses in PSQL")
+FLIP_FAILURES = metrics.Counter("qlog_status_flip_failures_total", "Status flips that failed")
+FLIP_BATCH_SIZE = metrics.Histogram("qlog_status_flip_batch_devices", "Devices flipped per transaction",
+                                    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256, 512))
+COALESCED = metrics.Counter("qlog_status_requests_coalesced_total",
+                            "Flip requests merged into a pending flip of the same device")
+
+
+class StatusFlipper:
+    """Flips device statuses in batches, one transaction per batch.
+
+    Requests are keyed by (warehouse_id, device_id). A request for a device
+    that is already waiting is merged into it, flipping is idempotent so
+    a burst from one device costs a single update and a single feedback
+    message. While a batch is in PSQL, new requests collect and go out
+    together in the next one, so batches grow with the load.
+
+    Args:
+        on_flipped (callable): Called as on_flipped(warehouse_id, device_id, status)
+        batch_window (float): Seconds to collect requests before flipping
+        max_batch (int): Devices that trigger flipping immediately
+    """
+
+    def __init__(self, on_flipped, batch_window=settings.STATUS_FLIP_BATCH_WINDOW,
+                 max_batch=settings.STATUS_FLIP_BATCH_MAX):
+        self.on_flipped = on_flipped
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+
+        # (warehouse_id, device_id) -> None, keeps arrival order
+        self._pending = {}
+        self._first_added = None
+        self._condition = threading.Condition()
+        self._thread = None
+        self._closing = False
+
+    def start(self):
+        """Starts the flipping thread"""
+        self._thread = threading.Thread(target=self._run,
+                                        name="status-flipper",
+                                        daemon=True)
+        self._thread.start()
+        return self
+
+    def submit(self, warehouse_id, device_id):
+        """Queues a status flip of the latest reading of a device"""
+        key = (warehouse_id, device_id)
+        with self._condition:
+            if key in self._pending:
+                COALESCED.inc()
+                return
+            if not self._pending:
+                self._first_added = time.monotonic()
+            self._pending[key] = None
+
+            # Wake the flipping thread to start the batch window or flip now
+            if len(self._pending) == 1 or len(self._pending) >= self.max_batch:
+                self._condition.notify()
+
+    def close(self, timeout=None):
+        """Flips the pending requests and stops the flipping thread"""
+        with self._condition:
+            self._closing = True
+            self._condition.notify()
+
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while True:
+                    if self._pending:
+                        wait = self.batch_window - (time.monotonic() - self._first_added)
+                        if (wait <= 0 or self._closing
+                                or len(self._pending) >= self.max_batch):
+                            break
+                    elif self._closing:
+                        return
+                    else:
+                        wait = None
+                    self._condition.wait(wait)
+
+                batch = list(self._pending)[:self.max_batch]
+                for key in batch:
+                    del self._pending[key]
+                self._first_added = time.monotonic()
+
+            self._flip(batch)
+
+    def _flip(self, batch):
+        try:
+            with FLIP_SECONDS.time():
+                statuses = psql_func.flip_statuses(batch)
+            FLIP_BATCH_SIZE.observe(len(batch))
+        except Exception as e:
+            FLIP_FAILURES.inc(len(batch))
+            logging.error("Flipping status of %s devices failed - %s" % (len(batch), e))
+            return
+
+        for warehouse_id, device_id in batch:
+            # Devices without readings answer -1
+            status = statuses.get((warehouse_id, device_id), -1)
+            try:
+                self.on_flipped(warehouse_id, device_id, status)
+            except Exception as e:
+                logging.error("Status callback for %s/%s failed - %s" % (warehouse_id, device_id, e))
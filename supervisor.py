@@ -0,0 +1,143 @@
+"""Launches and monitors the sharded ingest processes.
+
+Starts SHARD_ROUTERS shard_router.py processes and one ec2_mqtt.py worker
+per shard. A process that exits is restarted with exponential backoff,
+which resets once it has stayed up for SHARD_MAX_RESTART_DELAY seconds.
+SIGTERM is forwarded to every process and waited on, so the workers can
+write their buffered rows before the supervisor exits.
+
+Usage:
+    python supervisor.py
+"""
+
+# Basic libraries
+import logging
+import os
+import signal
+import subprocess
+import sys
+import time
+from warnings import filterwarnings
+
+# Custom modules
+import settings
+filterwarnings("ignore")
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class Process:
+    """A supervised child process
+
+    Args:
+        name (str): Name used in the logs
+        args (list): Arguments passed to the Python interpreter
+    """
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+        self.popen = None
+        self.started = 0
+        self.restart_delay = settings.SHARD_RESTART_DELAY
+        self.restart_at = 0
+
+    def start(self):
+        self.popen = subprocess.Popen([sys.executable] + self.args, cwd=BASE_DIR)
+        self.started = time.monotonic()
+        logging.info("Started %s (pid %s)" % (self.name, self.popen.pid))
+
+    def check(self, now):
+        """Restarts the process if it exited and its backoff has passed"""
+        if self.popen is not None:
+            code = self.popen.poll()
+            if code is None:
+                return
+
+            # Reset the backoff after a long enough run
+            if now - self.started >= settings.SHARD_MAX_RESTART_DELAY:
+                self.restart_delay = settings.SHARD_RESTART_DELAY
+
+            logging.error("%s exited with %s, restarting in %ss"
+                          % (self.name, code, self.restart_delay))
+            self.popen = None
+            self.restart_at = now + self.restart_delay
+            self.restart_delay = min(self.restart_delay * 2,
+                                     settings.SHARD_MAX_RESTART_DELAY)
+
+        if now >= self.restart_at:
+            self.start()
+
+    def terminate(self):
+        if self.popen is not None and self.popen.poll() is None:
+            self.popen.terminate()
+
+    def wait(self, deadline):
+        if self.popen is None:
+            return
+        try:
+            self.popen.wait(max(0, deadline - time.monotonic()))
+        except subprocess.TimeoutExpired:
+            logging.error("%s did not stop in time, killing it" % self.name)
+            self.popen.kill()
+            self.popen.wait()
+
+
+def create_processes(shards=settings.SHARD_COUNT, routers=settings.SHARD_ROUTERS):
+    processes = [Process(f"router-{router}", ["shard_router.py"])
+                 for router in range(routers)]
+    processes += [Process(f"worker-{shard}", ["ec2_mqtt.py", "--shard", str(shard)])
+                  for shard in range(shards)]
+    return processes
+
+
+stopping = False
+
+
+def shutdown(signum, frame):
+    global stopping
+    logging.info("Supervisor received signal %s, stopping shards" % signum)
+    stopping = True
+
+
+"""
+MAIN LOOP
+"""
+
+if __name__ == "__main__":
+
+    logging.basicConfig(
+        filename=settings.SHARD_LOG_FILE,
+        filemode="a",
+        format="%(asctime)s - %(levelname)s %(message)s",
+        level=logging.INFO,
+    )
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    processes = create_processes()
+
+    # Workers first, so routed messages are not published to empty topics
+    for process in reversed(processes):
+        process.start()
+
+    while not stopping:
+        time.sleep(1)
+        now = time.monotonic()
+        for process in processes:
+            if not stopping:
+                process.check(now)
+
+    # Stop the routers first so the workers receive everything routed
+    routers = [process for process in processes if process.name.startswith("router")]
+    workers = [process for process in processes if process not in routers]
+
+    for group in (routers, workers):
+        deadline = time.monotonic() + settings.SHARD_STOP_TIMEOUT
+        for process in group:
+            process.terminate()
+        for process in group:
+            process.wait(deadline)
+
+    logging.info("All shards stopped")
@@ -0,0 +1,6 @@
+# Basic libraries
+import os
+import sys
+
+# The services are flat top-level modules run from the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
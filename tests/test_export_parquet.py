@@ -0,0 +1,132 @@
+# Basic libraries
+import datetime
+import os
+
+import pytest
+
+pytest.importorskip("psycopg2")
+pytest.importorskip("pytz")
+pq = pytest.importorskip("pyarrow.parquet")
+
+# Custom modules
+import export_parquet
+import psql_func
+
+COLUMNS = [("id", "bigint"), ("warehouse_id", "character varying"),
+           ("time", "time without time zone"), ("date", "date"),
+           ("r1", "double precision"), ("r2", "double precision"),
+           ("r3", "double precision"), ("r4", "double precision"),
+           ("device_id", "character varying"), ("r5", "double precision"),
+           ("gas2", "double precision")]
+
+
+class FakeTable:
+    """Committed rows of QLog_data, read the way export_parquet reads them"""
+
+    def __init__(self):
+        self.rows = {}
+        self.chunks_read = 0
+        self.fail_after_chunks = None
+
+    def commit(self, *ids):
+        for id_pk in ids:
+            self.rows[id_pk] = (id_pk, "WC0001", datetime.time(12, 0), datetime.date(2021, 5, 23),
+                                1.0, 2.0, 3.0, 4.0, "D%s" % (id_pk % 3), 5.0, 0.0)
+
+    def _chunks(self, ids, chunk_rows):
+        for start in range(0, len(ids), chunk_rows):
+            if self.fail_after_chunks is not None and self.chunks_read >= self.fail_after_chunks:
+                raise RuntimeError("Connection lost")
+            self.chunks_read += 1
+            yield [self.rows[id_pk] for id_pk in ids[start:start + chunk_rows]]
+
+    def read_range(self, last_id, upper_id, chunk_rows):
+        ids = sorted(id_pk for id_pk in self.rows if last_id < id_pk <= upper_id)
+        return self._chunks(ids, chunk_rows)
+
+    def read_gaps(self, gaps, chunk_rows):
+        ids = sorted(id_pk for id_pk in self.rows
+                     if any(low <= id_pk <= high for low, high, _ in gaps))
+        return self._chunks(ids, chunk_rows)
+
+
+@pytest.fixture
+def table(monkeypatch):
+    table = FakeTable()
+    monkeypatch.setattr(export_parquet, "read_range", table.read_range)
+    monkeypatch.setattr(export_parquet, "read_gaps", table.read_gaps)
+    monkeypatch.setattr(psql_func, "get_table_columns", lambda name: COLUMNS)
+    monkeypatch.setattr(psql_func, "read_most_recent_id",
+                        lambda: (max(table.rows, default=0),))
+    return table
+
+
+def exported_ids(output):
+    ids = []
+    for directory, _, files in os.walk(output):
+        for name in files:
+            if name.endswith(".parquet"):
+                ids.extend(pq.read_table(os.path.join(directory, name)).column("id").to_pylist())
+    return sorted(ids)
+
+
+def export(output, **kwargs):
+    kwargs.setdefault("chunk_rows", 2)
+    kwargs.setdefault("checkpoint_rows", 3)
+    kwargs.setdefault("id_lag", 0)
+    return export_parquet.export(str(output), **kwargs)
+
+
+def test_rows_committed_out_of_id_order_are_exported(tmp_path, table):
+    # Process A reserved 1-1000, process B 1001-2000 and then 2001-3000
+    table.commit(1, 2, 1001, 1002, 1003, 2001, 2002)
+    assert export(tmp_path) == 7
+
+    # A commits into its old block after the export went past it
+    table.commit(3, 4)
+    table.commit(2003)
+    assert export(tmp_path) == 3
+
+    # B fills a hole below the highest exported id
+    table.commit(1004, 5)
+    assert export(tmp_path) == 2
+
+    assert exported_ids(tmp_path) == [1, 2, 3, 4, 5, 1001, 1002, 1003, 1004, 2001, 2002, 2003]
+    assert export(tmp_path) == 0
+
+    gaps = export_parquet.load_state(str(tmp_path))["gaps"]
+    assert [gap[:2] for gap in gaps] == [[6, 1000], [1005, 2000]]
+
+
+def test_interrupted_run_exports_every_row_once(tmp_path, table):
+    table.commit(1, 2, 1001, 1002, 1003, 2001, 2002)
+    export(tmp_path)
+
+    # Fails in the id range scan, after a checkpoint of the gap rows
+    table.commit(3, 4, 5, 1004, 2003, 2004, 2005, 2006)
+    table.chunks_read = 0
+    table.fail_after_chunks = 3
+    with pytest.raises(RuntimeError):
+        export(tmp_path)
+
+    table.fail_after_chunks = None
+    export(tmp_path)
+
+    assert exported_ids(tmp_path) == sorted(table.rows)
+
+
+def test_old_gaps_are_given_up(tmp_path, table):
+    table.commit(1, 1001)
+    export(tmp_path)
+    assert export_parquet.load_state(str(tmp_path))["gaps"]
+
+    table.commit(2)
+    assert export(tmp_path, gap_retention=-1) == 0
+    assert export_parquet.load_state(str(tmp_path))["gaps"] == []
+    assert exported_ids(tmp_path) == [1, 1001]
+
+
+def test_fill_gaps():
+    gaps = [[3, 10, 0.0], [20, 20, 1.0]]
+    assert export_parquet.fill_gaps(gaps, [3, 5, 10, 20]) == [[4, 4, 0.0], [6, 9, 0.0]]
+    assert export_parquet.fill_gaps(gaps, []) == gaps
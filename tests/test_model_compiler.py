@@ -0,0 +1,91 @@
+# Basic libraries
+import os
+import pickle
+import shutil
+
+import pytest
+
+# Scientific Libraries
+import numpy as np
+
+# Custom modules
+import model_compiler
+
+MODEL_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "models")
+BUNDLED_MODELS = ["default_brix.sav", "default_clf.sav"]
+
+
+def load_sav(sav_path):
+    try:
+        with open(sav_path, 'rb') as model_file:
+            return pickle.load(model_file)
+    except Exception as e:
+        pytest.skip("The bundled models need the pinned scikit-learn - %s" % e)
+
+
+@pytest.mark.parametrize("name", BUNDLED_MODELS)
+def test_bundled_model_matches_reference(name):
+    sav_path = os.path.join(MODEL_DIR, name)
+    npz_path = model_compiler.compiled_path(sav_path)
+    reference = model_compiler.reference_path(sav_path)
+
+    assert os.path.exists(npz_path), "compiled model missing, run model_compiler.py"
+    assert os.path.exists(reference), "reference outputs missing, run model_compiler.py"
+    assert model_compiler.check_reference(model_compiler.load_compiled(npz_path), reference)
+
+
+@pytest.mark.parametrize("name", BUNDLED_MODELS)
+def test_bundled_model_matches_sklearn(name):
+    sav_path = os.path.join(MODEL_DIR, name)
+    load_sav(sav_path)
+
+    assert model_compiler.check_file(sav_path) == "ok"
+
+
+def test_reference_mismatch_is_detected():
+    sav_path = os.path.join(MODEL_DIR, "default_brix.sav")
+    compiled = model_compiler.load_compiled(model_compiler.compiled_path(sav_path))
+    reference = model_compiler.reference_path(sav_path)
+
+    compiled.intercept = compiled.intercept + 1e-3
+    assert not model_compiler.check_reference(compiled, reference)
+
+
+def test_tree_mismatch_is_detected():
+    sav_path = os.path.join(MODEL_DIR, "default_clf.sav")
+    compiled = model_compiler.load_compiled(model_compiler.compiled_path(sav_path))
+    reference = model_compiler.reference_path(sav_path)
+
+    split = np.flatnonzero(compiled.feature >= 0)[0]
+    compiled.children_left[split], compiled.children_right[split] = (
+        compiled.children_right[split], compiled.children_left[split])
+    assert not model_compiler.check_reference(compiled, reference)
+
+
+@pytest.mark.parametrize("missing", ["compiled", "reference"])
+def test_missing_reference_fails_check(tmp_path, missing):
+    sav_path = os.path.join(MODEL_DIR, "default_brix.sav")
+    load_sav(sav_path)
+
+    copy = str(tmp_path / "default_brix.sav")
+    shutil.copy(sav_path, copy)
+    if missing != "compiled":
+        shutil.copy(model_compiler.compiled_path(sav_path), model_compiler.compiled_path(copy))
+    if missing != "reference":
+        shutil.copy(model_compiler.reference_path(sav_path), model_compiler.reference_path(copy))
+
+    assert model_compiler.check_file(copy) == "missing"
+
+
+def test_replaced_sav_is_stale(tmp_path):
+    sav_path = os.path.join(MODEL_DIR, "default_brix.sav")
+    copy = str(tmp_path / "default_brix.sav")
+    shutil.copy(sav_path, copy)
+    shutil.copy(model_compiler.compiled_path(sav_path), model_compiler.compiled_path(copy))
+    assert model_compiler.is_current(model_compiler.compiled_path(copy), copy)
+
+    # A newer .sav with an older timestamp must not be shadowed by the .npz
+    with open(copy, 'ab') as model_file:
+        model_file.write(b"\0")
+    os.utime(copy, (0, 0))
+    assert not model_compiler.is_current(model_compiler.compiled_path(copy), copy)
@@ -0,0 +1,72 @@
+# Basic libraries
+import pytest
+
+# Scientific Libraries
+import numpy as np
+
+# Custom modules
+import payload_parser
+from payload_parser import PayloadError
+
+
+def test_text_payload():
+    warehouse_id, device_id, readings = payload_parser.parse_payload(b"1, 2, 3, 82.5, WC0001, D20")
+
+    assert (warehouse_id, device_id) == ("WC0001", "D20")
+    np.testing.assert_array_equal(readings, [1.0, 2.0, 3.0, 82.5])
+    assert payload_parser.parse_ids(b"1, 2, 3, 82.5, WC0001, D20") == ("WC0001", "D20")
+
+
+def test_binary_payload_round_trip():
+    payload = payload_parser.pack_binary_payload("WC0001", "D20", [1.0, 2.5])
+    warehouse_id, device_id, readings = payload_parser.parse_payload(payload)
+
+    assert (warehouse_id, device_id) == ("WC0001", "D20")
+    np.testing.assert_array_equal(readings, [1.0, 2.5])
+    assert payload_parser.parse_ids(payload) == ("WC0001", "D20")
+
+
+@pytest.mark.parametrize("payload", [
+    b"1,2,\xff,\xfe",
+    b"1,2,WC0001,\xfe",
+    b"\xff,WC0001,D20",
+])
+def test_bad_utf8_raises_payload_error(payload):
+    with pytest.raises(PayloadError):
+        payload_parser.parse_payload(payload)
+
+
+def test_bad_utf8_ids_raise_payload_error():
+    with pytest.raises(PayloadError):
+        payload_parser.parse_ids(b"1,2,\xff,\xfe")
+
+    header = payload_parser.BINARY_HEADER.pack(payload_parser.BINARY_MAGIC,
+                                               payload_parser.BINARY_VERSION,
+                                               0, b"\xff", b"D20")
+    with pytest.raises(PayloadError):
+        payload_parser.parse_payload(header)
+
+
+@pytest.mark.parametrize("payload", [b"", b"1", b"1,2", b"1,2, ,D20", b"1,2,WC0001,"])
+def test_missing_ids_raise_payload_error(payload):
+    with pytest.raises(PayloadError):
+        payload_parser.parse_payload(payload)
+    with pytest.raises(PayloadError):
+        payload_parser.parse_ids(payload)
+
+
+def test_long_ids_are_rejected():
+    with pytest.raises(PayloadError):
+        payload_parser.pack_binary_payload("W" * 17, "D20", [1.0])
+    with pytest.raises(PayloadError):
+        # 9 characters but 18 bytes in UTF-8
+        payload_parser.pack_binary_payload("WC0001", "é" * 9, [1.0])
+
+    payload = payload_parser.pack_binary_payload("W" * 16, "D" * 16, [1.0])
+    assert payload_parser.parse_ids(payload) == ("W" * 16, "D" * 16)
+
+
+def test_binary_length_mismatch():
+    payload = payload_parser.pack_binary_payload("WC0001", "D20", [1.0, 2.0])
+    with pytest.raises(PayloadError):
+        payload_parser.parse_payload(payload[:-1])
@@ -1,14 +1,17 @@
 # Basic Libraries
 import datetime
 import logging
+import threading
 from warnings import filterwarnings
 
 # MQTT Library
 import paho.mqtt.client as mqttClient
 
 # Custom modules
+import metrics
 import psql_func
 import settings
+from status_flipper import StatusFlipper
 
 filterwarnings('ignore')
 
@@ -33,35 +36,65 @@ PASSWORD = settings.MQTT_PASSWORD2
 # Connection state variable
 Connected = False
 
+# Metrics, served on http://METRICS_HOST:STATUS_UPDATE_METRICS_PORT/metrics
+MESSAGES_RECEIVED = metrics.Counter("qlog_status_requests_total", "Status flip requests received")
+MQTT_CONNECTS = metrics.Counter("qlog_mqtt_connects_total", "Connections to the broker, including reconnects")
+MQTT_DISCONNECTS = metrics.Counter("qlog_mqtt_unexpected_disconnects_total", "Connections lost unexpectedly")
+PUBLISH_FAILURES = metrics.Counter("qlog_publish_failures_total", "Status feedback publishes that failed")
+
 def on_connect(client, userdata, flags, rc):
     if rc == 0:
         logging.info("Connected to broker")
+        MQTT_CONNECTS.inc()
         global Connected
         Connected = True
 
+        # Subscribe on every connect, the broker keeps the session and
+        # queues QoS 1 requests for it while the service is down
+        client.subscribe(SUB_TOPIC, qos=settings.MQTT_SUBSCRIBE_QOS)
+        metrics.readiness.set_ready("mqtt")
+
     else:
         logging.error("Connection failed an update from the status")
 
 
 def on_disconnect(client, userdata, rc):
+    metrics.readiness.set_ready("mqtt", False)
     if rc == 0:
         global Connected
         Connected = False
         logging.info("Disconnected")
     else:
+        MQTT_DISCONNECTS.inc()
         logging.error("Still running on the status")
 
 
 def on_message(client, userdata, message):
+    MESSAGES_RECEIVED.inc()
     msg = str(message.payload.decode("utf-8"))
 
     warehouse_id = msg.split(",")[0].strip()
     device_id = msg.split(",")[1].strip()
 
-    # Updates the new status value and sends feedback to device
-    flipped_status = psql_func.flip_status(warehouse_id, device_id)
+    # Updates the new status value, feedback is sent once it is flipped
+    flipper.submit(warehouse_id, device_id)
+
+
+def send_status(warehouse_id, device_id, flipped_status):
+    """Sends the flipped status as feedback to the device"""
     logging.info('Flipping status for %s/%s ' % (warehouse_id, device_id))
-    client.publish(f"/{warehouse_id}/{device_id}", flipped_status)
+    info = client.publish(f"/{warehouse_id}/{device_id}", flipped_status)
+    if info.rc != mqttClient.MQTT_ERR_SUCCESS:
+        PUBLISH_FAILURES.inc()
+        logging.error("Status feedback to %s/%s failed - %s"
+                      % (warehouse_id, device_id, mqttClient.error_string(info.rc)))
+
+
+def create_status_indexes():
+    try:
+        psql_func.create_status_indexes()
+    except Exception as e:
+        logging.error("Creating the status indexes failed - %s" % e)
 
 
 def create_client():
@@ -70,8 +103,9 @@ def create_client():
     Returns:
         mqttClient: MQTT Clients
     """
-    # Create client instance
-    mqtt_client = mqttClient.Client()
+    # Create client instance, with a persistent session
+    mqtt_client = mqttClient.Client(client_id=settings.STATUS_UPDATE_CLIENT_ID,
+                                    clean_session=False)
     mqtt_client.username_pw_set(USER, password=PASSWORD)
 
     # Callbacks
@@ -79,20 +113,28 @@ def create_client():
     mqtt_client.on_message = on_message
     mqtt_client.on_disconnect = on_disconnect
 
-    return client
+    return mqtt_client
 
 
 if __name__ == "__main__":
 
+    # Expose the metrics and readiness endpoints
+    metrics.readiness.require("mqtt")
+    metrics.serve(settings.STATUS_UPDATE_METRICS_PORT)
+
     # Create client
     client = create_client()
 
-    # Connect to broker
-    client.connect(BROKER_ADDRESS, port=MQTT_PORT)
-    logging.info(f"Connected via Script ({USER})")
+    # Coalesces flip requests and flips them in batched transactions
+    flipper = StatusFlipper(send_status).start()
+
+    # Indexes the flip statement relies on, built in the background on first start
+    threading.Thread(target=create_status_indexes, name="status-indexes", daemon=True).start()
 
-    # Subscribe to topic
-    client.subscribe(SUB_TOPIC)
+    # Connect to broker, on_connect subscribes
+    client.connect_async(BROKER_ADDRESS, port=MQTT_PORT)
+    logging.info(f"Connecting via Script ({USER})")
 
-    # Loop forever
-    client.loop_forever()
+    # Loop forever, retrying until the broker is reachable
+    client.loop_forever(retry_first_connection=True)
+    flipper.close(settings.PIPELINE_STOP_TIMEOUT)